@@ -11,6 +11,7 @@
 # limitations under the License.
 
 import logging
+import os
 
 # Required for setting SegmentDescription attributes. Direct import as this is not part of App SDK package.
 from pydicom.sr.codedict import codes
@@ -28,6 +29,9 @@ from monai.deploy.operators.monai_bundle_inference_operator import (
     IOMapping,
     MonaiBundleInferenceOperator,
 )
+from model_registry import PreparedBundleInferenceOperator
+from output_stage import InMemoryDICOMSegmentationWriterOperator
+from seg_writer import SparseDICOMSegmentationWriterOperator
 
 import traceback
 
@@ -36,10 +40,37 @@ import traceback
 # pip_packages can be a string that is a path(str) to requirements.txt file or a list of packages.
 # The monai pkg is not required by this class, instead by the included operators.
 class AISpleenSegApp(Application):
-    def __init__(self, ahi_client, *args, **kwargs):
-        """Creates an application instance."""
+    def __init__(
+        self,
+        ahi_client,
+        *args,
+        output_buffers=None,
+        model_registry=None,
+        sliding_window=None,
+        seg_writer=None,
+        **kwargs,
+    ):
+        """Creates an application instance.
+
+        Args:
+            ahi_client: AHItoDICOM helper used to load the input image set.
+            output_buffers (OutputBuffers): If set, the DICOM SEG is written to these in-memory
+                                            buffers instead of the output folder.
+            model_registry (ModelRegistry): If set, inference uses the registry's optimized, warmed-up
+                                            models instead of loading the model on every run.
+            sliding_window (SlidingWindowConfig): ROI size, overlap, sw_batch_size and patch
+                                                  parallelism overrides; requires `model_registry`.
+            seg_writer (str): "highdicom" (default) for the App SDK writer, or "sparse" to encode only
+                              the frames that contain the segment; defaults to `SEG_WRITER`.
+        """
         self._logger = logging.getLogger("{}.{}".format(__name__, type(self).__name__))
         self.ahi_client = ahi_client
+        self.output_buffers = output_buffers
+        self.model_registry = model_registry
+        self.sliding_window = sliding_window
+        self.seg_writer = seg_writer or os.getenv("SEG_WRITER", "highdicom")
+        if self.seg_writer not in ("highdicom", "sparse"):
+            raise ValueError(f"Unsupported SEG writer {self.seg_writer}, expected highdicom or sparse")
         super().__init__(*args, **kwargs)
 
     def run(self, *args, **kwargs):
@@ -74,11 +105,17 @@ class AISpleenSegApp(Application):
 
         config_names = BundleConfigNames(config_names=["inference"])  # Same as the default
 
-        bundle_spleen_seg_op = MonaiBundleInferenceOperator(
+        bundle_op_args = dict(
             input_mapping=[IOMapping("image", Image, IOType.IN_MEMORY)],
             output_mapping=[IOMapping("pred", Image, IOType.IN_MEMORY)],
             bundle_config_names=config_names,
         )
+        if self.model_registry is not None:
+            bundle_spleen_seg_op = PreparedBundleInferenceOperator(
+                self.model_registry, sliding_window=self.sliding_window, **bundle_op_args
+            )
+        else:
+            bundle_spleen_seg_op = MonaiBundleInferenceOperator(**bundle_op_args)
 
         # Create DICOM Seg writer providing the required segment description for each segment with
         # the actual algorithm and the pertinent organ/tissue. The segment_label, algorithm_name,
@@ -97,9 +134,18 @@ class AISpleenSegApp(Application):
 
         custom_tags = {"SeriesDescription": "AI generated Seg, not for clinical use."}
 
-        dicom_seg_writer = DICOMSegmentationWriterOperator(
-            segment_descriptions=segment_descriptions, custom_tags=custom_tags
-        )
+        if self.seg_writer == "sparse":
+            dicom_seg_writer = SparseDICOMSegmentationWriterOperator(
+                segment_descriptions=segment_descriptions, custom_tags=custom_tags, output_buffers=self.output_buffers
+            )
+        elif self.output_buffers is not None:
+            dicom_seg_writer = InMemoryDICOMSegmentationWriterOperator(
+                self.output_buffers, segment_descriptions=segment_descriptions, custom_tags=custom_tags
+            )
+        else:
+            dicom_seg_writer = DICOMSegmentationWriterOperator(
+                segment_descriptions=segment_descriptions, custom_tags=custom_tags
+            )
 
         # Create the processing pipeline, by specifying the source and destination operators, and
         # ensuring the output from the former matches the input of the latter, in both name and type.
@@ -0,0 +1,224 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+# Job, datastore and image set IDs become local paths and S3 keys, so nothing that could
+# leave the job's folder or prefix is accepted.
+ID_PATTERN = re.compile(r"[A-Za-z0-9-]{1,64}")
+
+
+def check_id(name: str, value) -> None:
+    if not isinstance(value, str) or not ID_PATTERN.fullmatch(value):
+        raise ValueError(f"Invalid {name} {value!r}, expected 1-64 letters, digits or hyphens")
+
+
+def is_batch_request(body: dict) -> bool:
+    """
+    A request is a batch job only if it has a `jobId` key; a null `jobId` derives the ID from the
+    manifest. Other requests keep the regular path, however many inputs they list.
+    """
+    return "jobId" in body
+
+
+def job_id_for(items: List[dict]) -> str:
+    """Deterministic job ID, so resubmitting the same manifest resumes the same job."""
+    canonical = json.dumps([[i["datastoreId"], i["imageSetId"]] for i in items], separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()[:16]
+
+
+class PrefetchingAHIClient:
+    """
+    AHItoDICOM helper wrapper that can DICOMize the next image set in the background while the
+    current one is being processed. Image sets that were not prefetched load synchronously.
+    """
+
+    def __init__(self, ahi_helper):
+        self.ahi_helper = ahi_helper
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+        self._pending: Dict[Tuple[str, str], Future] = {}
+        self._lock = threading.Lock()
+
+    def prefetch(self, datastoreId: str, imageSetId: str) -> None:
+        key = (datastoreId, imageSetId)
+        with self._lock:
+            if key not in self._pending:
+                self._pending[key] = self._executor.submit(self.ahi_helper.DICOMizeImageSet, datastoreId, imageSetId)
+
+    def DICOMizeImageSet(self, datastoreId: str, imageSetId: str):
+        with self._lock:
+            future = self._pending.pop((datastoreId, imageSetId), None)
+        if future is None:
+            return self.ahi_helper.DICOMizeImageSet(datastoreId, imageSetId)
+        return future.result()
+
+    def cancel_pending(self) -> None:
+        """Drop prefetches that were never consumed, e.g. after a job stopped early."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.cancel()
+
+    def __getattr__(self, item):
+        return getattr(self.ahi_helper, item)
+
+
+class BatchCheckpoint:
+    """
+    Progress of a batch job in S3: one small marker object per completed image set, holding its
+    output artifacts. Markers survive container restarts, unlike the local working directory.
+    """
+
+    def __init__(self, s3_client, bucket: str, prefix: str, max_workers: int = 16):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix.rstrip("/") + "/done/"
+        self.max_workers = max_workers
+
+    def _read(self, key: str) -> dict:
+        return json.loads(self.s3_client.get_object(Bucket=self.bucket, Key=key)["Body"].read())
+
+    def completed(self) -> Dict[str, dict]:
+        """Entries of all completed image sets, keyed by image set ID."""
+        keys = []
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            keys.extend(obj["Key"] for obj in page.get("Contents", []))
+        if not keys:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(keys))) as executor:
+            entries = list(executor.map(self._read, keys))
+        return {entry["imageSetId"]: entry for entry in entries}
+
+    def mark(self, entry: dict) -> None:
+        self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key=f"{self.prefix}{entry['imageSetId']}.json",
+            Body=json.dumps(entry).encode(),
+            ContentType="application/json",
+        )
+
+
+class BatchJob:
+    """
+    Runs an AISpleenSegApp over a manifest of image sets in one invocation.
+
+    Image set K+1 is DICOMized in the background while image set K runs through the app.
+    Every completed image set is checkpointed in S3, so a restarted job with the same ID skips
+    it. The job ends by writing one output manifest covering all image sets.
+    """
+
+    def __init__(self, app, uploader, model: str, work_dir: str = "/home/model-server/requests"):
+        """
+        Args:
+            app (AISpleenSegApp): App created with a `PrefetchingAHIClient` and output buffers.
+            uploader (OutputUploader): Uploads outputs, checkpoints and the manifest.
+            model (str): Path of the TorchScript model passed to `app.run`.
+            work_dir (str): Parent folder of the per-item working folders.
+        """
+        self.app = app
+        self.uploader = uploader
+        self.model = model
+        self.work_dir = work_dir
+
+    def _prefix(self, job_id: str) -> str:
+        return f"{self.uploader.prefix}/batch/{job_id}"
+
+    def _run_item(self, job_id: str, item: dict) -> dict:
+        item_dir = os.path.join(self.work_dir, job_id, item["imageSetId"])
+        output_dir = os.path.join(item_dir, "output")
+        os.makedirs(output_dir, exist_ok=True)
+        input_file = os.path.join(item_dir, "inputImageSets.json")
+        with open(input_file, "w") as f:
+            json.dump({"datastoreId": item["datastoreId"], "imageSetId": item["imageSetId"]}, f)
+
+        entry = {"datastoreId": item["datastoreId"], "imageSetId": item["imageSetId"]}
+        start_time = time.time()
+        try:
+            self.app.output_buffers.drain()
+            # AISpleenSegApp.run logs and swallows pipeline errors; an item without outputs failed.
+            self.app.run(input=input_file, output=output_dir, workdir=item_dir, model=self.model)
+            artifacts = self.uploader.upload(
+                f"batch/{job_id}/{item['imageSetId']}", output_dir, self.app.output_buffers.drain()
+            )
+        except Exception as e:
+            entry.update(status="failed", error=str(e))
+        else:
+            if artifacts:
+                entry.update(status="completed", outputs=artifacts)
+            else:
+                entry.update(status="failed", error="app produced no outputs")
+        finally:
+            shutil.rmtree(item_dir, ignore_errors=True)
+        entry["seconds"] = round(time.time() - start_time, 3)
+        return entry
+
+    def run(self, items: List[dict], job_id: Optional[str] = None) -> dict:
+        """
+        Process every image set of the manifest that has not been completed yet.
+
+        Args:
+            items (List[dict]): The manifest, a list of `{"datastoreId", "imageSetId"}` entries.
+            job_id (str): Job ID for checkpoints and outputs, derived from the manifest if not set.
+
+        Returns:
+            dict: Job ID, manifest URI and item counts.
+        """
+        for item in items:
+            if not item.get("datastoreId") or not item.get("imageSetId"):
+                raise ValueError(f"Manifest entries need a datastoreId and an imageSetId: {item}")
+            check_id("datastoreId", item["datastoreId"])
+            check_id("imageSetId", item["imageSetId"])
+        job_id = job_id or job_id_for(items)
+        check_id("jobId", job_id)
+        prefix = self._prefix(job_id)
+        checkpoint = BatchCheckpoint(self.uploader.s3_client, self.uploader.bucket, prefix)
+        done = checkpoint.completed()
+        pending = [item for item in items if item["imageSetId"] not in done]
+        logging.info(f"Batch job {job_id}: {len(items)} image sets, {len(done)} already completed")
+
+        ahi_client = self.app.ahi_client
+        results = dict(done)
+        try:
+            if pending:
+                ahi_client.prefetch(pending[0]["datastoreId"], pending[0]["imageSetId"])
+            for k, item in enumerate(pending):
+                if k + 1 < len(pending):
+                    ahi_client.prefetch(pending[k + 1]["datastoreId"], pending[k + 1]["imageSetId"])
+                entry = self._run_item(job_id, item)
+                results[item["imageSetId"]] = entry
+                if entry["status"] == "completed":
+                    checkpoint.mark(entry)
+                else:
+                    logging.error(f"Batch job {job_id}: image set {item['imageSetId']} failed: {entry['error']}")
+                logging.info(f"Batch job {job_id}: {k + 1}/{len(pending)} image sets processed")
+        finally:
+            ahi_client.cancel_pending()
+
+        manifest = {
+            "jobId": job_id,
+            "items": [results[item["imageSetId"]] for item in items],
+        }
+        manifest["completed"] = sum(1 for entry in manifest["items"] if entry["status"] == "completed")
+        manifest["failed"] = len(items) - manifest["completed"]
+        manifest["resumed"] = len(done)
+        manifest_key = f"{prefix}/manifest.json"
+        self.uploader.s3_client.put_object(
+            Bucket=self.uploader.bucket,
+            Key=manifest_key,
+            Body=json.dumps(manifest).encode(),
+            ContentType="application/json",
+        )
+        return {
+            "jobId": job_id,
+            "manifest": f"s3://{self.uploader.bucket}/{manifest_key}",
+            "completed": manifest["completed"],
+            "failed": manifest["failed"],
+            "resumed": manifest["resumed"],
+        }
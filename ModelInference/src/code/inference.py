@@ -1,28 +1,39 @@
-import glob
 import json
 import logging
 import os
-import torch
-from importlib import import_module
-import boto3
+import shutil
+import uuid
 
-from app import AISpleenSegApp
-
-from AHItoDICOMInterface.AHItoDICOM import AHItoDICOM
-helper = AHItoDICOM()
+# torch, MONAI and AHItoDICOM load in model_fn, and the account lookup happens on the first
+# upload, so importing this script is cheap and never calls AWS.
+from batch import is_batch_request
+from lazy_init import ahi_helper, client, output_bucket
 
 JSON_CONTENT_TYPE = 'application/json'
 
-account_id = boto3.client("sts").get_caller_identity()["Account"]
-region = boto3.Session().region_name
-
 def model_fn(model_dir, context):
+    from app import AISpleenSegApp
+    from batch import PrefetchingAHIClient
+    from model_prep import configure_threads
+    from model_registry import ModelRegistry
+    from output_stage import OutputBuffers
+    from sliding_window import SlidingWindowConfig
+
     logging.info("##### context system properties: {}".format(context.system_properties))
     logging.info("##### model files: {}".format(os.listdir( model_dir )))
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model = torch.jit.load(model_dir+'/model.ts', map_location=device)
+    # Load, freeze/optimize and warm up the model once, instead of on the first request.
+    configure_threads()
+    model_registry = ModelRegistry()
+    model_registry.get(model_dir+'/model.ts')
     
-    monai_app_instance = AISpleenSegApp(helper, do_run=False, path="/home/model-server")
+    monai_app_instance = AISpleenSegApp(
+        PrefetchingAHIClient(ahi_helper()),
+        do_run=False,
+        path="/home/model-server",
+        output_buffers=OutputBuffers(),
+        model_registry=model_registry,
+        sliding_window=SlidingWindowConfig.from_env(),
+    )
     logging.info(f"#### MONAI App Info: {monai_app_instance.get_package_info()}")
 
     return monai_app_instance
@@ -40,33 +51,56 @@ def input_fn(serialized_input_data, content_type=JSON_CONTENT_TYPE):
 
 
 def predict_fn(input_data, model):
-    
-    with open('/home/model-server/inputImageSets.json', 'w') as f:
+    if is_batch_request(input_data):
+        from batch import BatchJob
+        from output_stage import OutputUploader
+
+        job = BatchJob(model, OutputUploader(client("s3"), output_bucket()), model='/opt/ml/model/model.ts')
+        return {"batch": job.run(input_data["inputs"], job_id=input_data.get("jobId"))}
+
+    # Every request works in its own folder so concurrent requests never see each other's files.
+    request_id = uuid.uuid4().hex
+    request_dir = f"/home/model-server/requests/{request_id}"
+    output_folder = f"{request_dir}/output"
+    os.makedirs(output_folder, exist_ok=True)
+
+    with open(f"{request_dir}/inputImageSets.json", 'w') as f:
         f.write(json.dumps(input_data))
-        
-    output_folder = "/home/model-server/output"
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
 
+    model.output_buffers.drain()
     model.run(
-        input='/home/model-server/inputImageSets.json',
+        input=f"{request_dir}/inputImageSets.json",
         output=output_folder,
-        workdir='/home/model-server',
+        workdir=request_dir,
         model='/opt/ml/model/model.ts'
     )
 
     logging.info("MONAI App complete")
-    logging.info("###### output files: {}".format(os.listdir(output_folder)))
-    return 
+    return {
+        "request_id": request_id,
+        "request_dir": request_dir,
+        "output_folder": output_folder,
+        "buffers": model.output_buffers.drain(),
+    }
 
 
 def output_fn(prediction_output, accept=JSON_CONTENT_TYPE):
-    s3_client = boto3.client("s3")
-    for root,dirs,files in os.walk("/home/model-server/output/"):
-        for file in files:
-            s3_client.upload_file(os.path.join(root,file), f'sagemaker-{region}-{account_id}', 'monaideploy/'+file)
-    
-    if accept == JSON_CONTENT_TYPE:
-        return json.dumps({f"s://sagemaker-{region}-{account_id}/monaideploy/{file}": "1"}), accept
+    if accept != JSON_CONTENT_TYPE:
+        raise Exception('Requested unsupported ContentType in Accept: ' + accept)
+
+    if "batch" in prediction_output:
+        logging.info("###### batch job: {}".format(prediction_output["batch"]))
+        return json.dumps(prediction_output["batch"]), accept
+
+    from output_stage import OutputUploader
+
+    uploader = OutputUploader(client("s3"), output_bucket())
+    try:
+        artifacts = uploader.upload(
+            prediction_output["request_id"], prediction_output["output_folder"], prediction_output["buffers"]
+        )
+    finally:
+        shutil.rmtree(prediction_output["request_dir"], ignore_errors=True)
+    logging.info("###### output artifacts: {}".format(artifacts))
 
-    raise Exception('Requested unsupported ContentType in Accept: ' + accept)
\ No newline at end of file
+    return json.dumps({"requestId": prediction_output["request_id"], "outputs": artifacts}), accept
\ No newline at end of file
@@ -0,0 +1,41 @@
+"""
+Lazily resolved AWS clients, account lookups and the AHItoDICOM helper.
+
+Nothing here touches the network or imports torch/MONAI at import time. Every value is
+resolved on first use and cached for the lifetime of the worker, so model server workers
+spawn quickly and a slow STS endpoint can no longer fail the container at startup.
+"""
+import functools
+
+
+@functools.lru_cache(maxsize=None)
+def client(service_name: str):
+    """Cached boto3 client for `service_name`."""
+    import boto3
+
+    return boto3.client(service_name)
+
+
+@functools.lru_cache(maxsize=None)
+def aws_region() -> str:
+    import boto3
+
+    return boto3.Session().region_name
+
+
+@functools.lru_cache(maxsize=None)
+def aws_account_id() -> str:
+    return client("sts").get_caller_identity()["Account"]
+
+
+def output_bucket() -> str:
+    """Default SageMaker bucket the inference outputs are uploaded to."""
+    return f"sagemaker-{aws_region()}-{aws_account_id()}"
+
+
+@functools.lru_cache(maxsize=None)
+def ahi_helper():
+    """Cached AHItoDICOM helper used to load image sets."""
+    from AHItoDICOMInterface.AHItoDICOM import AHItoDICOM
+
+    return AHItoDICOM()
@@ -0,0 +1,119 @@
+import logging
+import os
+import time
+from typing import Optional, Tuple
+
+import torch
+from monai.deploy.operators.monai_bundle_inference_operator import get_bundle_config
+
+from sliding_window import SlidingWindowConfig
+
+VARIANTS = ("fp32", "bf16")
+
+
+def configure_threads(
+    intra_op: Optional[int] = None,
+    inter_op: Optional[int] = None,
+) -> None:
+    """
+    Set the torch intra-op and inter-op thread pools, from `TORCH_NUM_THREADS` and
+    `TORCH_NUM_INTEROP_THREADS` if not given. Unset values keep the torch defaults.
+    """
+    intra_op = intra_op or int(os.getenv("TORCH_NUM_THREADS", "0"))
+    inter_op = inter_op or int(os.getenv("TORCH_NUM_INTEROP_THREADS", "0"))
+    if intra_op > 0:
+        torch.set_num_threads(intra_op)
+    if inter_op > 0:
+        try:
+            torch.set_num_interop_threads(inter_op)
+        except RuntimeError as e:
+            # Only allowed before the first inter-op parallel work in the process.
+            logging.warning(f"Could not set inter-op threads to {inter_op}: {e}")
+    logging.info(f"torch threads: intra-op {torch.get_num_threads()}, inter-op {torch.get_num_interop_threads()}")
+
+
+class BFloat16Model(torch.nn.Module):
+    """Runs a model in bfloat16 while keeping float32 inputs and outputs for the bundle transforms."""
+
+    def __init__(self, model: torch.nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.model(x.to(torch.bfloat16)).float()
+
+
+def warmup_shape(bundle_path: str) -> Tuple[int, ...]:
+    """
+    Input shape of one sliding-window batch of the bundle, read from its inferer config and
+    the `SW_*` deployment overrides. `MODEL_WARMUP_SHAPE` (e.g. "4,1,96,96,96") overrides it.
+    """
+    if os.getenv("MODEL_WARMUP_SHAPE"):
+        return tuple(int(v) for v in os.environ["MODEL_WARMUP_SHAPE"].split(","))
+    roi_size, batch_size, channels = [96, 96, 96], 1, 1
+    try:
+        parser = get_bundle_config(bundle_path, ["inference"])
+        inferer = parser.get("inferer") or {}
+        if isinstance(inferer.get("roi_size"), list) and all(isinstance(v, int) for v in inferer["roi_size"]):
+            roi_size = inferer["roi_size"]
+        if isinstance(inferer.get("sw_batch_size"), int):
+            batch_size = inferer["sw_batch_size"]
+        image_format = parser.get("_meta_", {}).get("network_data_format", {}).get("inputs", {}).get("image", {})
+        channels = int(image_format.get("num_channels", channels))
+    except Exception as e:
+        logging.warning(f"Using the default warm-up shape, the bundle config of {bundle_path} is not readable: {e}")
+    sliding_window = SlidingWindowConfig.from_env()
+    roi_size = sliding_window.roi_size or roi_size
+    batch_size = sliding_window.sw_batch_size or batch_size
+    return (batch_size, channels, *roi_size)
+
+
+def optimize_model(
+    model: torch.nn.Module,
+    variant: str = "fp32",
+    freeze: bool = True,
+    optimize: bool = True,
+) -> torch.nn.Module:
+    """
+    Turn a loaded TorchScript model into its inference form.
+
+    Args:
+        model (torch.nn.Module): TorchScript model in evaluation mode.
+        variant (str): "fp32", or "bf16" to compute in bfloat16 (for CPUs with AVX-512 BF16/AMX).
+        freeze (bool): Inline parameters and attributes as constants with `torch.jit.freeze`.
+        optimize (bool): Apply `torch.jit.optimize_for_inference` (conv/batch-norm folding,
+                         MKLDNN layouts on CPU) to the frozen model.
+
+    Returns:
+        torch.nn.Module: The model in evaluation mode.
+    """
+    if variant not in VARIANTS:
+        raise ValueError(f"Unsupported model variant {variant}, expected one of {VARIANTS}")
+    if variant == "bf16":
+        model = torch.jit.script(BFloat16Model(model.to(torch.bfloat16))).eval()
+    if freeze or optimize:
+        model = torch.jit.freeze(model)
+    if optimize:
+        model = torch.jit.optimize_for_inference(model)
+    return model
+
+
+def prepare_model(path: str, device: torch.device, variant: str = "fp32", freeze: bool = True, optimize: bool = True):
+    """Load the TorchScript model at `path` onto `device` and apply `optimize_model`."""
+    model = torch.jit.load(path, map_location=device).eval()
+    return optimize_model(model, variant, freeze, optimize)
+
+
+def warm_up(model: torch.nn.Module, shape: Tuple[int, ...], device: torch.device, iterations: int = 2) -> float:
+    """
+    Run synthetic inputs through the model so JIT profiling, kernel selection and allocator
+    growth happen before the first request. Returns the seconds spent.
+    """
+    start_time = time.time()
+    with torch.no_grad():
+        x = torch.rand(shape, device=device)
+        for _ in range(iterations):
+            model(x)
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return time.time() - start_time
@@ -0,0 +1,242 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional
+
+import torch
+from monai.deploy.operators.monai_bundle_inference_operator import MonaiBundleInferenceOperator
+
+from model_prep import optimize_model, warm_up, warmup_shape
+from sliding_window import SlidingWindowConfig
+
+# Operator attributes set by MonaiBundleInferenceOperator._init_config from a bundle's configs.
+BUNDLE_CONFIG_ATTRS = (
+    "_parser",
+    "_device",
+    "_inferer",
+    "_inputs",
+    "_outputs",
+    "_preproc",
+    "_postproc",
+    "_meta_key_postfix",
+)
+
+
+def default_max_bytes() -> int:
+    """Half of the GPU memory, or a quarter of the host memory on CPU-only instances."""
+    if torch.cuda.is_available():
+        return torch.cuda.get_device_properties(0).total_memory // 2
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 4
+
+
+class LoadedModel:
+    """A prepared model with its measured memory footprint and the bundle config parsed for it."""
+
+    def __init__(self, path: str, mtime: float, network: torch.nn.Module, nbytes: int, load_time: float):
+        self.path = path
+        self.mtime = mtime
+        self.network = network
+        self.nbytes = nbytes
+        self.load_time = load_time
+        # Filled by PreparedBundleInferenceOperator on first use, see BUNDLE_CONFIG_ATTRS.
+        self.bundle_config: Optional[Dict[str, object]] = None
+
+
+class ModelRegistry:
+    """
+    In-process registry of prepared TorchScript models, for multi-model endpoints.
+
+    Models are loaded, optimized and warmed up on a background thread. Concurrent requests for
+    a model that is being loaded wait on the same load. Loaded models are evicted in LRU order
+    when their summed footprint exceeds `max_bytes`; the footprint is the CUDA memory a load
+    allocated, or the size of the model's parameters and buffers on CPU.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = int(os.getenv("MODEL_CACHE_MAX_BYTES", "0")),
+        max_models: int = int(os.getenv("MODEL_CACHE_MAX_MODELS", "0")),
+        load_workers: int = int(os.getenv("MODEL_LOAD_WORKERS", "2")),
+        variant: str = os.getenv("MODEL_VARIANT", "fp32"),
+        freeze: bool = os.getenv("MODEL_FREEZE", "1") == "1",
+        optimize: bool = os.getenv("MODEL_OPTIMIZE", "1") == "1",
+        warmup_iterations: int = int(os.getenv("MODEL_WARMUP_ITERATIONS", "2")),
+    ):
+        """
+        Args:
+            max_bytes (int): Memory budget of the loaded models, 0 for `default_max_bytes()`.
+            max_models (int): Maximum number of loaded models, 0 for no limit.
+            load_workers (int): Threads loading models in the background.
+            variant, freeze, optimize: Passed to `model_prep.optimize_model`.
+            warmup_iterations (int): Synthetic inference passes after each load.
+        """
+        self.max_bytes = max_bytes or default_max_bytes()
+        self.max_models = max_models
+        self.variant = variant
+        self.freeze = freeze
+        self.optimize = optimize
+        self.warmup_iterations = warmup_iterations
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.load_failures = 0
+        self.load_time = 0.0
+        self.evictions = 0
+        self._models: "OrderedDict[str, LoadedModel]" = OrderedDict()
+        self._loading: Dict[str, Future] = {}
+        # Reentrant: a load that finishes before its done-callback is attached runs the callback inline.
+        self._lock = threading.RLock()
+        self._executor = ThreadPoolExecutor(max_workers=load_workers, thread_name_prefix="model-load")
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(model.nbytes for model in self._models.values())
+
+    def _load(self, path: str, mtime: float) -> LoadedModel:
+        start_time = time.time()
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+            allocated = torch.cuda.memory_allocated(self.device)
+        model = torch.jit.load(path, map_location=self.device).eval()
+        nbytes = sum(t.numel() * t.element_size() for t in [*model.parameters(), *model.buffers()])
+        if self.variant == "bf16":
+            nbytes //= 2
+        network = optimize_model(model, self.variant, self.freeze, self.optimize)
+        del model
+        if self.warmup_iterations > 0:
+            warm_up(network, warmup_shape(path), self.device, self.warmup_iterations)
+        if self.device.type == "cuda":
+            nbytes = max(nbytes, torch.cuda.memory_allocated(self.device) - allocated)
+        loaded = LoadedModel(path, mtime, network, nbytes, time.time() - start_time)
+        logging.info(
+            f"Loaded {path} ({self.variant}, freeze={self.freeze}, optimize={self.optimize}) on {self.device}: "
+            f"{nbytes / 2**20:.1f} MiB in {loaded.load_time:.2f}s"
+        )
+        return loaded
+
+    def _on_loaded(self, path: str, future: Future) -> None:
+        with self._lock:
+            self._loading.pop(path, None)
+            if future.exception() is not None:
+                self.load_failures += 1
+                return
+            loaded = future.result()
+            self.loads += 1
+            self.load_time += loaded.load_time
+            self._models[path] = loaded
+            self._models.move_to_end(path)
+            self._evict(keep=path)
+
+    def _evict(self, keep: str) -> None:
+        evicted = False
+        while len(self._models) > 1 and (
+            self.total_bytes > self.max_bytes or (self.max_models and len(self._models) > self.max_models)
+        ):
+            path = next(p for p in self._models if p != keep)
+            model = self._models.pop(path)
+            self.evictions += 1
+            evicted = True
+            logging.info(f"Evicted {path} ({model.nbytes / 2**20:.1f} MiB) from the model registry")
+        if evicted and self.device.type == "cuda":
+            torch.cuda.empty_cache()
+
+    def load_async(self, path: str) -> Future:
+        """Start loading `path` in the background unless it is loaded or loading already."""
+        path = os.path.abspath(path)
+        mtime = os.path.getmtime(path)
+        with self._lock:
+            loaded = self._models.get(path)
+            if loaded is not None and loaded.mtime == mtime:
+                future = Future()
+                future.set_result(loaded)
+                return future
+            future = self._loading.get(path)
+            if future is None:
+                future = self._executor.submit(self._load, path, mtime)
+                self._loading[path] = future
+                future.add_done_callback(lambda f: self._on_loaded(path, f))
+            return future
+
+    def get(self, path: str) -> LoadedModel:
+        """The loaded model for `path`, waiting for its load on a miss."""
+        path = os.path.abspath(path)
+        mtime = os.path.getmtime(path)
+        with self._lock:
+            loaded = self._models.get(path)
+            if loaded is not None and loaded.mtime == mtime:
+                self._models.move_to_end(path)
+                self.hits += 1
+                return loaded
+            self.misses += 1
+        return self.load_async(path).result()
+
+    def prepare_all(self, model_dir: str, wait: bool = True) -> None:
+        """
+        Load every TorchScript model in `model_dir`, e.g. at worker initialization so the first
+        request does not pay for it. With `wait=False` the loads continue in the background.
+        """
+        futures = [
+            self.load_async(os.path.join(model_dir, name)) for name in sorted(os.listdir(model_dir)) if name.endswith(".ts")
+        ]
+        if wait:
+            for future in futures:
+                future.result()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "models": len(self._models),
+                "loading": len(self._loading),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "loads": self.loads,
+                "load_failures": self.load_failures,
+                "load_time": round(self.load_time, 3),
+                "evictions": self.evictions,
+            }
+
+
+class PreparedBundleInferenceOperator(MonaiBundleInferenceOperator):
+    """
+    MONAI Bundle inference operator that predicts with the registry's model for the bundle of
+    the current run, and switches to that bundle's cached config when the target model changes.
+    """
+
+    def __init__(self, registry: ModelRegistry, *args, sliding_window: Optional[SlidingWindowConfig] = None, **kwargs):
+        """
+        Args:
+            registry (ModelRegistry): Registry the prepared models are taken from.
+            sliding_window (SlidingWindowConfig): Overrides of the bundles' sliding-window inferer.
+        """
+        self.registry = registry
+        self.sliding_window = sliding_window or SlidingWindowConfig()
+        self._loaded: Optional[LoadedModel] = None
+        super().__init__(*args, **kwargs)
+
+    def compute(self, op_input, op_output, context):
+        model = context.models.get(self._model_name) if context.models else None
+        if model is not None:
+            loaded = self.registry.get(model.path)
+            with self._lock:
+                self._bundle_path = Path(loaded.path)
+                if loaded.bundle_config is None:
+                    self._init_config(self._bundle_config_names.config_names)
+                    self._inferer = self.sliding_window.apply(self._inferer)
+                    loaded.bundle_config = {attr: getattr(self, attr) for attr in BUNDLE_CONFIG_ATTRS}
+                else:
+                    for attr, value in loaded.bundle_config.items():
+                        setattr(self, attr, value)
+                self._init_completed = True
+                self._loaded = loaded
+        super().compute(op_input, op_output, context)
+
+    def predict(self, data, *args, **kwargs):
+        network = self._loaded.network if self._loaded is not None else self._model_network
+        return self._inferer(inputs=data, network=network, *args, **kwargs)
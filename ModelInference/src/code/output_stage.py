@@ -0,0 +1,148 @@
+import io
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Union
+
+from boto3.s3.transfer import TransferConfig
+from pydicom import dcmread
+from monai.deploy.operators.dicom_seg_writer_operator import DICOMSegmentationWriterOperator
+
+MB = 1024 * 1024
+
+
+class _OutputBuffer(io.BytesIO):
+    """In-memory file that also answers the `parent` lookup writers make on output paths."""
+
+    def __init__(self, name: str, parent: Path):
+        super().__init__()
+        self.name = name
+        self.parent = parent
+
+
+class OutputBuffers:
+    """Thread-safe collection of named in-memory output artifacts produced during one app run."""
+
+    def __init__(self):
+        self._buffers: Dict[str, io.BytesIO] = {}
+        self._lock = threading.Lock()
+
+    def open(self, name: str, parent: Path = Path(".")) -> io.BytesIO:
+        buffer = _OutputBuffer(name, parent)
+        with self._lock:
+            self._buffers[name] = buffer
+        return buffer
+
+    def drain(self) -> Dict[str, io.BytesIO]:
+        """Return and forget every buffer written so far, rewound for reading."""
+        with self._lock:
+            buffers, self._buffers = self._buffers, {}
+        for buffer in buffers.values():
+            buffer.seek(0)
+        return buffers
+
+
+class _BufferDirectory:
+    """Stands in for the writer's `output_dir`: the file it joins onto it is an `OutputBuffers` entry."""
+
+    def __init__(self, output_buffers: OutputBuffers, path: Path):
+        self.output_buffers = output_buffers
+        self.path = path
+        self.buffer = None
+
+    def is_dir(self) -> bool:
+        return True
+
+    def mkdir(self, *args, **kwargs):
+        pass
+
+    def __truediv__(self, name: str) -> io.BytesIO:
+        self.buffer = self.output_buffers.open(name, self.path)
+        return self.buffer
+
+
+class InMemoryDICOMSegmentationWriterOperator(DICOMSegmentationWriterOperator):
+    """
+    DICOM SEG writer that serializes the SEG instance into an `OutputBuffers` entry instead of
+    a file in the output folder, so it can be uploaded without touching the disk.
+    """
+
+    def __init__(self, output_buffers: OutputBuffers, *args, **kwargs):
+        self.output_buffers = output_buffers
+        self._directory = None
+        super().__init__(*args, **kwargs)
+
+    def create_dicom_seg(self, image, dicom_series, output_dir: Path):
+        # The base class only checks and creates `output_dir`, joins the file name onto it and
+        # hands the result to pydicom's `save_as`, which accepts a file-like object as well as a path.
+        self._directory = _BufferDirectory(self.output_buffers, Path(output_dir))
+        super().create_dicom_seg(image, dicom_series, self._directory)
+
+    def _read_from_dcm(self, file_path: str):
+        # The read-back check gets `str(output_path)`; read the buffer just written instead.
+        return dcmread(io.BytesIO(self._directory.buffer.getvalue()))
+
+
+class OutputUploader:
+    """
+    Uploads the artifacts of one request to S3 in parallel under a request-unique prefix,
+    using multipart uploads for large objects.
+    """
+
+    def __init__(
+        self,
+        s3_client,
+        bucket: str,
+        prefix: str = "monaideploy",
+        max_workers: int = int(os.getenv("OUTPUT_UPLOAD_WORKERS", "8")),
+        chunk_size: int = int(os.getenv("OUTPUT_UPLOAD_CHUNK_SIZE", str(8 * MB))),
+    ):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.max_workers = max_workers
+        self.transfer_config = TransferConfig(
+            multipart_threshold=chunk_size, multipart_chunksize=chunk_size, max_concurrency=max_workers
+        )
+
+    def _upload(self, key: str, source: Union[str, io.BytesIO]) -> dict:
+        start_time = time.time()
+        if isinstance(source, str):
+            size = os.path.getsize(source)
+            self.s3_client.upload_file(source, self.bucket, key, Config=self.transfer_config)
+        else:
+            size = source.getbuffer().nbytes
+            self.s3_client.upload_fileobj(source, self.bucket, key, Config=self.transfer_config)
+        upload_time = time.time() - start_time
+        logging.info(f"Uploaded s3://{self.bucket}/{key}: {size} bytes in {upload_time:.2f}s")
+        return {"uri": f"s3://{self.bucket}/{key}", "size": size, "upload_time": round(upload_time, 3)}
+
+    def upload(self, request_id: str, output_folder: str = None, buffers: Dict[str, io.BytesIO] = None) -> List[dict]:
+        """
+        Upload every file under `output_folder` and every in-memory buffer.
+
+        Args:
+            request_id (str): Unique ID of the request, used in the object keys.
+            output_folder (str): Folder the app wrote its file outputs to.
+            buffers (Dict[str, io.BytesIO]): In-memory outputs keyed by file name.
+
+        Returns:
+            List[dict]: One entry per artifact with its S3 URI, size in bytes and upload time in seconds.
+        """
+        sources = {}
+        if output_folder and os.path.isdir(output_folder):
+            for root, dirs, files in os.walk(output_folder):
+                for file in files:
+                    path = os.path.join(root, file)
+                    sources[os.path.relpath(path, output_folder)] = path
+        sources.update(buffers or {})
+        if not sources:
+            return []
+
+        keys = {name: f"{self.prefix}/{request_id}/{name}" for name in sources}
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(sources))) as executor:
+            futures = [executor.submit(self._upload, keys[name], source) for name, source in sources.items()]
+            return [future.result() for future in futures]
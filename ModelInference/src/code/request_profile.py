@@ -0,0 +1,196 @@
+import cProfile
+import io
+import json
+import logging
+import marshal
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+PROFILE_MODES = ("off", "on", "cprofile")
+
+
+def _custom_attributes(request_header: dict) -> Dict[str, str]:
+    """`key=value` pairs of the X-Amzn-SageMaker-Custom-Attributes header, the only custom header SageMaker forwards."""
+    for name, value in (request_header or {}).items():
+        if name.lower() == "x-amzn-sagemaker-custom-attributes" and value:
+            pairs = (item.split("=", 1) for item in value.replace(",", ";").split(";") if "=" in item)
+            return {k.strip().lower(): v.strip() for k, v in pairs}
+    return {}
+
+
+def profile_mode(request_header: dict) -> str:
+    """
+    Profiling mode of a request: `profile=on|cprofile` in X-Amzn-SageMaker-Custom-Attributes,
+    else `PROFILE_REQUESTS` ("off" by default). "1" means "on".
+    """
+    mode = _custom_attributes(request_header).get("profile") or os.getenv("PROFILE_REQUESTS", "off")
+    mode = "on" if mode.lower() in ("1", "true") else mode.lower()
+    if mode not in PROFILE_MODES:
+        logging.warning(f"Unsupported profiling mode {mode}, expected one of {PROFILE_MODES}")
+        return "off"
+    return mode
+
+
+def _read_fields(path: str, separator: str = ":") -> Dict[str, str]:
+    try:
+        with open(path) as f:
+            return {k.strip(): v.strip() for k, _, v in (line.partition(separator) for line in f)}
+    except OSError:
+        return {}
+
+
+def _io_bytes() -> Dict[str, int]:
+    """Bytes the process read and wrote through file, pipe and socket read/write calls, and at the block layer."""
+    fields = _read_fields("/proc/self/io")
+    names = {"rchar": "read_bytes", "wchar": "written_bytes", "read_bytes": "disk_read_bytes", "write_bytes": "disk_written_bytes"}
+    return {name: int(fields[field]) for field, name in names.items() if field in fields}
+
+
+def _network_bytes() -> Dict[str, int]:
+    """Received and sent bytes of every interface but loopback, for the whole network namespace (the container)."""
+    rx = tx = 0
+    try:
+        with open("/proc/net/dev") as f:
+            for line in f.readlines()[2:]:
+                name, _, counters = line.partition(":")
+                if name.strip() != "lo":
+                    values = counters.split()
+                    rx, tx = rx + int(values[0]), tx + int(values[8])
+    except (OSError, ValueError, IndexError):
+        return {}
+    return {"net_received_bytes": rx, "net_sent_bytes": tx}
+
+
+def _reset_peak_rss() -> bool:
+    """Reset the process' peak RSS (VmHWM); supported on Linux 4.0 and later."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss() -> int:
+    value = _read_fields("/proc/self/status").get("VmHWM")
+    if value:
+        return int(value.split()[0]) * 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _cuda():
+    # Only if the app already initialized CUDA; profiling never imports torch or creates a context.
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized():
+        return torch.cuda
+    return None
+
+
+class RequestProfile:
+    """
+    Per-request profile of the app's operators: wall and CPU time, peak RSS and CUDA memory,
+    and bytes moved by each operator, plus an optional cProfile of the whole request.
+
+    CPU time is the process' (all threads, e.g. torch intra-op threads). Peak RSS is reset
+    before every section where the kernel allows it, else it is the process' peak so far.
+    Network bytes are counted for the whole container.
+    """
+
+    def __init__(self, request_id: str, mode: str = "on"):
+        self.request_id = request_id
+        self.mode = mode
+        self.sections: List[dict] = []
+        self.profiler = cProfile.Profile() if mode == "cprofile" else None
+        self.start_time = time.perf_counter()
+        self.wall_seconds = None
+        self.rss_resettable = _reset_peak_rss()
+        if self.profiler is not None:
+            self.profiler.enable()
+
+    @classmethod
+    def for_request(cls, request_id: str, request_header: dict) -> Optional["RequestProfile"]:
+        """A started profile if the request or the environment asks for one, else None."""
+        mode = profile_mode(request_header)
+        return None if mode == "off" else cls(request_id, mode)
+
+    @contextmanager
+    def section(self, name: str):
+        cuda = _cuda()
+        if cuda is not None:
+            cuda.reset_peak_memory_stats()
+        self.rss_resettable = _reset_peak_rss() and self.rss_resettable
+        io_start, net_start = _io_bytes(), _network_bytes()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = repr(e)
+            raise
+        finally:
+            record = {
+                "name": name,
+                "wall_seconds": round(time.perf_counter() - wall_start, 4),
+                "cpu_seconds": round(time.process_time() - cpu_start, 4),
+                "peak_rss_bytes": _peak_rss(),
+            }
+            if cuda is not None:
+                record["peak_cuda_bytes"] = cuda.max_memory_allocated()
+            io_end, net_end = _io_bytes(), _network_bytes()
+            record.update({k: io_end[k] - io_start[k] for k in io_end if k in io_start})
+            record.update({k: net_end[k] - net_start[k] for k in net_end if k in net_start})
+            if error:
+                record["error"] = error
+            self.sections.append(record)
+
+    @contextmanager
+    def operators(self, app):
+        """Record a section per operator `compute` of `app` while the block runs, then restore the operators."""
+        wrapped = []
+        for op in app.graph.get_operators():
+            compute = op.compute
+
+            def profiled_compute(*args, _compute=compute, _name=type(op).__name__, **kwargs):
+                with self.section(_name):
+                    return _compute(*args, **kwargs)
+
+            # An instance attribute shadows the class method until it is deleted again.
+            op.compute = profiled_compute
+            wrapped.append(op)
+        try:
+            yield
+        finally:
+            for op in wrapped:
+                del op.compute
+
+    def finish(self) -> dict:
+        """Stop the profile and log its summary; later calls return the same summary."""
+        if self.wall_seconds is not None:
+            return self.summary()
+        if self.profiler is not None:
+            self.profiler.disable()
+        self.wall_seconds = round(time.perf_counter() - self.start_time, 4)
+        summary = self.summary()
+        logging.info(f"#### request profile: {json.dumps(summary)}")
+        return summary
+
+    def summary(self) -> dict:
+        return {
+            "requestId": self.request_id,
+            "mode": self.mode,
+            "wall_seconds": self.wall_seconds,
+            "peak_rss_per_section": self.rss_resettable,
+            "sections": self.sections,
+        }
+
+    def buffers(self) -> Dict[str, io.BytesIO]:
+        """`profile.json`, and `profile.pstats` in cProfile mode (load it with `pstats.Stats`), to upload with the outputs."""
+        buffers = {"profile.json": io.BytesIO(json.dumps(self.summary(), indent=1).encode())}
+        if self.profiler is not None:
+            self.profiler.create_stats()
+            buffers["profile.pstats"] = io.BytesIO(marshal.dumps(self.profiler.stats))
+        return buffers
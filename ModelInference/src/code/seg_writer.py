@@ -0,0 +1,274 @@
+import datetime
+import io
+import logging
+import time
+from pathlib import Path
+from random import randint
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence as DicomSequence
+from pydicom.uid import PYDICOM_IMPLEMENTATION_UID, ExplicitVRLittleEndian, generate_uid
+
+from monai.deploy.operators.dicom_seg_writer_operator import DICOMSegmentationWriterOperator
+from monai.deploy.utils.version import get_sdk_semver
+
+SEGMENTATION_STORAGE = "1.2.840.10008.5.1.4.1.1.66.4"
+# Tags copied from the source series: Patient, General Study, Frame of Reference and Clinical Trial modules.
+SOURCE_ATTRIBUTES = (
+    "PatientName",
+    "PatientID",
+    "PatientBirthDate",
+    "PatientSex",
+    "PatientAge",
+    "StudyInstanceUID",
+    "StudyDate",
+    "StudyTime",
+    "StudyID",
+    "StudyDescription",
+    "ReferringPhysicianName",
+    "AccessionNumber",
+    "FrameOfReferenceUID",
+    "PositionReferenceIndicator",
+    "ClinicalTrialSponsorName",
+    "ClinicalTrialProtocolID",
+    "ClinicalTrialSiteID",
+    "ClinicalTrialSubjectID",
+)
+
+
+def _dataset(**attributes) -> Dataset:
+    ds = Dataset()
+    for keyword, value in attributes.items():
+        setattr(ds, keyword, value)
+    return ds
+
+
+def occupied_frames(mask: np.ndarray, segment_number: int) -> np.ndarray:
+    """Indices of the slices of a (frames, rows, columns) label volume that contain the segment."""
+    return np.flatnonzero((mask == segment_number).reshape(mask.shape[0], -1).any(axis=1))
+
+
+def pack_frames(frames: np.ndarray) -> bytes:
+    """
+    Bit-pack binary frames for a BINARY SEG: one bit per pixel, least significant bit first,
+    frames concatenated without padding, the whole value padded to an even length.
+    """
+    packed = np.packbits(frames.reshape(-1).astype(bool), bitorder="little").tobytes()
+    return packed + b"\0" if len(packed) % 2 else packed
+
+
+def encode_seg(
+    mask: np.ndarray,
+    source_datasets: Sequence[Dataset],
+    segment_descriptions: Sequence[Dataset],
+    custom_tags: Optional[Dict[str, str]] = None,
+    series_number: Optional[int] = None,
+    software_versions: str = "0.1",
+) -> Dataset:
+    """
+    Build a BINARY DICOM Segmentation of `mask` that holds only the frames containing segment
+    voxels, with every per-frame attribute computed with array operations over the volume.
+    An empty mask is written as a single empty frame of the first segment.
+
+    Args:
+        mask (np.ndarray): (frames, rows, columns) label volume, frame i on `source_datasets[i]`.
+        source_datasets (Sequence[Dataset]): Single-frame instances of the source series.
+        segment_descriptions (Sequence[Dataset]): Segment Sequence items, segment number n for label n.
+        custom_tags (Dict[str, str]): Attributes set by keyword on the SEG dataset.
+
+    Returns:
+        Dataset: The SEG instance with its file meta information.
+    """
+    if mask.ndim != 3 or mask.shape[0] != len(source_datasets):
+        raise ValueError(f"Mask of shape {mask.shape} does not match the {len(source_datasets)} source instances")
+    first = source_datasets[0]
+    rows, columns = int(first.Rows), int(first.Columns)
+    if mask.shape[1:] != (rows, columns):
+        raise ValueError(f"Mask frames of {mask.shape[1:]} do not match the source frames of {(rows, columns)}")
+
+    positions = np.array([[float(v) for v in ds.ImagePositionPatient] for ds in source_datasets])
+    orientation = [float(v) for v in first.ImageOrientationPatient]
+    normal = np.cross(orientation[:3], orientation[3:])
+    # Dimension index of each source slice: its rank along the slice normal.
+    position_index = np.argsort(np.argsort(positions @ normal)) + 1
+
+    ds = Dataset()
+    sop_instance_uid = generate_uid()
+    for keyword in SOURCE_ATTRIBUTES:
+        if keyword in first:
+            setattr(ds, keyword, first.data_element(keyword).value)
+    now = datetime.datetime.now()
+    ds.SOPClassUID = SEGMENTATION_STORAGE
+    ds.SOPInstanceUID = sop_instance_uid
+    ds.Modality = "SEG"
+    ds.SeriesInstanceUID = generate_uid()
+    ds.SeriesNumber = series_number if series_number is not None else randint(1000, 9999)
+    ds.SeriesDate = ds.ContentDate = now.strftime("%Y%m%d")
+    ds.SeriesTime = ds.ContentTime = now.strftime("%H%M%S")
+    ds.TimezoneOffsetFromUTC = now.astimezone().isoformat()[-6:].replace(":", "")
+    ds.InstanceNumber = 1
+    ds.Manufacturer = "The MONAI Consortium"
+    ds.ManufacturerModelName = "MONAI Deploy App SDK"
+    ds.SoftwareVersions = software_versions
+    ds.DeviceSerialNumber = "0000"
+    ds.ImageType = ["DERIVED", "PRIMARY"]
+    ds.ContentLabel = "SEGMENTATION"
+    ds.ContentDescription = ""
+    ds.ContentCreatorName = ""
+    ds.SegmentationType = "BINARY"
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.Rows, ds.Columns = rows, columns
+    ds.BitsAllocated = ds.BitsStored = 1
+    ds.HighBit = 0
+    ds.PixelRepresentation = 0
+    ds.LossyImageCompression = "00"
+    ds.SegmentSequence = DicomSequence(list(segment_descriptions))
+
+    dimension_organization_uid = generate_uid()
+    ds.DimensionOrganizationSequence = DicomSequence([_dataset(DimensionOrganizationUID=dimension_organization_uid)])
+    ds.DimensionOrganizationType = "3D"
+    ds.DimensionIndexSequence = DicomSequence(
+        [
+            _dataset(
+                DimensionOrganizationUID=dimension_organization_uid,
+                DimensionIndexPointer=0x0062000B,  # ReferencedSegmentNumber
+                FunctionalGroupPointer=0x0062000A,  # SegmentIdentificationSequence
+                DimensionDescriptionLabel="ReferencedSegmentNumber",
+            ),
+            _dataset(
+                DimensionOrganizationUID=dimension_organization_uid,
+                DimensionIndexPointer=0x00200032,  # ImagePositionPatient
+                FunctionalGroupPointer=0x00209113,  # PlanePositionSequence
+                DimensionDescriptionLabel="ImagePositionPatient",
+            ),
+        ]
+    )
+
+    pixel_measures = _dataset(PixelSpacing=first.PixelSpacing, SliceThickness=first.get("SliceThickness", ""))
+    if "SpacingBetweenSlices" in first:
+        pixel_measures.SpacingBetweenSlices = first.SpacingBetweenSlices
+    ds.SharedFunctionalGroupsSequence = DicomSequence(
+        [
+            _dataset(
+                PixelMeasuresSequence=DicomSequence([pixel_measures]),
+                PlaneOrientationSequence=DicomSequence([_dataset(ImageOrientationPatient=first.ImageOrientationPatient)]),
+            )
+        ]
+    )
+
+    purpose = _dataset(
+        CodeValue="121322", CodingSchemeDesignator="DCM", CodeMeaning="Source image for image processing operation"
+    )
+    derivation_code = _dataset(CodeValue="113076", CodingSchemeDesignator="DCM", CodeMeaning="Segmentation")
+    occupied = [(int(item.SegmentNumber), occupied_frames(mask, int(item.SegmentNumber))) for item in ds.SegmentSequence]
+    if not any(len(indices) for _, indices in occupied):
+        # A SEG needs at least one frame: an empty mask gets one empty frame of the first segment.
+        logging.warning("Mask has no segment voxels, writing a DICOM SEG with one empty frame")
+        occupied = [(occupied[0][0], np.array([0]))]
+    per_frame, frames, referenced = [], [], set()
+    for segment_number, indices in occupied:
+        if len(indices):
+            frames.append(mask[indices] == segment_number)
+        for i in indices:
+            source = source_datasets[i]
+            referenced.add(i)
+            per_frame.append(
+                _dataset(
+                    DerivationImageSequence=DicomSequence(
+                        [
+                            _dataset(
+                                SourceImageSequence=DicomSequence(
+                                    [
+                                        _dataset(
+                                            ReferencedSOPClassUID=source.SOPClassUID,
+                                            ReferencedSOPInstanceUID=source.SOPInstanceUID,
+                                            PurposeOfReferenceCodeSequence=DicomSequence([purpose]),
+                                        )
+                                    ]
+                                ),
+                                DerivationCodeSequence=DicomSequence([derivation_code]),
+                            )
+                        ]
+                    ),
+                    FrameContentSequence=DicomSequence(
+                        [_dataset(DimensionIndexValues=[segment_number, int(position_index[i])])]
+                    ),
+                    PlanePositionSequence=DicomSequence([_dataset(ImagePositionPatient=source.ImagePositionPatient)]),
+                    SegmentIdentificationSequence=DicomSequence([_dataset(ReferencedSegmentNumber=segment_number)]),
+                )
+            )
+    ds.PerFrameFunctionalGroupsSequence = DicomSequence(per_frame)
+    ds.NumberOfFrames = len(per_frame)
+    ds.PixelData = pack_frames(np.concatenate(frames))
+
+    ds.ReferencedSeriesSequence = DicomSequence(
+        [
+            _dataset(
+                SeriesInstanceUID=first.SeriesInstanceUID,
+                ReferencedInstanceSequence=DicomSequence(
+                    [
+                        _dataset(
+                            ReferencedSOPClassUID=source_datasets[i].SOPClassUID,
+                            ReferencedSOPInstanceUID=source_datasets[i].SOPInstanceUID,
+                        )
+                        for i in sorted(referenced)
+                    ]
+                ),
+            )
+        ]
+    )
+
+    for keyword, value in (custom_tags or {}).items():
+        if isinstance(keyword, str) and isinstance(value, str):
+            try:
+                setattr(ds, keyword, value)
+            except Exception as ex:
+                logging.warning(f"Tag {keyword} was not written, due to {ex}")
+
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID = SEGMENTATION_STORAGE
+    ds.file_meta.MediaStorageSOPInstanceUID = sop_instance_uid
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.file_meta.ImplementationClassUID = PYDICOM_IMPLEMENTATION_UID
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    return ds
+
+
+class SparseDICOMSegmentationWriterOperator(DICOMSegmentationWriterOperator):
+    """
+    DICOM SEG writer for sparse masks. It encodes only the frames that contain segment voxels,
+    bit-packs them in one vectorized pass and serializes the SEG straight into an in-memory
+    buffer (an `OutputBuffers` entry when given), instead of building every frame with
+    highdicom and reading the written file back.
+    """
+
+    def __init__(self, *args, output_buffers=None, **kwargs):
+        self.output_buffers = output_buffers
+        super().__init__(*args, **kwargs)
+
+    def create_dicom_seg(self, image: np.ndarray, dicom_series, output_dir: Path):
+        start_time = time.time()
+        try:
+            version_str = get_sdk_semver()
+        except Exception:
+            version_str = "0.1"
+        source_datasets: List[Dataset] = [i.get_native_sop_instance() for i in dicom_series.get_sop_instances()]
+        seg = encode_seg(image, source_datasets, self._seg_descs, self._custom_tags, software_versions=version_str)
+        name = f"{seg.SOPInstanceUID}{DICOMSegmentationWriterOperator.DCM_EXTENSION}"
+        output_dir = Path(output_dir)
+        if self.output_buffers is not None:
+            buffer = self.output_buffers.open(name, output_dir)
+        else:
+            buffer = io.BytesIO()
+        seg.save_as(buffer, write_like_original=False)
+        if self.output_buffers is None:
+            output_dir.mkdir(parents=True, exist_ok=True)
+            (output_dir / name).write_bytes(buffer.getvalue())
+        logging.info(
+            f"DICOM SEG with {seg.NumberOfFrames} of {image.shape[0]} frames, {buffer.tell()} bytes, "
+            f"in {time.time() - start_time:.3f}s"
+        )
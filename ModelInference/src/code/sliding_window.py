@@ -0,0 +1,112 @@
+import inspect
+import logging
+import os
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import torch
+from monai.inferers import SlidingWindowInferer
+
+
+class PatchParallel(torch.nn.Module):
+    """
+    Splits each batch of sliding-window patches into `workers` chunks and runs them with
+    `torch.jit.fork`, so the chunks execute concurrently on the inter-op thread pool.
+    """
+
+    def __init__(self, model: torch.nn.Module, workers: int):
+        super().__init__()
+        self.model = model
+        self.workers = workers
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        futures: List[torch.jit.Future[torch.Tensor]] = []
+        for chunk in torch.chunk(x, self.workers, dim=0):
+            futures.append(torch.jit.fork(self.model, chunk))
+        return torch.cat([torch.jit.wait(future) for future in futures], dim=0)
+
+
+class PatchParallelInferer(SlidingWindowInferer):
+    """SlidingWindowInferer that runs the patches of each window batch on several inter-op threads."""
+
+    def __init__(self, *args, patch_workers: int = 1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.patch_workers = patch_workers
+        self._wrapped: Tuple[Optional[torch.nn.Module], Optional[torch.nn.Module]] = (None, None)
+
+    def __call__(self, inputs, network, *args, **kwargs):
+        if self.patch_workers > 1 and isinstance(network, torch.jit.ScriptModule):
+            if self._wrapped[0] is not network:
+                self._wrapped = (network, torch.jit.script(PatchParallel(network, self.patch_workers)))
+            network = self._wrapped[1]
+        return super().__call__(inputs, network, *args, **kwargs)
+
+
+def inferer_settings(inferer: SlidingWindowInferer) -> Dict:
+    """Constructor arguments of `inferer`, read back from its attributes, so a rebuilt inferer keeps all of them."""
+    parameters = inspect.signature(SlidingWindowInferer.__init__).parameters
+    settings = {name: getattr(inferer, name) for name in parameters if name != "self" and hasattr(inferer, name)}
+    if "cache_roi_weight_map" in parameters:
+        # Not kept as an attribute; the precomputed map is.
+        settings["cache_roi_weight_map"] = getattr(inferer, "roi_weight_map", None) is not None
+    return settings
+
+
+class SlidingWindowConfig(NamedTuple):
+    """
+    Deployment overrides of the bundle's sliding-window inferer. Unset values keep the
+    bundle's settings.
+    """
+
+    roi_size: Optional[Tuple[int, ...]] = None
+    overlap: Optional[float] = None
+    sw_batch_size: Optional[int] = None
+    mode: Optional[str] = None
+    patch_workers: int = 1
+
+    @classmethod
+    def from_dict(cls, config: Dict) -> "SlidingWindowConfig":
+        roi_size = config.get("roi_size")
+        if isinstance(roi_size, str):
+            roi_size = [int(v) for v in roi_size.split(",")]
+        return cls(
+            roi_size=tuple(roi_size) if roi_size else None,
+            overlap=float(config["overlap"]) if config.get("overlap") not in (None, "") else None,
+            sw_batch_size=int(config["sw_batch_size"]) if config.get("sw_batch_size") else None,
+            mode=config.get("mode") or None,
+            patch_workers=int(config.get("patch_workers") or 1),
+        )
+
+    @classmethod
+    def from_env(cls) -> "SlidingWindowConfig":
+        """Read `SW_ROI_SIZE` (e.g. "160,160,160"), `SW_OVERLAP`, `SW_BATCH_SIZE`, `SW_MODE` and `SW_PATCH_WORKERS`."""
+        return cls.from_dict(
+            {
+                "roi_size": os.getenv("SW_ROI_SIZE"),
+                "overlap": os.getenv("SW_OVERLAP"),
+                "sw_batch_size": os.getenv("SW_BATCH_SIZE"),
+                "mode": os.getenv("SW_MODE"),
+                "patch_workers": os.getenv("SW_PATCH_WORKERS"),
+            }
+        )
+
+    def is_default(self) -> bool:
+        return self == SlidingWindowConfig()
+
+    def apply(self, inferer):
+        """
+        Return `inferer` with these overrides, or unchanged if there are none. A bundle that does
+        not use a sliding-window inferer gets one built from the overrides when `roi_size` is set.
+        """
+        if self.is_default():
+            return inferer
+        if not isinstance(inferer, SlidingWindowInferer):
+            if self.roi_size is None:
+                logging.warning(f"Sliding-window settings ignored, the bundle uses {type(inferer).__name__}")
+                return inferer
+            base = dict(roi_size=self.roi_size)
+        else:
+            base = inferer_settings(inferer)
+        overrides = {k: v for k, v in self._asdict().items() if v is not None and k != "patch_workers"}
+        settings = {**base, **overrides}
+        logging.info(f"Sliding-window inference: {settings}, patch_workers={self.patch_workers}")
+        return PatchParallelInferer(patch_workers=self.patch_workers, **settings)
@@ -0,0 +1,509 @@
+"""
+End-to-end load test of the model handler against local stand-ins of its AWS dependencies.
+
+Each of `--workers` processes imports `model_handler` and calls `handle` for one request at
+a time, like a model server worker. A fake HealthImaging API serves synthetic CT image sets
+with the shapes given in `--mix` as JPEG 2000 frames. A fake S3 accepts the output uploads,
+counting their bytes without keeping them, and a fake STS answers the account lookup. The
+bundle in `--model-dir` runs for real, on the GPU if there is one.
+
+The clock starts once every worker has initialized. The report lists throughput, latency
+percentiles and errors, overall and per mix entry, and each worker's initialization time.
+It also lists memory high-water marks: every worker's peak RSS, the sampled peak of all
+workers and their frame fetching processes together, and the CUDA peak per worker.
+
+The fake HealthImaging API, the synthetic image sets and the report helpers are shared with
+the NIM proxy's harness, NIMonSageMaker/nimapi_load_test.py.
+
+Run it inside the inference image, which has the dependencies and a writable /home/model-server:
+
+    docker run --rm --gpus all -v $PWD/src:/src -v $PWD/model:/opt/ml/model \\
+        --entrypoint python <image> /src/load_test.py --workers 2
+
+usage: python load_test.py [--model-dir DIR] [--mix SLICESxSIZE[:WEIGHT],...] [--workers N]
+                           [--requests N] [--target-model NAME]
+"""
+import argparse
+import gzip
+import io
+import json
+import math
+import multiprocessing
+import os
+import random
+import re
+import resource
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SRC_DIR)
+
+import numpy as np
+
+from startup_benchmark import STS_RESPONSE, offline_env
+
+DATASTORE_ID = "10adte5700000000000000000000000a"
+# Distinct synthetic frames per frame size; the frames of an image set cycle through them.
+FRAME_VARIANTS = 8
+
+
+class MixEntry(NamedTuple):
+    slices: int
+    size: int
+    weight: float
+
+    @property
+    def name(self) -> str:
+        return f"{self.slices}x{self.size}"
+
+
+def parse_mix(text: str) -> List[MixEntry]:
+    """`300x512:3,120x512:1`: slices x rows/columns of the image sets and a relative weight."""
+    entries = []
+    for item in text.split(","):
+        match = re.fullmatch(r"(\d+)x(\d+)(?::([\d.]+))?", item.strip())
+        if not match:
+            raise argparse.ArgumentTypeError(f"Invalid mix entry {item!r}, expected SLICESxSIZE[:WEIGHT]")
+        entries.append(MixEntry(int(match.group(1)), int(match.group(2)), float(match.group(3) or 1)))
+    return entries
+
+
+def image_set_id(slices: int, size: int, n: int) -> str:
+    """32 character image set ID that carries the volume shape, so the fake needs no registry."""
+    return f"{slices:05d}x{size:05d}{n:021x}"
+
+
+def frame_id(size: int, index: int) -> str:
+    return f"{size:05d}{index % FRAME_VARIANTS:027x}"
+
+
+def phantom_slice(index: int, size: int) -> np.ndarray:
+    """int16 CT-like slice: air, a soft-tissue body, an organ that moves along the volume and some noise."""
+    y, x = np.ogrid[:size, :size]
+    image = np.full((size, size), -1000, dtype=np.int16)
+    image[((y - size * 0.5) / (size * 0.38)) ** 2 + ((x - size * 0.5) / (size * 0.45)) ** 2 <= 1] = 40
+    cy, cx = size * (0.4 + 0.02 * math.sin(index / 10)), size * 0.7
+    image[((y - cy) / (size * 0.1)) ** 2 + ((x - cx) / (size * 0.07)) ** 2 <= 1] = 120
+    noise = np.random.default_rng(index).integers(-20, 20, (size, size), dtype=np.int16)
+    return image + noise
+
+
+def image_set_metadata(slices: int, size: int, imageSetId: str) -> dict:
+    """Image set metadata in the HealthImaging layout, one single-frame CT instance per slice."""
+    study_uid, series_uid = f"2.25.{slices}{size}1", f"2.25.{slices}{size}2"
+    instances = {}
+    for i in range(slices):
+        sop_instance_uid = f"{series_uid}.{i + 1}"
+        instances[sop_instance_uid] = {
+            "DICOM": {
+                "SOPClassUID": "1.2.840.10008.5.1.4.1.1.2",
+                "SOPInstanceUID": sop_instance_uid,
+                "InstanceNumber": i + 1,
+                "ImagePositionPatient": [-size * 0.4, -size * 0.4, -i * 1.5],
+                "ImageOrientationPatient": [1, 0, 0, 0, 1, 0],
+                "PixelSpacing": [0.8, 0.8],
+                "SliceThickness": 1.5,
+                "Rows": size,
+                "Columns": size,
+                "SamplesPerPixel": 1,
+                "PhotometricInterpretation": "MONOCHROME2",
+                "BitsAllocated": 16,
+                "BitsStored": 16,
+                "HighBit": 15,
+                "PixelRepresentation": 1,
+                "RescaleIntercept": 0,
+                "RescaleSlope": 1,
+            },
+            "DICOMVRs": {},
+            "ImageFrames": [{"ID": frame_id(size, i), "PixelDataChecksumFromBaseToFullResolution": []}],
+        }
+    return {
+        "SchemaVersion": "1.1",
+        "DatastoreID": DATASTORE_ID,
+        "ImageSetID": imageSetId,
+        "Patient": {"DICOM": {"PatientName": "Synthetic^LoadTest", "PatientID": "LOAD-TEST", "PatientSex": "O"}},
+        "Study": {
+            "DICOM": {
+                "StudyInstanceUID": study_uid,
+                "StudyDate": "20240101",
+                "StudyTime": "120000",
+                "StudyID": "1",
+                "StudyDescription": "Synthetic CT",
+                "AccessionNumber": "",
+                "ReferringPhysicianName": "",
+            },
+            "Series": {
+                series_uid: {
+                    "DICOM": {"SeriesInstanceUID": series_uid, "SeriesNumber": 1, "Modality": "CT"},
+                    "Instances": instances,
+                }
+            },
+        },
+    }
+
+
+class FakeAWS:
+    """Synthetic HealthImaging image sets, the sizes of the uploaded S3 objects and per-operation counters."""
+
+    def __init__(self, frame_sizes: Iterable[int]):
+        self.frames: Dict[int, List[bytes]] = {}
+        for size in set(frame_sizes):
+            try:
+                from openjpeg import encode
+            except ImportError:
+                raise SystemExit("The fake HealthImaging API needs pylibjpeg-openjpeg 2 or later to encode frames")
+            self.frames[size] = [encode(phantom_slice(i, size)) for i in range(FRAME_VARIANTS)]
+        self.objects: Dict[str, int] = {}
+        self.uploads: Dict[str, Dict[int, int]] = {}
+        self.stats: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def count(self, operation: str, sent: int = 0, received: int = 0) -> None:
+        with self.lock:
+            self.stats[operation] = self.stats.get(operation, 0) + 1
+            self.stats["bytes_sent"] = self.stats.get("bytes_sent", 0) + sent
+            self.stats["bytes_received"] = self.stats.get("bytes_received", 0) + received
+
+
+def _dechunk(stream) -> bytes:
+    """Body of a chunked stream: HTTP `Transfer-Encoding: chunked` or S3 `aws-chunked` with signatures or trailers."""
+    data = bytearray()
+    while True:
+        size = int(stream.readline().split(b";")[0].strip() or b"0", 16)
+        if size == 0:
+            break
+        data += stream.read(size)
+        stream.readline()
+    while stream.readline().strip():
+        pass
+    return bytes(data)
+
+
+class FakeAWSHandler(BaseHTTPRequestHandler):
+    """
+    STS GetCallerIdentity; HealthImaging GetImageSet, GetImageSetMetadata and GetImageFrame;
+    S3 PutObject and multipart uploads.
+    """
+
+    # HTTP/1.1 keeps connections alive and answers `Expect: 100-continue` before large uploads.
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def aws(self) -> FakeAWS:
+        return self.server.aws
+
+    def _body(self) -> bytes:
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = _dechunk(self.rfile)
+        else:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if "aws-chunked" in self.headers.get("Content-Encoding", ""):
+            body = _dechunk(io.BytesIO(body))
+        return body
+
+    def do_POST(self):
+        body = self._body()
+        path, _, query = self.path.partition("?")
+        match = re.fullmatch(r"/datastore/([^/]+)/imageSet/([^/]+)/(\w+)", path)
+        if match:
+            return self._medical_imaging(*match.groups(), body)
+        if b"GetCallerIdentity" in body:
+            return self._reply(200, STS_RESPONSE.encode(), "text/xml")
+        bucket, _, key = path.lstrip("/").partition("/")
+        if query == "uploads" or query.startswith("uploads&") or query.endswith("&uploads"):
+            upload_id = uuid.uuid4().hex
+            with self.aws.lock:
+                self.aws.uploads[upload_id] = {}
+            self.aws.count("CreateMultipartUpload")
+            return self._reply(
+                200,
+                f"<InitiateMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{key}</Key>"
+                f"<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>".encode(),
+                "application/xml",
+            )
+        upload_id = re.search(r"uploadId=([^&]+)", query)
+        if upload_id:
+            with self.aws.lock:
+                parts = self.aws.uploads.pop(upload_id.group(1), {})
+                self.aws.objects[path] = sum(parts.values())
+            self.aws.count("CompleteMultipartUpload")
+            return self._reply(
+                200,
+                f'<CompleteMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{key}</Key>'
+                f'<ETag>"{uuid.uuid4().hex}-{len(parts)}"</ETag></CompleteMultipartUploadResult>'.encode(),
+                "application/xml",
+            )
+        self._reply(400, b"<Error><Code>InvalidRequest</Code></Error>", "application/xml")
+
+    def do_PUT(self):
+        body = self._body()
+        path, _, query = self.path.partition("?")
+        part = re.search(r"partNumber=(\d+)", query)
+        upload_id = re.search(r"uploadId=([^&]+)", query)
+        with self.aws.lock:
+            if part and upload_id:
+                self.aws.uploads.setdefault(upload_id.group(1), {})[int(part.group(1))] = len(body)
+            else:
+                self.aws.objects[path] = len(body)
+        self.aws.count("UploadPart" if part else "PutObject", received=len(body))
+        self._reply(200, b"", "application/xml", {"ETag": f'"{uuid.uuid4().hex}"'})
+
+    def do_DELETE(self):
+        upload_id = re.search(r"uploadId=([^&]+)", self.path)
+        if upload_id:
+            with self.aws.lock:
+                self.aws.uploads.pop(upload_id.group(1), None)
+        self.aws.count("AbortMultipartUpload" if upload_id else "DeleteObject")
+        self._reply(204, b"", "application/xml")
+
+    def _medical_imaging(self, datastoreId: str, imageSetId: str, operation: str, body: bytes):
+        shape = re.match(r"(\d{5})x(\d{5})", imageSetId)
+        if not shape or int(shape.group(2)) not in self.aws.frames:
+            return self._reply(404, b'{"message": "Image set not found"}', "application/json")
+        slices, size = int(shape.group(1)), int(shape.group(2))
+        if operation == "getImageSet":
+            data = json.dumps(
+                {"datastoreId": datastoreId, "imageSetId": imageSetId, "versionId": "1", "imageSetState": "ACTIVE"}
+            ).encode()
+            self._reply(200, data, "application/json")
+        elif operation == "getImageSetMetadata":
+            data = gzip.compress(json.dumps(image_set_metadata(slices, size, imageSetId)).encode(), compresslevel=1)
+            self._reply(200, data, "application/json", {"Content-Encoding": "gzip"})
+        elif operation == "getImageFrame":
+            index = int(json.loads(body)["imageFrameId"][5:], 16)
+            data = self.aws.frames[size][index % FRAME_VARIANTS]
+            self._reply(200, data, "application/octet-stream")
+        else:
+            return self._reply(404, b'{"message": "Unknown operation"}', "application/json")
+        self.aws.count(operation, sent=len(data))
+
+    def _reply(self, code: int, data: bytes, content_type: str, headers: Optional[dict] = None):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_aws(entries: List[MixEntry]) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeAWSHandler)
+    server.daemon_threads = True
+    server.aws = FakeAWS(entry.size for entry in entries)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class Context:
+    """The parts of the model server context `model_handler` uses."""
+
+    def __init__(self, model_dir: str):
+        self.system_properties = {"model_dir": model_dir, "gpu_id": 0}
+        self.request_headers: Dict[str, str] = {}
+
+    def get_all_request_header(self, index: int) -> Dict[str, str]:
+        return self.request_headers
+
+
+def _status_fields(pid: int) -> Dict[str, int]:
+    fields = {}
+    try:
+        with open(f"/proc/{pid}/status") as fp:
+            for line in fp:
+                name, _, value = line.partition(":")
+                if name in ("VmRSS", "VmHWM"):
+                    fields[name] = int(value.split()[0]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return fields
+
+
+def process_tree(pid: int) -> List[int]:
+    """`pid` and all its descendants."""
+    children: Dict[int, List[int]] = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as fp:
+                    ppid = int(fp.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, ValueError, IndexError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children.get(current, []))
+    return tree
+
+
+class MemorySampler(threading.Thread):
+    """Samples the summed RSS of processes and their descendants (e.g. frame fetchers) and keeps the peak."""
+
+    def __init__(self, pids: List[int], interval: float = 0.2):
+        super().__init__(daemon=True)
+        self.pids = pids
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            rss = sum(_status_fields(pid).get("VmRSS", 0) for root in self.pids for pid in process_tree(root))
+            self.peak = max(self.peak, rss)
+
+    def stop(self) -> int:
+        self.stopped.set()
+        self.join()
+        return self.peak
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))]
+
+
+def latency_summary(seconds: List[float]) -> dict:
+    if not seconds:
+        return {}
+    summary = {f"p{q}": round(percentile(seconds, q), 3) for q in (50, 90, 99)}
+    summary.update(mean=round(sum(seconds) / len(seconds), 3), max=round(max(seconds), 3))
+    return summary
+
+
+def worker(index: int, model_dir: str, start, tasks, results) -> None:
+    """Model server worker: initialize the handler, then handle one request at a time until None."""
+    context = Context(model_dir)
+    start_ts = time.perf_counter()
+    try:
+        import model_handler
+
+        model_handler.handle(None, context)
+    except Exception as e:
+        results.put({"worker": index, "error": repr(e)})
+        return
+    results.put({"worker": index, "init_seconds": round(time.perf_counter() - start_ts, 3)})
+    start.wait()
+
+    for entry, body, headers in iter(tasks.get, None):
+        context.request_headers = headers
+        result = {"entry": entry, "worker": index}
+        start_ts = time.perf_counter()
+        try:
+            response = model_handler.handle([{"body": json.dumps(body).encode()}], context)
+            if not any(a["uri"].endswith(".dcm") for a in response[0]["outputs"]):
+                result["error"] = "no DICOM SEG in the outputs"
+        except Exception as e:
+            result["error"] = repr(e)
+        result["seconds"] = time.perf_counter() - start_ts
+        results.put(result)
+
+    memory = {
+        "worker": index,
+        "peak_rss_bytes": _status_fields(os.getpid()).get("VmHWM"),
+        # Largest finished child, e.g. an AHItoDICOM frame fetcher.
+        "children_peak_rss_bytes": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+    }
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized():
+        memory["peak_cuda_bytes"] = torch.cuda.max_memory_allocated()
+    results.put(memory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model-dir", default="/opt/ml/model", help="directory with the TorchScript bundle(s)")
+    parser.add_argument("--target-model", default="model.tar.gz", help="X-Amzn-SageMaker-Target-Model of the requests")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("300x512:3,120x512:1"), help="request mix")
+    parser.add_argument("--workers", type=int, default=1, help="model server workers, each handling one request at a time")
+    parser.add_argument("--requests", type=int, default=8, help="requests to send")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the request mix")
+    args = parser.parse_args()
+
+    server = start_fake_aws(args.mix)
+    os.environ.update(offline_env(f"http://127.0.0.1:{server.server_address[1]}"))
+    # HealthImaging data plane calls go to runtime-<endpoint host> otherwise.
+    os.environ["AWS_DISABLE_HOST_PREFIX_INJECTION"] = "true"
+
+    rng = random.Random(args.seed)
+    headers = {"X-Amzn-SageMaker-Target-Model": args.target_model, "Content-Type": "application/json"}
+    context = multiprocessing.get_context("spawn")
+    start, tasks, results = context.Event(), context.Queue(), context.Queue()
+    for n in range(args.requests):
+        entry = rng.choices(args.mix, weights=[e.weight for e in args.mix])[0]
+        body = {"inputs": [{"datastoreId": DATASTORE_ID, "imageSetId": image_set_id(entry.slices, entry.size, n)}]}
+        tasks.put((entry.name, body, headers))
+    for _ in range(args.workers):
+        tasks.put(None)
+
+    workers = [context.Process(target=worker, args=(i, args.model_dir, start, tasks, results)) for i in range(args.workers)]
+    for process in workers:
+        process.start()
+    init = [results.get() for _ in workers]
+    failed = [r for r in init if "error" in r]
+    if failed:
+        start.set()
+        for process in workers:
+            process.terminate()
+        raise SystemExit(f"Worker initialization failed: {failed[0]['error']}")
+
+    sampler = MemorySampler([process.pid for process in workers])
+    sampler.start()
+    start_ts = time.perf_counter()
+    start.set()
+    request_results, worker_memory, wall_seconds = [], [], 0.0
+    while len(worker_memory) < len(workers):
+        result = results.get()
+        if "entry" in result:
+            request_results.append(result)
+            if len(request_results) == args.requests:
+                wall_seconds = time.perf_counter() - start_ts
+        else:
+            worker_memory.append(result)
+    tree_peak = sampler.stop()
+    for process in workers:
+        process.join()
+    server.shutdown()
+
+    ok = [r for r in request_results if "error" not in r]
+    report = {
+        "workers": args.workers,
+        "requests": len(request_results),
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput_rps": round(len(ok) / wall_seconds, 3) if wall_seconds else None,
+        "error_rate": round(1 - len(ok) / len(request_results), 4) if request_results else None,
+        "latency_seconds": latency_summary([r["seconds"] for r in ok]),
+        "by_entry": {},
+        "errors": sorted({r["error"] for r in request_results if "error" in r})[:10],
+        "worker_init_seconds": [r["init_seconds"] for r in sorted(init, key=lambda r: r["worker"])],
+        "memory": {
+            "workers": sorted(worker_memory, key=lambda r: r["worker"]),
+            "all_workers_peak_rss_bytes": tree_peak,
+        },
+        "fake_aws": dict(server.aws.stats),
+    }
+    for entry in args.mix:
+        entry_results = [r for r in request_results if r["entry"] == entry.name]
+        report["by_entry"][entry.name] = {
+            "requests": len(entry_results),
+            "errors": sum(1 for r in entry_results if "error" in r),
+            "latency_seconds": latency_summary([r["seconds"] for r in entry_results if "error" not in r]),
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+CPU latency and accuracy of the model preparation variants on a reference volume.
+
+Every variant runs the bundle's sliding-window inference over the same volume. Latency is
+reported for the first call and as the median of the following calls, and accuracy as the
+Dice overlap and maximum probability difference against the first variant, the
+unoptimized float32 model by default.
+
+usage: python model_benchmark.py MODEL_TS [--volume CT.nii.gz] [--threads N] [--repeat N]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "code"))
+
+import numpy as np
+import SimpleITK as sitk
+import torch
+from monai.inferers import sliding_window_inference
+
+from model_prep import configure_threads, prepare_model, warmup_shape
+
+VARIANTS = {
+    "baseline": dict(variant="fp32", freeze=False, optimize=False),
+    "fp32-optimized": dict(variant="fp32", freeze=True, optimize=True),
+    "bf16-optimized": dict(variant="bf16", freeze=True, optimize=True),
+}
+
+
+def reference_volume(path: str, a_min: float, a_max: float, shape) -> torch.Tensor:
+    """CT volume scaled to [0, 1] like the spleen bundle preprocessing, or random data without a path."""
+    if path:
+        array = sitk.GetArrayFromImage(sitk.ReadImage(path)).astype(np.float32)
+        array = np.clip((array - a_min) / (a_max - a_min), 0.0, 1.0)
+    else:
+        array = np.random.default_rng(0).random(shape, dtype=np.float32)
+    return torch.from_numpy(array)[None, None]
+
+
+def dice(a: torch.Tensor, b: torch.Tensor) -> float:
+    intersection = (a & b).sum().item()
+    total = a.sum().item() + b.sum().item()
+    return 1.0 if total == 0 else 2.0 * intersection / total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("model", help="TorchScript bundle, e.g. model.ts")
+    parser.add_argument("--volume", default=None, help="reference CT volume (default: random 160x160x160)")
+    parser.add_argument("--a-min", type=float, default=-57.0, help="intensity mapped to 0")
+    parser.add_argument("--a-max", type=float, default=164.0, help="intensity mapped to 1")
+    parser.add_argument("--threads", type=int, default=None, help="intra-op threads")
+    parser.add_argument("--interop-threads", type=int, default=None, help="inter-op threads")
+    parser.add_argument("--repeat", type=int, default=3, help="timed calls after the first one")
+    parser.add_argument("--variants", default=",".join(VARIANTS), help="comma-separated variants to run")
+    args = parser.parse_args()
+
+    configure_threads(args.threads, args.interop_threads)
+    device = torch.device("cpu")
+    batch_size, _, *roi_size = warmup_shape(args.model)
+    volume = reference_volume(args.volume, args.a_min, args.a_max, (160, 160, 160))
+
+    report = {"volume_shape": list(volume.shape[2:]), "threads": torch.get_num_threads(), "variants": {}}
+    reference = None
+    for name in args.variants.split(","):
+        start_time = time.time()
+        model = prepare_model(args.model, device, **VARIANTS[name])
+        prepare_time = time.time() - start_time
+
+        def infer():
+            with torch.no_grad():
+                return sliding_window_inference(volume, roi_size, batch_size, model, overlap=0.5)
+
+        start_time = time.time()
+        output = infer()
+        first_call = time.time() - start_time
+        latencies = []
+        for _ in range(args.repeat):
+            start_time = time.time()
+            infer()
+            latencies.append(time.time() - start_time)
+
+        probabilities = torch.softmax(output.float(), dim=1)
+        mask = probabilities.argmax(dim=1).bool()
+        if reference is None:
+            reference = (probabilities, mask)
+        report["variants"][name] = {
+            "prepare_seconds": round(prepare_time, 3),
+            "first_call_seconds": round(first_call, 3),
+            "median_seconds": round(statistics.median(latencies), 3) if latencies else None,
+            "dice_vs_first": round(dice(mask, reference[1]), 5),
+            "max_probability_diff": round((probabilities - reference[0]).abs().max().item(), 5),
+        }
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,18 @@
 """
 ModelHandler defines an example model handler for MONAI Deploy
 """
-import glob
 import json
 import logging
 import os
-import re
-import torch
-from collections import namedtuple
-from importlib import import_module
-import numpy as np
-import boto3
-logging.info(f"######## boto3 version {boto3.__version__}")
+import shutil
+import uuid
+from contextlib import nullcontext
 
-from app import AISpleenSegApp
-from AHItoDICOMInterface.AHItoDICOM import AHItoDICOM
-
-account_id = boto3.client("sts").get_caller_identity()["Account"]
-region = boto3.Session().region_name
+# MONAI, torch, pydicom and the AWS clients are imported/created in initialize(), so worker
+# spawn stays cheap and no network call happens at import time.
+from batch import is_batch_request
+from lazy_init import ahi_helper, client, output_bucket
+from request_profile import RequestProfile
 
 class ModelHandler(object):
     """
@@ -42,18 +37,40 @@ class ModelHandler(object):
         logging.debug("files in model_dir: {}".format(os.listdir(model_dir)))
         
         gpu_id = properties.get("gpu_id")
-        # device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        # model = torch.jit.load(model_dir+'/model.ts', map_location=device)
 
-        helper = AHItoDICOM()
-        self.monai_app_instance = AISpleenSegApp(helper, do_run=False, path="/home/model-server/")
+        from app import AISpleenSegApp
+        from batch import PrefetchingAHIClient
+        from model_prep import configure_threads
+        from model_registry import ModelRegistry
+        from output_stage import OutputBuffers, OutputUploader
+        from sliding_window import SlidingWindowConfig
+
+        configure_threads()
+        self.model_registry = ModelRegistry()
+        # Each model is frozen, optimized and warmed up on its first request, so a multi-model
+        # endpoint only loads the models it is asked for and stays within the model-load timeout.
+        # MODEL_PREPARE_ALL=1 prepares every model in model_dir now instead.
+        if os.getenv("MODEL_PREPARE_ALL", "0") == "1":
+            self.model_registry.prepare_all(model_dir)
+
+        self.output_buffers = OutputBuffers()
+        self.monai_app_instance = AISpleenSegApp(
+            PrefetchingAHIClient(ahi_helper()),
+            do_run=False,
+            path="/home/model-server/",
+            output_buffers=self.output_buffers,
+            model_registry=self.model_registry,
+            sliding_window=SlidingWindowConfig.from_env(),
+        )
         logging.debug(f"MONAI App Info: {self.monai_app_instance.get_package_info()}")
-        self.s3_client = boto3.client("s3")
+        self.s3_client = client("s3")
+        self.uploader = OutputUploader(self.s3_client, output_bucket())
 
-    def preprocess(self, request):
+    def preprocess(self, request, request_id):
         """
         Transform raw input into model input data.
         :param request: list of raw requests
+        :param request_id: unique ID of the request, used to keep its files apart from other requests
         :return: list of preprocessed model input data
         """
         # Take the input data and pre-process it make it inference ready
@@ -61,40 +78,68 @@ class ModelHandler(object):
         datastoreId = json.loads(inputStr)['inputs'][0]['datastoreId']
         imageSetId = json.loads(inputStr)['inputs'][0]['imageSetId']
         
-        with open('/home/model-server/inputImageSets.json', 'w') as f:
+        request_dir = f"/home/model-server/requests/{request_id}"
+        os.makedirs(request_dir, exist_ok=True)
+        with open(f"{request_dir}/inputImageSets.json", 'w') as f:
             f.write(json.dumps({
                 "datastoreId": datastoreId, 
                 "imageSetId": imageSetId
             }))
         
-        return '/home/model-server/inputImageSets.json'
+        return f"{request_dir}/inputImageSets.json"
 
-    def inference(self, model_input, targetmodel):
+    def inference(self, model_input, targetmodel, request_id, profile=None):
         """
         Internal inference methods
         :param model_input: transformed model input data list
-        :return: list of inference output in NDArray
+        :param request_id: unique ID of the request, used in the output S3 keys
+        :param profile: RequestProfile of the request, or None when profiling is off
+        :return: list with the S3 URI, size and upload time of every output artifact
         """
         logging.debug("input file: {}".format(model_input))
         logging.debug("input file: {}".format(targetmodel.split('.')[0]))
 
-        self.monai_app_instance.run(
-            input=model_input,
-            output="/home/model-server/output/",
-            workdir="/home/model-server/",
-            model=f"{os.environ['model_dir']}/{targetmodel.split('.')[0]}.ts"
-        )
+        request_dir = os.path.dirname(model_input)
+        output_dir = f"{request_dir}/output/"
+        self.output_buffers.drain()
+        with profile.operators(self.monai_app_instance) if profile else nullcontext():
+            self.monai_app_instance.run(
+                input=model_input,
+                output=output_dir,
+                workdir=request_dir,
+                model=f"{os.environ['model_dir']}/{targetmodel.split('.')[0]}.ts"
+            )
 
         logging.info("#### MONAI App complete")
-        logging.info("#### output files: {}".format(os.listdir("/home/model-server/output/")))
-        
-        
-        for root,dirs,files in os.walk("/home/model-server/output/"):
-            logging.info(files)
-            for file in files:
-                self.s3_client.upload_file(os.path.join(root,file), f"sagemaker-{region}-{account_id}", 'monaideploy/'+file)
+        logging.info("#### model registry: {}".format(json.dumps(self.model_registry.stats())))
+        try:
+            with profile.section("upload") if profile else nullcontext():
+                artifacts = self.uploader.upload(request_id, output_dir, self.output_buffers.drain())
+        finally:
+            shutil.rmtree(request_dir, ignore_errors=True)
+        logging.info("#### output artifacts: {}".format(artifacts))
+
+        if profile is None:
+            return [{"requestId": request_id, "outputs": artifacts}]
+        summary = profile.finish()
+        # The profile is uploaded under the request prefix, next to the outputs.
+        artifacts += self.uploader.upload(request_id, buffers=profile.buffers())
+        return [{"requestId": request_id, "outputs": artifacts, "profile": summary}]
+
+    def batch(self, body, targetmodel):
+        """
+        Run a batch job over every image set listed in the request
+        :param body: parsed request with the `inputs` manifest and a `jobId`, null to derive it
+        :return: list with the job ID, output manifest URI and item counts
+        """
+        from batch import BatchJob
 
-        return [{f"s://sagemaker-{region}-{account_id}/monaideploy/{file}": "outputs3file"}]
+        job = BatchJob(
+            self.monai_app_instance,
+            self.uploader,
+            model=f"{os.environ['model_dir']}/{targetmodel.split('.')[0]}.ts",
+        )
+        return [job.run(body["inputs"], job_id=body.get("jobId"))]
 
     def handle(self, data, context):
         """
@@ -103,8 +148,18 @@ class ModelHandler(object):
         :param context: mms context
         """
         request_header = context.get_all_request_header(0) ## {'body': {'content-type': 'application/json'}, 'Accept': 'application/json', 'User-Agent': 'AHC/2.0', 'Host': '169.254.180.2:8080', 'Content-Length': '115', 'X-Amzn-SageMaker-Target-Model': 'model.tar.gz', 'Content-Type': 'application/json'}
-        model_input = self.preprocess(data)
-        model_out = self.inference(model_input, request_header['X-Amzn-SageMaker-Target-Model'])
+        body = json.loads(data[0].get("body").decode('UTF8'))
+        if is_batch_request(body):
+            return self.batch(body, request_header['X-Amzn-SageMaker-Target-Model'])
+        request_id = uuid.uuid4().hex
+        # Opt-in: `profile=on|cprofile` in X-Amzn-SageMaker-Custom-Attributes, or PROFILE_REQUESTS.
+        profile = RequestProfile.for_request(request_id, request_header)
+        try:
+            model_input = self.preprocess(data, request_id)
+            model_out = self.inference(model_input, request_header['X-Amzn-SageMaker-Target-Model'], request_id, profile)
+        finally:
+            if profile is not None:
+                profile.finish()
         return model_out
 
 _service = ModelHandler()
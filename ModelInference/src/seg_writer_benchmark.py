@@ -0,0 +1,157 @@
+"""
+Encoding time and size of the DICOM SEG writers on synthetic spleen-like masks.
+
+A synthetic CT series and an ellipsoid mask covering `--extent` of its slices are written by
+the App SDK writer to the output folder ("highdicom"), by the same writer into an in-memory
+buffer ("highdicom-in-memory", what the model server runs by default) and by the sparse
+writer into an in-memory buffer ("sparse", `SEG_WRITER=sparse`). Every SEG is decoded again
+and checked against the mask through the source instances its frames reference.
+
+usage: python seg_writer_benchmark.py [--slices N] [--size N] [--extent F] [--repeat N]
+"""
+import argparse
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "code"))
+
+import numpy as np
+from pydicom import dcmread
+from pydicom.dataset import Dataset
+from pydicom.sr.codedict import codes
+from pydicom.uid import generate_uid
+
+from monai.deploy.core.domain.dicom_series import DICOMSeries
+from monai.deploy.operators.dicom_seg_writer_operator import DICOMSegmentationWriterOperator, SegmentDescription
+
+from output_stage import InMemoryDICOMSegmentationWriterOperator, OutputBuffers
+from seg_writer import SparseDICOMSegmentationWriterOperator
+
+CT_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.2"
+
+
+def synthetic_series(slices: int, size: int, spacing: float = 0.8, thickness: float = 1.5) -> DICOMSeries:
+    """Single-frame CT instances without pixel data; the writers only read their attributes."""
+    study_uid, series_uid, frame_of_reference_uid = generate_uid(), generate_uid(), generate_uid()
+    series = DICOMSeries(series_uid)
+    for i in range(slices):
+        ds = Dataset()
+        ds.SOPClassUID = CT_IMAGE_STORAGE
+        ds.SOPInstanceUID = generate_uid()
+        ds.StudyInstanceUID = study_uid
+        ds.SeriesInstanceUID = series_uid
+        ds.FrameOfReferenceUID = frame_of_reference_uid
+        ds.Modality = "CT"
+        ds.PatientName = "Synthetic^Spleen"
+        ds.PatientID = "SEG-BENCHMARK"
+        ds.PatientBirthDate = ""
+        ds.PatientSex = "O"
+        ds.StudyDate = "20230101"
+        ds.StudyTime = "120000"
+        ds.StudyID = "1"
+        ds.AccessionNumber = ""
+        ds.ReferringPhysicianName = ""
+        ds.SeriesNumber = 1
+        ds.InstanceNumber = i + 1
+        ds.ImagePositionPatient = [-size * spacing / 2, -size * spacing / 2, -i * thickness]
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.PixelSpacing = [spacing, spacing]
+        ds.SliceThickness = thickness
+        ds.Rows = ds.Columns = size
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated = ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 1
+        series.add_sop_instance(ds)
+    return series
+
+
+def ellipsoid_mask(slices: int, size: int, extent: float) -> np.ndarray:
+    """uint8 (slices, rows, columns) label volume, like the bundle output the writers receive."""
+    z, y, x = np.ogrid[:slices, :size, :size]
+    radii = (max(1.0, slices * extent / 2), size * 0.12, size * 0.08)
+    center = (slices * 0.5, size * 0.4, size * 0.7)
+    inside = ((z - center[0]) / radii[0]) ** 2 + ((y - center[1]) / radii[1]) ** 2 + ((x - center[2]) / radii[2]) ** 2
+    return (inside <= 1.0).astype(np.uint8)
+
+
+def check(seg: Dataset, mask: np.ndarray, series: DICOMSeries) -> bool:
+    """True if the SEG frames, placed on the source instances they reference, rebuild the mask."""
+    index = {i.get_native_sop_instance().SOPInstanceUID: n for n, i in enumerate(series.get_sop_instances())}
+    frames = seg.pixel_array.reshape(-1, seg.Rows, seg.Columns)
+    rebuilt = np.zeros_like(mask)
+    for item, frame in zip(seg.PerFrameFunctionalGroupsSequence, frames):
+        source = item.DerivationImageSequence[0].SourceImageSequence[0].ReferencedSOPInstanceUID
+        rebuilt[index[source]] = frame
+    return bool(np.array_equal(rebuilt, mask))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--slices", type=int, default=300, help="slices of the synthetic series")
+    parser.add_argument("--size", type=int, default=512, help="rows and columns of the synthetic series")
+    parser.add_argument("--extent", type=float, default=0.2, help="fraction of the slices the mask covers")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per writer")
+    args = parser.parse_args()
+
+    series = synthetic_series(args.slices, args.size)
+    mask = ellipsoid_mask(args.slices, args.size, args.extent)
+    segment_descriptions = [
+        SegmentDescription(
+            segment_label="Spleen",
+            segmented_property_category=codes.SCT.Organ,
+            segmented_property_type=codes.SCT.Spleen,
+            algorithm_name="volumetric (3D) segmentation of the spleen from CT image",
+            algorithm_family=codes.DCM.ArtificialIntelligence,
+            algorithm_version="0.1.0",
+        )
+    ]
+    custom_tags = {"SeriesDescription": "AI generated Seg, not for clinical use."}
+
+    report = {
+        "series_shape": list(mask.shape),
+        "slices_with_segment": int(mask.reshape(mask.shape[0], -1).any(axis=1).sum()),
+        "writers": {},
+    }
+    with tempfile.TemporaryDirectory() as output_dir:
+        output_buffers = OutputBuffers()
+        writers = {
+            "highdicom": DICOMSegmentationWriterOperator(segment_descriptions, custom_tags),
+            "highdicom-in-memory": InMemoryDICOMSegmentationWriterOperator(
+                output_buffers, segment_descriptions, custom_tags
+            ),
+            "sparse": SparseDICOMSegmentationWriterOperator(
+                segment_descriptions, custom_tags, output_buffers=output_buffers
+            ),
+        }
+        for name, writer in writers.items():
+            latencies = []
+            for _ in range(args.repeat):
+                for path in Path(output_dir).glob("*.dcm"):
+                    path.unlink()
+                output_buffers.drain()
+                start_time = time.time()
+                writer.create_dicom_seg(mask, series, Path(output_dir))
+                latencies.append(time.time() - start_time)
+            buffers = list(output_buffers.drain().values())
+            data = buffers[0].getvalue() if buffers else next(Path(output_dir).glob("*.dcm")).read_bytes()
+            seg = dcmread(io.BytesIO(data))
+            report["writers"][name] = {
+                "median_seconds": round(statistics.median(latencies), 3),
+                "bytes": len(data),
+                "frames": int(seg.NumberOfFrames),
+                "matches_mask": check(seg, mask, series),
+            }
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
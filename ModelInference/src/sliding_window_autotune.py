@@ -0,0 +1,159 @@
+"""
+Picks sliding-window inference settings for this host.
+
+Every candidate combination of ROI size, overlap, sw_batch_size and patch workers runs the
+model over a synthetic CT volume in a fresh process, so peak memory is measured per
+candidate. The report lists seconds per volume, throughput and peak memory. The fastest
+candidate that fits the memory budget is printed as the SW_* environment variables read by
+`SlidingWindowConfig.from_env`.
+
+usage: python sliding_window_autotune.py MODEL_TS [--roi-sizes 96,96,96;160,160,160]
+           [--overlaps 0.25,0.5] [--batch-sizes 1,4] [--patch-workers 1,2] [--memory-budget BYTES]
+"""
+import argparse
+import itertools
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+CODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "code")
+
+
+def synthetic_ct(shape, seed: int = 0):
+    """Air around an ellipsoidal soft-tissue body with noise and a denser spine, in Hounsfield units."""
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    z, y, x = np.meshgrid(*(np.linspace(-1, 1, n, dtype=np.float32) for n in shape), indexing="ij")
+    volume = np.full(shape, -1000.0, dtype=np.float32)
+    body = (x / 0.85) ** 2 + (y / 0.65) ** 2 <= 1.0
+    volume[body] = 40.0 + rng.normal(0, 20, size=int(body.sum())).astype(np.float32)
+    volume[(x**2 + (y - 0.45) ** 2) <= 0.01] = 700.0
+    return volume
+
+
+def run_candidate(model_path: str, candidate: dict, shape, device_name: str, repeat: int) -> dict:
+    """Run one candidate in this process and measure it."""
+    sys.path.insert(0, CODE_DIR)
+    import numpy as np
+    import torch
+    from monai.inferers import SlidingWindowInferer
+
+    from model_prep import prepare_model
+    from sliding_window import SlidingWindowConfig
+
+    device = torch.device(device_name)
+    model = prepare_model(model_path, device)
+    config = SlidingWindowConfig.from_dict(candidate)
+    inferer = config.apply(SlidingWindowInferer(roi_size=config.roi_size))
+    volume = np.clip((synthetic_ct(shape) + 57.0) / (164.0 + 57.0), 0.0, 1.0)
+    inputs = torch.from_numpy(volume)[None, None].to(device)
+
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+        baseline = torch.cuda.memory_allocated(device)
+    else:
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    with torch.no_grad():
+        inferer(inputs, model)  # warm-up
+        latencies = []
+        for _ in range(repeat):
+            start_time = time.time()
+            inferer(inputs, model)
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            latencies.append(time.time() - start_time)
+
+    if device.type == "cuda":
+        peak = torch.cuda.max_memory_allocated(device) - baseline
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - baseline
+    seconds = sorted(latencies)[len(latencies) // 2]
+    return {
+        **candidate,
+        "seconds": round(seconds, 3),
+        "voxels_per_second": int(volume.size / seconds),
+        "peak_bytes": max(int(peak), 0),
+    }
+
+
+def default_memory_budget(device_name: str) -> int:
+    if device_name == "cuda":
+        import torch
+
+        return int(torch.cuda.get_device_properties(0).total_memory * 0.8)
+    return int(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES") * 0.8)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("model", help="TorchScript bundle, e.g. model.ts")
+    parser.add_argument("--roi-sizes", default="96,96,96;128,128,128;160,160,160", help="';'-separated ROI sizes")
+    parser.add_argument("--overlaps", default="0.25,0.5")
+    parser.add_argument("--batch-sizes", default="1,4")
+    parser.add_argument("--patch-workers", default="1,2")
+    parser.add_argument("--volume-shape", default="160,224,224", help="synthetic volume shape (z,y,x) after resampling")
+    parser.add_argument("--device", default=None, help="cpu or cuda (default: cuda if available)")
+    parser.add_argument("--repeat", type=int, default=2)
+    parser.add_argument("--memory-budget", type=int, default=None, help="bytes (default: 80%% of free memory)")
+    parser.add_argument("--min-overlap", type=float, default=0.25, help="lowest overlap eligible for the pick")
+    parser.add_argument("--candidate", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    shape = tuple(int(v) for v in args.volume_shape.split(","))
+    if args.device is None:
+        import torch
+
+        args.device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    if args.candidate:
+        result = run_candidate(args.model, json.loads(args.candidate), shape, args.device, args.repeat)
+        print(json.dumps(result))
+        return
+
+    candidates = [
+        {"roi_size": [int(v) for v in roi.split(",")], "overlap": float(o), "sw_batch_size": int(b), "patch_workers": int(w)}
+        for roi, o, b, w in itertools.product(
+            args.roi_sizes.split(";"), args.overlaps.split(","), args.batch_sizes.split(","), args.patch_workers.split(",")
+        )
+    ]
+    results = []
+    for candidate in candidates:
+        process = subprocess.run(
+            [
+                sys.executable, __file__, args.model,
+                "--candidate", json.dumps(candidate),
+                "--volume-shape", args.volume_shape,
+                "--device", args.device,
+                "--repeat", str(args.repeat),
+            ],
+            capture_output=True,
+            text=True,
+        )
+        if process.returncode != 0:
+            error = process.stderr.strip().splitlines()[-1] if process.stderr.strip() else "failed"
+            results.append({**candidate, "error": error})
+        else:
+            results.append(json.loads(process.stdout.strip().splitlines()[-1]))
+        print(json.dumps(results[-1]), file=sys.stderr)
+
+    budget = args.memory_budget or default_memory_budget(args.device)
+    eligible = [
+        r for r in results if "error" not in r and r["peak_bytes"] <= budget and r["overlap"] >= args.min_overlap
+    ]
+    best = min(eligible, key=lambda r: r["seconds"]) if eligible else None
+    report = {"device": args.device, "volume_shape": list(shape), "memory_budget": budget, "results": results, "best": best}
+    print(json.dumps(report, indent=2))
+    if best:
+        print(f"SW_ROI_SIZE={','.join(str(v) for v in best['roi_size'])}")
+        print(f"SW_OVERLAP={best['overlap']}")
+        print(f"SW_BATCH_SIZE={best['sw_batch_size']}")
+        print(f"SW_PATCH_WORKERS={best['patch_workers']}")
+
+
+if __name__ == "__main__":
+    main()
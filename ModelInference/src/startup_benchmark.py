@@ -0,0 +1,162 @@
+"""
+Measures the cold-start cost of the inference container modules without network access.
+
+AWS calls are answered by a local stub endpoint, so the numbers reflect import and
+initialization work only. For every module the import time is measured in a fresh
+interpreter, followed by the time until the model handler has initialized and would
+answer its first health check.
+
+usage: python startup_benchmark.py [--model-dir DIR] [--repeat N] [--top N]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+CODE_DIR = os.path.join(SRC_DIR, "code")
+MODULES = ["lazy_init", "batch", "output_stage", "app", "inference", "model_handler"]
+
+STS_RESPONSE = """<GetCallerIdentityResponse xmlns="https://sts.amazonaws.com/doc/2011-06-15/">
+  <GetCallerIdentityResult>
+    <Arn>arn:aws:iam::123456789012:user/benchmark</Arn>
+    <UserId>AIDABENCHMARK</UserId>
+    <Account>123456789012</Account>
+  </GetCallerIdentityResult>
+  <ResponseMetadata><RequestId>00000000-0000-0000-0000-000000000000</RequestId></ResponseMetadata>
+</GetCallerIdentityResponse>"""
+
+
+class StubAWSHandler(BaseHTTPRequestHandler):
+    """Answers STS GetCallerIdentity and acknowledges every other AWS call with an empty body."""
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+        if "GetCallerIdentity" in body:
+            self._reply(200, STS_RESPONSE, "text/xml")
+        else:
+            self._reply(200, "{}", "application/json")
+
+    def do_GET(self):
+        self._reply(200, "{}", "application/json")
+
+    do_PUT = do_HEAD = do_GET
+
+    def _reply(self, code, body, content_type):
+        data = body.encode()
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_endpoint() -> str:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubAWSHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def offline_env(endpoint_url: str) -> dict:
+    env = dict(os.environ)
+    env.update(
+        {
+            "AWS_ENDPOINT_URL": endpoint_url,
+            "AWS_ACCESS_KEY_ID": "benchmark",
+            "AWS_SECRET_ACCESS_KEY": "benchmark",
+            "AWS_DEFAULT_REGION": "us-east-1",
+            "AWS_EC2_METADATA_DISABLED": "true",
+            "PYTHONPATH": os.pathsep.join([SRC_DIR, CODE_DIR, env.get("PYTHONPATH", "")]),
+        }
+    )
+    return env
+
+
+def run_python(code: str, env: dict, *args) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, *args, "-c", code], env=env, capture_output=True, text=True)
+
+
+def import_time(module: str, env: dict) -> float:
+    code = (
+        "import time; start = time.perf_counter(); "
+        f"import {module}; print(time.perf_counter() - start)"
+    )
+    result = run_python(code, env)
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr.strip()}")
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def top_imports(module: str, env: dict, top: int) -> list:
+    """Slowest imports (cumulative microseconds) reported by `-X importtime`."""
+    result = run_python(f"import {module}", env, "-X", "importtime")
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        entries.append((int(cumulative_us), name.strip()))
+    return sorted(entries, reverse=True)[:top]
+
+
+def time_to_ready(model_dir: str, env: dict) -> float:
+    """Seconds from interpreter start of the handler to the end of its first `handle` call."""
+    code = f"""
+import time
+start = time.perf_counter()
+import model_handler
+
+class Context:
+    system_properties = {{"model_dir": {model_dir!r}, "gpu_id": 0}}
+
+model_handler.handle(None, Context())
+print(time.perf_counter() - start)
+"""
+    result = run_python(code, env)
+    if result.returncode != 0:
+        raise RuntimeError(f"model handler initialization failed:\n{result.stderr.strip()}")
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model-dir", default=None, help="model directory passed to the handler (default: empty temp dir)")
+    parser.add_argument("--repeat", type=int, default=3, help="fresh interpreters per measurement")
+    parser.add_argument("--top", type=int, default=10, help="slowest imports to list per module")
+    args = parser.parse_args()
+
+    env = offline_env(start_stub_endpoint())
+    report = {"import_seconds": {}, "slowest_imports": {}, "ready_seconds": None}
+
+    for module in MODULES:
+        try:
+            times = [import_time(module, env) for _ in range(args.repeat)]
+        except RuntimeError as e:
+            print(e, file=sys.stderr)
+            continue
+        report["import_seconds"][module] = round(statistics.median(times), 4)
+        report["slowest_imports"][module] = [
+            {"module": name, "cumulative_ms": round(us / 1000, 1)} for us, name in top_imports(module, env, args.top)
+        ]
+
+    with tempfile.TemporaryDirectory() as model_dir:
+        try:
+            times = [time_to_ready(args.model_dir or model_dir, env) for _ in range(args.repeat)]
+            report["ready_seconds"] = round(statistics.median(times), 4)
+        except RuntimeError as e:
+            print(e, file=sys.stderr)
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import io
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "code"))
+
+pydicom = pytest.importorskip("pydicom")
+pytest.importorskip("monai.deploy")
+
+from pydicom.dataset import Dataset
+from pydicom.uid import generate_uid
+
+from seg_writer import encode_seg
+
+
+def source_series(slices=6, size=16):
+    """Single-frame CT instances without pixel data, top slice first."""
+    study_uid, series_uid, frame_of_reference_uid = generate_uid(), generate_uid(), generate_uid()
+    datasets = []
+    for i in range(slices):
+        ds = Dataset()
+        ds.SOPClassUID = "1.2.840.10008.5.1.4.1.1.2"
+        ds.SOPInstanceUID = generate_uid()
+        ds.StudyInstanceUID = study_uid
+        ds.SeriesInstanceUID = series_uid
+        ds.FrameOfReferenceUID = frame_of_reference_uid
+        ds.PatientID = "SEG-TEST"
+        ds.ImagePositionPatient = [0.0, 0.0, -2.0 * i]
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.PixelSpacing = [0.8, 0.8]
+        ds.SliceThickness = 2.0
+        ds.Rows = ds.Columns = size
+        datasets.append(ds)
+    return datasets
+
+
+def segment_descriptions(count=1):
+    return [Dataset() for _ in range(count)]
+
+
+def written(seg):
+    """The SEG as read back from its file."""
+    buffer = io.BytesIO()
+    seg.save_as(buffer, write_like_original=False)
+    buffer.seek(0)
+    return pydicom.dcmread(buffer)
+
+
+def rebuilt_mask(seg, datasets):
+    index = {ds.SOPInstanceUID: n for n, ds in enumerate(datasets)}
+    frames = seg.pixel_array.reshape(-1, seg.Rows, seg.Columns)
+    mask = np.zeros((len(datasets), seg.Rows, seg.Columns), np.uint8)
+    for item, frame in zip(seg.PerFrameFunctionalGroupsSequence, frames):
+        source = item.DerivationImageSequence[0].SourceImageSequence[0].ReferencedSOPInstanceUID
+        segment_number = item.SegmentIdentificationSequence[0].ReferencedSegmentNumber
+        mask[index[source]][frame > 0] = segment_number
+    return mask
+
+
+def test_encode_seg_writes_only_occupied_frames():
+    datasets = source_series()
+    descriptions = segment_descriptions(2)
+    for number, ds in enumerate(descriptions, 1):
+        ds.SegmentNumber = number
+    mask = np.zeros((6, 16, 16), np.uint8)
+    mask[1, 2:5, 3:9] = 1
+    mask[2, 4:6, 4:6] = 1
+    mask[4, 10:14, 1:3] = 2
+    seg = written(encode_seg(mask, datasets, descriptions, series_number=1))
+    assert seg.NumberOfFrames == 3
+    assert len(seg.ReferencedSeriesSequence[0].ReferencedInstanceSequence) == 3
+    np.testing.assert_array_equal(rebuilt_mask(seg, datasets), mask)
+
+
+def test_encode_seg_writes_one_empty_frame_for_an_empty_mask():
+    datasets = source_series()
+    descriptions = segment_descriptions()
+    descriptions[0].SegmentNumber = 1
+    seg = written(encode_seg(np.zeros((6, 16, 16), np.uint8), datasets, descriptions, series_number=1))
+    assert seg.NumberOfFrames == 1
+    assert len(seg.PerFrameFunctionalGroupsSequence) == 1
+    assert not seg.pixel_array.any()
+    referenced = seg.PerFrameFunctionalGroupsSequence[0].DerivationImageSequence[0].SourceImageSequence[0]
+    assert referenced.ReferencedSOPInstanceUID == datasets[0].SOPInstanceUID
@@ -8,17 +8,25 @@ import sys
 import time
 import os
 import gzip
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from openjpeg import decode
 
+from .FetchPlan import FetchPlan
+from .FrameCache import frameCacheFromEnv, frameKey
+from .FrameDecode import readFrame
+
 logging.basicConfig( level="INFO" )
 
 class MedicalImaging: 
-    def __init__(self, endpoint=""):
+    def __init__(self, endpoint="", frameCache=None):
         session = boto3.Session()
         if len(endpoint)>1:
             self.client = boto3.client('medical-imaging', endpoint_url=endpoint)
         else:
             self.client = boto3.client('medical-imaging')
+        # optional shared tier (FrameCache) the nodes of a training cluster consult before the service
+        self.frameCache = frameCache if frameCache is not None else frameCacheFromEnv()
     
     def stopwatch(self, start_time, end_time):
         time_lapsed = end_time - start_time
@@ -36,7 +44,9 @@ class MedicalImaging:
     
     def listDatastores(self):
         start_time = time.time()
-        response = self.client.list_datastores()
+        response = {"datastoreSummaries": []}
+        for page in self.client.get_paginator("list_datastores").paginate():
+            response["datastoreSummaries"].extend(page["datastoreSummaries"])
         end_time = time.time()
         logging.debug(f"List Datastores  : {self.stopwatch(start_time,end_time)} ms")        
         return response
@@ -66,15 +76,19 @@ class MedicalImaging:
         return response
     
     
-    def startImportJob(self, datastoreId, IamRoleArn, inputS3, outputS3):
+    def startImportJob(self, datastoreId, IamRoleArn, inputS3, outputS3, clientToken=None, jobName=None):
+        # The client token is the idempotency key of the request: reuse it only to retry the same import.
         start_time = time.time()
-        response = self.client.start_dicom_import_job(
+        params = dict(
             datastoreId=datastoreId,
             dataAccessRoleArn = IamRoleArn,
             inputS3Uri = inputS3,
             outputS3Uri = outputS3,
-            clientToken = "demoClient"
+            clientToken = clientToken or str(uuid.uuid4())
         )
+        if jobName:
+            params["jobName"] = jobName
+        response = self.client.start_dicom_import_job(**params)
         end_time = time.time()
         logging.debug(f"Start Import Job  : {self.stopwatch(start_time,end_time)} ms")        
         return response
@@ -90,30 +104,89 @@ class MedicalImaging:
 
     def listImportJobs(self, datastoreId, jobStatus='COMPLETED'):
         start_time = time.time()
-        response = self.client.list_dicom_import_jobs(
-            datastoreId=datastoreId,
-            jobStatus = jobStatus
-        )
+        response = {"jobSummaries": []}
+        paginator = self.client.get_paginator("list_dicom_import_jobs")
+        for page in paginator.paginate(datastoreId=datastoreId, jobStatus=jobStatus):
+            response["jobSummaries"].extend(page["jobSummaries"])
         end_time = time.time()
         logging.debug(f"List Import Jobs : {self.stopwatch(start_time,end_time)} ms")        
         return response
     
     
-    def getFramePixels(self, datastoreId, imageSetId, imageFrameId):
+    def searchImageSets(self, datastoreId, searchCriteria=None):
         start_time = time.time()
-        res = self.client.get_image_frame(
-            datastoreId=datastoreId,
-            imageSetId=imageSetId,
-            imageFrameInformation={
-                'imageFrameId': imageFrameId
-            })
+        params = {"datastoreId": datastoreId}
+        if searchCriteria:
+            params["searchCriteria"] = searchCriteria
+        summaries = []
+        for page in self.client.get_paginator("search_image_sets").paginate(**params):
+            summaries.extend(page["imageSetsMetadataSummaries"])
+        end_time = time.time()
+        logging.debug(f"Search ImageSets : {self.stopwatch(start_time,end_time)} ms")
+        return summaries
+    
+    
+    def getFrameBytes(self, datastoreId, imageSetId, imageFrameId):
+        # encoded frame, through the shared frame cache if there is one
+        def fetch():
+            res = self.client.get_image_frame(
+                datastoreId=datastoreId,
+                imageSetId=imageSetId,
+                imageFrameInformation={'imageFrameId': imageFrameId}
+            )
+            return res['imageFrameBlob'].read()
+        if self.frameCache is not None:
+            return self.frameCache.getOrFetch(frameKey(datastoreId, imageSetId, imageFrameId), fetch)
+        return fetch()
+    
+    
+    def getFramePixels(self, datastoreId, imageSetId, imageFrameId, resolutionLevel=0, targetSize=None):
+        # resolutionLevel n decodes only down to 1/2**n of the width and height; targetSize picks
+        # the level from the frame's size, e.g. 128 for thumbnails. See FrameDecode.readFrame.
+        start_time = time.time()
+        if self.frameCache is not None:
+            res = {'imageFrameBlob': io.BytesIO(self.getFrameBytes(datastoreId, imageSetId, imageFrameId)), 'ResponseMetadata': {}}
+        else:
+            res = self.client.get_image_frame(
+                datastoreId=datastoreId,
+                imageSetId=imageSetId,
+                imageFrameInformation={
+                    'imageFrameId': imageFrameId
+                })
         end_time = time.time()
         logging.debug(f"Frame fetch     : {self.stopwatch(start_time,end_time)} ms") 
         start_time = time.time() 
-        b = io.BytesIO()
-        b.write(res['imageFrameBlob'].read())
-        b.seek(0)
-        d = decode(b)
+        if resolutionLevel == 0 and targetSize is None:
+            b = io.BytesIO()
+            b.write(res['imageFrameBlob'].read())
+            b.seek(0)
+            d = decode(b)
+        else:
+            d, level, nbytes = readFrame(res['imageFrameBlob'], resolutionLevel, targetSize)
+            logging.debug(f"Frame level     : {level}, {nbytes} bytes read")
         end_time = time.time()
         logging.debug(f"Frame decode    : {self.stopwatch(start_time,end_time)} ms")    
-        return d 
+        return d
+    
+    
+    def getFramesPixels(self, datastoreId, imageSetId, frameIds, maxWorkers=8, **decodeOptions):
+        # decodeOptions: resolutionLevel and targetSize of getFramePixels.
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            frames = list(executor.map(lambda f: self.getFramePixels(datastoreId, imageSetId, f, **decodeOptions), frameIds))
+        end_time = time.time()
+        logging.debug(f"Frames fetch    : {len(frameIds)} frames in {self.stopwatch(start_time,end_time)} ms")
+        return frames
+    
+    
+    def getVolume(self, datastoreId, imageSetId, fetchPlan=None, metadata=None, maxWorkers=8, **decodeOptions):
+        # Frames are selected from the metadata first, so frames outside the plan are never fetched.
+        # They keep their native integer dtype; see Normalize for slope/intercept and float conversion.
+        start_time = time.time()
+        if metadata is None:
+            metadata = self.getMetadata(datastoreId, imageSetId)
+        frameIds = (fetchPlan or FetchPlan()).frameIds(metadata)
+        frames = self.getFramesPixels(datastoreId, imageSetId, frameIds, maxWorkers, **decodeOptions)
+        end_time = time.time()
+        logging.debug(f"Volume fetch    : {len(frameIds)} frames in {self.stopwatch(start_time,end_time)} ms")
+        return frames
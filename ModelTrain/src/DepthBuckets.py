@@ -0,0 +1,179 @@
+import math
+import queue
+import random
+import threading
+
+import torch
+import torch.nn.functional as F
+
+
+def depthBoundaries(depths, numBuckets=4, multiple=8):
+    """
+    Bucket depths at the quantiles of `depths`, rounded up to a multiple of `multiple`, so
+    each bucket holds about as many studies and pads them by less than a bucket width.
+    """
+    ordered = sorted(depths)
+    if not ordered:
+        return []
+    boundaries = set()
+    for n in range(1, numBuckets + 1):
+        depth = ordered[min(len(ordered) - 1, math.ceil(n * len(ordered) / numBuckets) - 1)]
+        boundaries.add(int(math.ceil(depth / multiple) * multiple))
+    return sorted(boundaries)
+
+
+def bucketOf(depth, boundaries):
+    for boundary in boundaries:
+        if depth <= boundary:
+            return boundary
+    return boundaries[-1]
+
+
+class DepthBucketSampler(torch.utils.data.Sampler):
+    """
+    Batch sampler that only batches studies of the same depth bucket, for a DataLoader's
+    `batch_sampler`. Depths come from metadata (`VolumeDataset.depths()`), so no pixels are
+    read to plan the batches.
+    """
+
+    def __init__(self, depths, batchSize, boundaries=None, shuffle=True, dropLast=False, seed=0):
+        self.depths = list(depths)
+        self.batchSize = batchSize
+        self.boundaries = boundaries or depthBoundaries(self.depths)
+        self.shuffle = shuffle
+        self.dropLast = dropLast
+        self.seed = seed
+        self.epoch = 0
+        self.buckets = {}
+        for index, depth in enumerate(self.depths):
+            self.buckets.setdefault(bucketOf(depth, self.boundaries), []).append(index)
+
+    def batches(self):
+        rng = random.Random(self.seed + self.epoch)
+        batches = []
+        for bucket in sorted(self.buckets):
+            indices = list(self.buckets[bucket])
+            if self.shuffle:
+                rng.shuffle(indices)
+            for start in range(0, len(indices), self.batchSize):
+                batch = indices[start:start + self.batchSize]
+                if len(batch) == self.batchSize or not self.dropLast:
+                    batches.append(batch)
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        batches = self.batches()
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        return sum(
+            len(indices) // self.batchSize if self.dropLast else math.ceil(len(indices) / self.batchSize)
+            for indices in self.buckets.values()
+        )
+
+
+def fitDepth(image, depth):
+    """Zero-pad the end of, or center-crop, the depth axis (-3) of `image` to `depth`."""
+    current = image.shape[-3]
+    if current > depth:
+        start = (current - depth) // 2
+        return image[..., start:start + depth, :, :]
+    if current < depth:
+        return F.pad(image, (0, 0, 0, 0, 0, depth - current))
+    return image
+
+
+class BucketCollate:
+    """
+    Collates `(image, label)` samples of one depth bucket into a mini-batch: images are padded
+    or cropped to the bucket depth and padded to the largest rows and columns of the batch.
+    Returns `(images, labels, depths)` with the depth of each study before padding.
+    """
+
+    def __init__(self, boundaries):
+        self.boundaries = boundaries
+
+    def __call__(self, samples):
+        images, labels = zip(*samples)
+        depths = torch.tensor([image.shape[-3] for image in images])
+        depth = bucketOf(int(depths.max()), self.boundaries)
+        rows = max(image.shape[-2] for image in images)
+        columns = max(image.shape[-1] for image in images)
+        batch = torch.stack(
+            [
+                F.pad(fitDepth(image, depth), (0, columns - image.shape[-1], 0, rows - image.shape[-2]))
+                for image in images
+            ]
+        )
+        return batch, torch.stack([torch.as_tensor(label) for label in labels]), depths
+
+
+class BackgroundLoader:
+    """
+    Iterates a DataLoader on a background thread, `maxPrefetch` batches ahead. Starting the
+    next training epoch's loader before validation overlaps its fetch and decode with the
+    validation pass.
+
+    Every iteration runs a fresh pass on its own thread; `start` begins the next one early.
+    A consumer that stops before the end stops the thread at its next batch.
+    """
+
+    END = object()
+
+    def __init__(self, loader, maxPrefetch=2):
+        self.loader = loader
+        self.maxPrefetch = maxPrefetch
+        self.pending = None
+
+    def start(self):
+        if self.pending is None:
+            batches, stop = queue.Queue(maxsize=self.maxPrefetch), threading.Event()
+            thread = threading.Thread(target=self.run, args=(batches, stop), name="background-loader", daemon=True)
+            thread.start()
+            self.pending = (batches, stop)
+        return self
+
+    def run(self, batches, stop):
+        def put(item):
+            # Time out now and then, so a stopped pass does not stay blocked on a full queue.
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for batch in self.loader:
+                if not put(batch):
+                    return
+            put(self.END)
+        except Exception as e:
+            put(e)
+
+    def __iter__(self):
+        self.start()
+        (batches, stop), self.pending = self.pending, None
+        try:
+            while True:
+                item = batches.get()
+                if item is self.END:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            # Free the slot a producer may be waiting for, so it sees the stop promptly.
+            while True:
+                try:
+                    batches.get_nowait()
+                except queue.Empty:
+                    break
+
+    def __len__(self):
+        return len(self.loader)
@@ -0,0 +1,117 @@
+# Series level tags the MetadataIndex keeps, by DICOM keyword.
+INDEXED_SERIES_TAGS = {
+    "SeriesInstanceUID": "seriesInstanceUID",
+    "Modality": "modality",
+    "BodyPartExamined": "bodyPartExamined",
+    "SeriesDescription": "seriesDescription",
+    "SeriesNumber": "seriesNumber",
+}
+
+
+def intTag(dicom, name):
+    try:
+        return int(dicom.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+def sliceLocation(dicom):
+    position = dicom.get("ImagePositionPatient")
+    if isinstance(position, str):
+        position = position.split("\\")
+    try:
+        return float(position[2]) if position else float(dicom["SliceLocation"])
+    except (KeyError, IndexError, TypeError, ValueError):
+        return None
+
+
+def seriesFrames(metadata):
+    """(seriesDicom, frames) per series of `getMetadata` output, with (instanceNumber, sliceLocation, frameId) frames."""
+    series = []
+    for seriesUID, seriesMetadata in metadata["Study"]["Series"].items():
+        seriesDicom = {"SeriesInstanceUID": seriesUID, **seriesMetadata.get("DICOM", {})}
+        frames = []
+        for instance in seriesMetadata.get("Instances", {}).values():
+            instanceDicom = instance.get("DICOM", {})
+            for frame in instance.get("ImageFrames", []):
+                frames.append((intTag(instanceDicom, "InstanceNumber"), sliceLocation(instanceDicom), frame["ID"]))
+        series.append((seriesDicom, frames))
+    return series
+
+
+class FetchPlan:
+    """
+    Selects the frames of an image set to fetch, from its metadata alone, so that frames
+    outside the plan are never downloaded or decoded.
+
+    Frames are put in slice order (ImagePositionPatient, else InstanceNumber, else metadata
+    order), then the plan applies, in this order:
+
+    - seriesFilter: dict of series DICOM keyword -> value (or list of accepted values), or a
+      callable on the series DICOM dict. Without it every series is kept.
+    - sliceRange: (start, stop) slice indices; floats in [0, 1] are fractions of the depth,
+      e.g. (0.25, 0.75) for the middle half.
+    - stride: keep every `stride`-th slice.
+    - targetDepth: pick this many slices, each the nearest to evenly spaced positions over
+      the selected range (slices repeat when the series is shorter).
+    """
+
+    def __init__(self, seriesFilter=None, sliceRange=None, stride=1, targetDepth=None):
+        if stride < 1:
+            raise ValueError(f"stride must be at least 1, got {stride}")
+        if targetDepth is not None and targetDepth < 1:
+            raise ValueError(f"targetDepth must be at least 1, got {targetDepth}")
+        self.seriesFilter = seriesFilter
+        self.sliceRange = sliceRange
+        self.stride = stride
+        self.targetDepth = targetDepth
+
+    def __repr__(self):
+        return (
+            f"FetchPlan(seriesFilter={self.seriesFilter!r}, sliceRange={self.sliceRange!r}, "
+            f"stride={self.stride}, targetDepth={self.targetDepth})"
+        )
+
+    def matchesSeries(self, seriesDicom):
+        if self.seriesFilter is None:
+            return True
+        if callable(self.seriesFilter):
+            return bool(self.seriesFilter(seriesDicom))
+        for keyword, accepted in self.seriesFilter.items():
+            accepted = accepted if isinstance(accepted, (list, tuple, set)) else [accepted]
+            if seriesDicom.get(keyword) not in accepted and str(seriesDicom.get(keyword)) not in map(str, accepted):
+                return False
+        return True
+
+    def sliceIndices(self, depth):
+        start, stop = 0, depth
+        if self.sliceRange is not None:
+            start, stop = (
+                int(round(v * depth)) if isinstance(v, float) and 0.0 <= v <= 1.0 else int(v) for v in self.sliceRange
+            )
+            start, stop = max(start, 0), min(stop, depth)
+        indices = list(range(start, stop, self.stride))
+        if self.targetDepth is not None and indices:
+            scale = (len(indices) - 1) / max(self.targetDepth - 1, 1)
+            indices = [indices[int(round(n * scale))] for n in range(self.targetDepth)]
+        return indices
+
+    def select(self, series):
+        """
+        Args:
+            series (list): (seriesDicom, frames) per series in metadata order, where frames are
+                           (instanceNumber, sliceLocation, frameId) tuples in metadata order.
+
+        Returns:
+            list: Frame IDs to fetch, in slice order.
+        """
+        frames = [frame for seriesDicom, candidates in series if self.matchesSeries(seriesDicom) for frame in candidates]
+        if frames and all(f[1] is not None for f in frames):
+            frames = sorted(frames, key=lambda f: f[1])
+        elif frames and all(f[0] is not None for f in frames):
+            frames = sorted(frames, key=lambda f: f[0])
+        return [frames[i][2] for i in self.sliceIndices(len(frames))]
+
+    def frameIds(self, metadata):
+        """Frame IDs to fetch, from the metadata returned by `MedicalImaging.getMetadata`."""
+        return self.select(seriesFrames(metadata))
@@ -0,0 +1,386 @@
+import logging
+import os
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def frameKey(datastoreId, imageSetId, imageFrameId):
+    return f"{datastoreId}/{imageSetId}/{imageFrameId}"
+
+
+class FrameCache(ABC):
+    """
+    Shared tier for encoded image frames, consulted by `MedicalImaging.getFramePixels` before
+    calling the service. Frames are cached as returned by `get_image_frame`, so each node
+    still decodes at the resolution it asks for.
+
+    `getOrFetch` coalesces concurrent misses for the same frame: across the threads of a
+    process, and across nodes through the shared tier, so only one of them calls `fetch`.
+    Subclasses implement the tier's `get` and `put`.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.lock = threading.Lock()
+        self.inflight = {}
+
+    @abstractmethod
+    def get(self, key, claim):
+        """Cached bytes, or None. With `claim`, None also means this caller owns the fetch of `key`."""
+
+    @abstractmethod
+    def put(self, key, data):
+        """Store the bytes of `key` and end a claim on it."""
+
+    def release(self, key):
+        """Give up a claim without storing, e.g. after a failed fetch."""
+
+    def getOrFetch(self, key, fetch):
+        with self.lock:
+            event = self.inflight.get(key)
+            owner = event is None
+            if owner:
+                event = self.inflight[key] = threading.Event()
+        if not owner:
+            event.wait()
+            with self.lock:
+                self.waits += 1
+        try:
+            data = self.get(key, claim=True)
+            if data is not None:
+                with self.lock:
+                    self.hits += 1
+                return data
+            with self.lock:
+                self.misses += 1
+            try:
+                data = fetch()
+            except Exception:
+                self.release(key)
+                raise
+            self.put(key, data)
+            return data
+        finally:
+            if owner:
+                with self.lock:
+                    self.inflight.pop(key, None)
+                event.set()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "waits": self.waits}
+
+
+class SharedDirectoryCache(FrameCache):
+    """
+    Frames as files on a filesystem all nodes mount (EFS, FSx for Lustre). A node that misses
+    creates `<frame>.lock` exclusively and fetches; the others wait for the frame to appear,
+    and take the fetch over if the lock gets older than `staleSeconds`.
+
+    Beyond `maxBytes` the least recently used frames are deleted, by modification time, which
+    hits refresh. Every node rescans the directory in the background once its own writes may
+    have filled it, and at least every `scanInterval` seconds to see the other nodes' writes,
+    and evicts down to 90% of `maxBytes`.
+    """
+
+    def __init__(self, path, maxBytes=64 * 1024**3, staleSeconds=60.0, pollInterval=0.05, scanInterval=60.0):
+        super().__init__()
+        self.path = path
+        self.maxBytes = maxBytes
+        self.staleSeconds = staleSeconds
+        self.pollInterval = pollInterval
+        self.scanInterval = scanInterval
+        self.scannedBytes = 0
+        self.writtenBytes = 0
+        self.scannedAt = 0.0
+        self.evictions = 0
+        self.evictLock = threading.Lock()
+
+    def framePath(self, key):
+        return os.path.join(self.path, *key.split("/"))
+
+    def read(self, path):
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            # Mark the frame as recently used, at most once per scan interval to spare metadata writes.
+            if time.time() - os.path.getmtime(path) > self.scanInterval:
+                os.utime(path)
+        except FileNotFoundError:
+            pass
+        return data
+
+    def get(self, key, claim):
+        path = self.framePath(key)
+        data = self.read(path)
+        if data is not None or not claim:
+            return data
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        lockPath = f"{path}.lock"
+        while True:
+            try:
+                os.close(os.open(lockPath, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                # Written between our first read and taking the lock.
+                data = self.read(path)
+                if data is not None:
+                    os.remove(lockPath)
+                return data
+            except FileExistsError:
+                pass
+            with self.lock:
+                self.waits += 1
+            while os.path.exists(lockPath):
+                data = self.read(path)
+                if data is not None:
+                    return data
+                try:
+                    if time.time() - os.path.getmtime(lockPath) > self.staleSeconds:
+                        logging.warning(f"Taking over the stale fetch of {key}")
+                        os.remove(lockPath)
+                        break
+                except FileNotFoundError:
+                    break
+                time.sleep(self.pollInterval)
+            data = self.read(path)
+            if data is not None:
+                return data
+
+    def put(self, key, data):
+        path = self.framePath(key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        self.release(key)
+        with self.lock:
+            self.writtenBytes += len(data)
+            due = (
+                self.scannedBytes + self.writtenBytes > self.maxBytes
+                or time.time() - self.scannedAt > self.scanInterval
+            )
+        if self.maxBytes and due and self.evictLock.acquire(blocking=False):
+            threading.Thread(target=self.evictInBackground, name="frame-cache-evict", daemon=True).start()
+
+    def release(self, key):
+        try:
+            os.remove(f"{self.framePath(key)}.lock")
+        except FileNotFoundError:
+            pass
+
+    def evictInBackground(self):
+        try:
+            self.evict()
+        except OSError as e:
+            logging.warning(f"Frame cache eviction in {self.path} failed: {e}")
+        finally:
+            self.evictLock.release()
+
+    def evict(self):
+        """Scan the directory and delete the least recently used frames while it holds more than `maxBytes`."""
+        frames = []
+        for root, _, names in os.walk(self.path):
+            for name in names:
+                if name.endswith((".lock", ".tmp")):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                frames.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in frames)
+        evicted = 0
+        if total > self.maxBytes:
+            frames.sort()
+            for _, size, path in frames:
+                if total <= self.maxBytes * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                    evicted += 1
+                except FileNotFoundError:
+                    pass  # evicted by another node
+                total -= size
+        with self.lock:
+            self.scannedBytes, self.writtenBytes, self.scannedAt = total, 0, time.time()
+            self.evictions += evicted
+
+    def stats(self):
+        return {**super().stats(), "evictions": self.evictions}
+
+
+class CacheServer:
+    """
+    Small in-memory frame cache server for a training cluster, e.g. run on the first node.
+
+    `GET /<key>?claim=1` returns the frame, or 404 with `X-Claim: granted` to the first
+    client that misses; later clients asking for the same frame wait until it is stored or
+    the claim expires. `PUT /<key>` stores a frame, `DELETE /<key>` drops a claim. Frames are
+    evicted in LRU order beyond `maxBytes`.
+    """
+
+    def __init__(self, host="0.0.0.0", port=8470, maxBytes=8 * 1024**3, claimTimeout=60.0):
+        self.maxBytes = maxBytes
+        self.claimTimeout = claimTimeout
+        self.frames = OrderedDict()
+        self.bytes = 0
+        self.claims = {}
+        self.condition = threading.Condition()
+        self.server = ThreadingHTTPServer((host, port), self.handlerClass())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{'127.0.0.1' if host == '0.0.0.0' else host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="frame-cache-server", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def lookup(self, key, claim):
+        """(data, granted) for a GET."""
+        with self.condition:
+            while True:
+                data = self.frames.get(key)
+                if data is not None:
+                    self.frames.move_to_end(key)
+                    return data, False
+                if not claim:
+                    return None, False
+                claimed = self.claims.get(key)
+                if claimed is None or time.time() - claimed > self.claimTimeout:
+                    self.claims[key] = time.time()
+                    return None, True
+                self.condition.wait(timeout=max(0.0, claimed + self.claimTimeout - time.time()))
+
+    def store(self, key, data):
+        with self.condition:
+            if key in self.frames:
+                self.bytes -= len(self.frames.pop(key))
+            self.frames[key] = data
+            self.bytes += len(data)
+            while self.bytes > self.maxBytes and len(self.frames) > 1:
+                self.bytes -= len(self.frames.popitem(last=False)[1])
+            self.claims.pop(key, None)
+            self.condition.notify_all()
+
+    def unclaim(self, key):
+        with self.condition:
+            self.claims.pop(key, None)
+            self.condition.notify_all()
+
+    def handlerClass(self):
+        cache = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def key(self):
+                url = urllib.parse.urlsplit(self.path)
+                return urllib.parse.unquote(url.path.lstrip("/")), urllib.parse.parse_qs(url.query)
+
+            def do_GET(self):
+                key, query = self.key()
+                data, granted = cache.lookup(key, claim=query.get("claim") == ["1"])
+                if data is None:
+                    self.send_response(404)
+                    if granted:
+                        self.send_header("X-Claim", "granted")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_PUT(self):
+                key, _ = self.key()
+                cache.store(key, self.rfile.read(int(self.headers["Content-Length"])))
+                self.send_response(204)
+                self.end_headers()
+
+            def do_DELETE(self):
+                key, _ = self.key()
+                cache.unclaim(key)
+                self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logging.debug(f"frame cache: {format % args}")
+
+        return Handler
+
+
+class HttpFrameCache(FrameCache):
+    """Client of a CacheServer. If the server is unreachable, frames are fetched from the service directly."""
+
+    def __init__(self, url, timeout=120.0):
+        super().__init__()
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.errors = 0
+
+    def request(self, method, key, data=None, query=""):
+        url = f"{self.url}/{urllib.parse.quote(key)}{query}"
+        return urllib.request.urlopen(urllib.request.Request(url, data=data, method=method), timeout=self.timeout)
+
+    def get(self, key, claim):
+        try:
+            with self.request("GET", key, query="?claim=1" if claim else "") as response:
+                return response.read()
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return None
+            raise
+        except OSError as e:
+            with self.lock:
+                self.errors += 1
+            logging.warning(f"Frame cache {self.url} unavailable: {e}")
+            return None
+
+    def put(self, key, data):
+        try:
+            self.request("PUT", key, data=data).close()
+        except OSError as e:
+            with self.lock:
+                self.errors += 1
+            logging.warning(f"Frame cache {self.url} unavailable: {e}")
+
+    def release(self, key):
+        try:
+            self.request("DELETE", key).close()
+        except OSError:
+            pass
+
+    def stats(self):
+        return {**super().stats(), "errors": self.errors}
+
+
+def frameCacheFromEnv():
+    """
+    `FRAME_CACHE_URL` (http://host:port of a CacheServer) or `FRAME_CACHE_DIR` (shared directory,
+    limited to `FRAME_CACHE_MAX_BYTES`, 64 GiB by default), else None.
+    """
+    if os.getenv("FRAME_CACHE_URL"):
+        return HttpFrameCache(os.environ["FRAME_CACHE_URL"])
+    if os.getenv("FRAME_CACHE_DIR"):
+        maxBytes = int(os.getenv("FRAME_CACHE_MAX_BYTES", str(64 * 1024**3)))
+        return SharedDirectoryCache(os.environ["FRAME_CACHE_DIR"], maxBytes=maxBytes)
+    return None
@@ -0,0 +1,105 @@
+import io
+import math
+import struct
+
+import numpy as np
+from openjpeg import decode
+from PIL import Image, ImageFile
+
+SOC = b"\xff\x4f"
+SIZ = 0xFF51
+COD = 0xFF52
+SOT = 0xFF90
+SOD = 0xFF93
+HEADER_BYTES = 1024
+
+
+def parseCodestreamHeader(data):
+    """
+    Image size, sample precision and signedness, and decomposition levels from the main
+    header of a JPEG 2000 / HTJ2K codestream, or None if `data` does not start with one.
+    """
+    if data[:2] != SOC:
+        return None
+    header = {"width": None, "height": None, "precision": None, "signed": None, "levels": None}
+    offset = 2
+    while offset + 4 <= len(data):
+        marker, length = struct.unpack(">HH", data[offset:offset + 4])
+        if marker == SIZ and offset + 41 <= len(data):
+            xsiz, ysiz, xosiz, yosiz = struct.unpack(">IIII", data[offset + 6:offset + 22])
+            header["width"], header["height"] = xsiz - xosiz, ysiz - yosiz
+            # Ssiz of the first component: sign bit and precision - 1.
+            ssiz = data[offset + 40]
+            header["precision"], header["signed"] = (ssiz & 0x7F) + 1, bool(ssiz & 0x80)
+        elif marker == COD and offset + 10 <= len(data):
+            header["levels"] = data[offset + 9]
+        elif marker in (SOT, SOD):
+            break
+        offset += 2 + length
+    return header
+
+
+def resolutionLevelFor(header, targetSize):
+    """Highest resolution level (halvings) whose image still covers `targetSize` pixels on its longer side."""
+    if not targetSize or header is None or not header["width"]:
+        return 0
+    level = int(math.floor(math.log2(max(header["width"], header["height"]) / targetSize)))
+    return max(0, min(level, header["levels"] or 0))
+
+
+def decodeReduced(data, resolutionLevel, header):
+    """
+    Decode only the wavelet levels up to 1/2**resolutionLevel of the width and height.
+
+    pylibjpeg-openjpeg always decodes the full resolution, so this goes through Pillow (11 or
+    later), whose JPEG 2000 decoder passes the level to OpenJPEG as `reduce`. Pillow scales
+    samples to fill 8 or 16 bits and offsets signed ones to unsigned; both are undone to
+    return the stored values.
+    """
+    image = Image.open(io.BytesIO(data))
+    # Set up the tile as Jpeg2KImageFile.load does for `reduce`, but with OpenJPEG's
+    # ceil(side / 2**level) size; Pillow rounds, which fails from level 2 on odd sizes.
+    scale = 2**resolutionLevel
+    size = (math.ceil(image.size[0] / scale), math.ceil(image.size[1] / scale))
+    tile = image.tile[0]
+    image._size = size
+    image.tile = [tile._replace(extents=(0, 0) + size, args=(tile.args[0], resolutionLevel, image.layers, *tile.args[3:]))]
+    ImageFile.ImageFile.load(image)
+    pixels = np.array(image)
+    if pixels.dtype in (np.uint8, np.uint16) and header["precision"] <= pixels.dtype.itemsize * 8:
+        pixels = pixels >> (pixels.dtype.itemsize * 8 - header["precision"])
+        if header["signed"]:
+            signedType = np.int8 if pixels.dtype == np.uint8 else np.int16
+            pixels = (pixels.astype(np.int32) - (1 << (header["precision"] - 1))).astype(signedType)
+    return pixels
+
+
+def decodeFrame(data, resolutionLevel=0):
+    """Decode a frame at 1/2**resolutionLevel of its width and height (ceil for odd sizes)."""
+    if resolutionLevel <= 0:
+        return decode(io.BytesIO(data))
+    header = parseCodestreamHeader(data)
+    if header is None or header["precision"] is None:
+        raise ValueError("Reduced-resolution decoding needs a JPEG 2000 / HTJ2K codestream")
+    return decodeReduced(data, min(resolutionLevel, header["levels"] or 0), header)
+
+
+def readFrame(blob, resolutionLevel=0, targetSize=None):
+    """
+    Read and decode an image frame blob at reduced resolution.
+
+    Only the wavelet levels down to the requested resolution are decoded, so decode time
+    falls with every level. The whole codestream is always read.
+
+    Returns:
+        (numpy.ndarray, int, int): Pixels, resolution level used and bytes read.
+    """
+    data = blob.read()
+    header = parseCodestreamHeader(data[:HEADER_BYTES])
+    if targetSize:
+        resolutionLevel = max(resolutionLevel, resolutionLevelFor(header, targetSize))
+    if header is None:
+        # Not a bare codestream (e.g. a JP2 file): decoded at full resolution.
+        return decode(io.BytesIO(data)), 0, len(data)
+    resolutionLevel = min(resolutionLevel, header["levels"] or 0)
+    return decodeFrame(data, resolutionLevel), resolutionLevel, len(data)
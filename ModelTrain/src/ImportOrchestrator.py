@@ -0,0 +1,246 @@
+import hashlib
+import json
+import logging
+import random
+import time
+
+import boto3
+from botocore.exceptions import ClientError
+
+# AWS HealthImaging import job limits; check the service quotas of your account and region.
+MAX_FILES_PER_JOB = 5000
+MAX_BYTES_PER_JOB = 10 * 1024**3
+MAX_CONCURRENT_JOBS = 20
+
+RETRYABLE_ERRORS = ("ThrottlingException", "ServiceQuotaExceededException", "TooManyRequestsException")
+
+
+class ImportJob:
+    def __init__(self, inputS3Uri, outputS3Uri, clientToken, files, bytes):
+        self.inputS3Uri = inputS3Uri
+        self.outputS3Uri = outputS3Uri
+        self.clientToken = clientToken
+        self.files = files
+        self.bytes = bytes
+        self.jobId = None
+        self.status = "PENDING"
+        self.imageSets = 0
+        self.failures = 0
+        self.attempts = 0
+        self.nextActionTime = 0.0
+        self.pollInterval = 0.0
+
+    def summary(self):
+        return {
+            "inputS3Uri": self.inputS3Uri,
+            "jobId": self.jobId,
+            "status": self.status,
+            "files": self.files,
+            "imageSets": self.imageSets,
+            "failures": self.failures,
+        }
+
+
+class ImageSetIndex:
+    """imageSetId -> number of imported instances, with the import job each came from, appended to an optional ndjson file."""
+
+    def __init__(self, path=None):
+        self.imageSetIds = {}
+        self.jobIds = {}
+        self.path = path
+
+    def add(self, imageSetId, jobId):
+        self.imageSetIds[imageSetId] = self.imageSetIds.get(imageSetId, 0) + 1
+        self.jobIds[imageSetId] = jobId
+
+    def flush(self, imageSetIds):
+        if self.path is None:
+            return
+        with open(self.path, "a") as f:
+            for imageSetId in imageSetIds:
+                f.write(json.dumps({"imageSetId": imageSetId, "jobId": self.jobIds[imageSetId]}) + "\n")
+
+
+class ImportOrchestrator:
+    """
+    Imports a large S3 prefix into a datastore as many concurrent import jobs.
+
+    The prefix is split into the fewest sub-prefixes that each fit the per-job file and size
+    limits. Jobs start as slots free up under the concurrency limit, one scheduler loop polls
+    every running job with exponential backoff, and the success.ndjson of each finished job is
+    streamed into an ImageSetIndex right away.
+    """
+
+    def __init__(
+        self,
+        medicalimaging,
+        s3=None,
+        maxFilesPerJob=MAX_FILES_PER_JOB,
+        maxBytesPerJob=MAX_BYTES_PER_JOB,
+        maxConcurrentJobs=MAX_CONCURRENT_JOBS,
+        minPollInterval=5.0,
+        maxPollInterval=60.0,
+    ):
+        self.medicalimaging = medicalimaging
+        self.s3 = s3 or boto3.client("s3")
+        self.maxFilesPerJob = maxFilesPerJob
+        self.maxBytesPerJob = maxBytesPerJob
+        self.maxConcurrentJobs = maxConcurrentJobs
+        self.minPollInterval = minPollInterval
+        self.maxPollInterval = maxPollInterval
+
+    @staticmethod
+    def splitS3Uri(uri):
+        bucket, _, key = uri.replace("s3://", "").partition("/")
+        return bucket, key
+
+    def listObjects(self, inputS3Uri):
+        bucket, prefix = self.splitS3Uri(inputS3Uri)
+        for page in self.s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                if not obj["Key"].endswith("/"):
+                    yield obj["Key"][len(prefix):], obj["Size"]
+
+    def splitPrefix(self, prefix, objects):
+        """
+        Cover `objects` (relative key, size) under `prefix` with the fewest prefixes that fit the job limits.
+        A job imports everything under its prefix, so only whole sub-folders can be split off.
+        """
+        if len(objects) <= self.maxFilesPerJob and sum(size for _, size in objects) <= self.maxBytesPerJob:
+            return [(prefix, objects)]
+        children, direct = {}, []
+        for key, size in objects:
+            folder, sep, rest = key.partition("/")
+            if sep:
+                children.setdefault(folder, []).append((rest, size))
+            else:
+                direct.append((key, size))
+        if direct:
+            raise ValueError(
+                f"{prefix} holds {len(direct)} files next to its sub-folders and exceeds the import job limits; "
+                "move its files into sub-folders of at most "
+                f"{self.maxFilesPerJob} files and {self.maxBytesPerJob} bytes"
+            )
+        return [part for folder, items in sorted(children.items()) for part in self.splitPrefix(f"{prefix}{folder}/", items)]
+
+    def planImportJobs(self, inputS3Uri, outputS3Uri, runId=""):
+        """
+        Split `inputS3Uri` into import jobs. Each job writes to its own folder under `outputS3Uri` and
+        gets a client token derived from its input, output and `runId`, so re-running the same
+        plan does not start duplicate jobs while different jobs never share a token.
+        """
+        inputS3Uri = inputS3Uri.rstrip("/") + "/"
+        outputS3Uri = outputS3Uri.rstrip("/") + "/"
+        objects = list(self.listObjects(inputS3Uri))
+        if not objects:
+            return []
+        jobs = []
+        for n, (prefix, items) in enumerate(self.splitPrefix(inputS3Uri, objects)):
+            jobOutput = f"{outputS3Uri}job-{n:05d}/"
+            token = hashlib.sha256(f"{prefix}|{jobOutput}|{runId}".encode()).hexdigest()[:64]
+            jobs.append(ImportJob(prefix, jobOutput, token, len(items), sum(size for _, size in items)))
+        logging.info(f"Planned {len(jobs)} import jobs for {len(objects)} files under {inputS3Uri}")
+        return jobs
+
+    def backoff(self, job):
+        job.attempts += 1
+        delay = min(self.maxPollInterval, self.minPollInterval * 2 ** min(job.attempts, 6))
+        job.nextActionTime = time.time() + delay * random.uniform(0.5, 1.0)
+
+    def startJob(self, datastoreId, roleArn, job):
+        try:
+            response = self.medicalimaging.startImportJob(
+                datastoreId, roleArn, job.inputS3Uri, job.outputS3Uri,
+                clientToken=job.clientToken, jobName=job.clientToken[:16],
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] in RETRYABLE_ERRORS:
+                logging.debug(f"Start of {job.inputS3Uri} throttled, retrying: {e}")
+                self.backoff(job)
+                return False
+            raise
+        job.jobId = response["jobId"]
+        job.status = "SUBMITTED"
+        job.attempts = 0
+        job.pollInterval = self.minPollInterval
+        job.nextActionTime = time.time() + job.pollInterval
+        logging.info(f"Started import job {job.jobId} for {job.inputS3Uri} ({job.files} files)")
+        return True
+
+    def pollJob(self, datastoreId, job):
+        try:
+            status = self.medicalimaging.getImportJob(datastoreId, job.jobId)["jobProperties"]["jobStatus"]
+        except ClientError as e:
+            if e.response["Error"]["Code"] in RETRYABLE_ERRORS:
+                self.backoff(job)
+                return
+            raise
+        job.status = status
+        job.pollInterval = min(self.maxPollInterval, job.pollInterval * 1.5)
+        job.nextActionTime = time.time() + job.pollInterval
+
+    def jobResultPrefix(self, datastoreId, job):
+        return f"{job.outputS3Uri}{datastoreId}-DicomImport-{job.jobId}/"
+
+    def collectResults(self, datastoreId, job, index):
+        """Stream the success.ndjson of a finished job into `index` and count its failures."""
+        bucket, prefix = self.splitS3Uri(self.jobResultPrefix(datastoreId, job))
+        added = []
+        try:
+            body = self.s3.get_object(Bucket=bucket, Key=f"{prefix}SUCCESS/success.ndjson")["Body"]
+            for line in body.iter_lines():
+                if line:
+                    imageSetId = json.loads(line)["importResponse"]["imageSetId"]
+                    if imageSetId not in index.imageSetIds:
+                        added.append(imageSetId)
+                    index.add(imageSetId, job.jobId)
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+                raise
+        index.flush(added)
+        job.imageSets = len(added)
+        try:
+            body = self.s3.get_object(Bucket=bucket, Key=f"{prefix}FAILURE/failure.ndjson")["Body"]
+            job.failures = sum(1 for line in body.iter_lines() if line)
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+                raise
+
+    def run(self, datastoreId, roleArn, inputS3Uri, outputS3Uri, index=None, runId=""):
+        """
+        Import everything under `inputS3Uri` and return the index of imported image sets with the job summaries.
+        """
+        index = index or ImageSetIndex()
+        jobs = self.planImportJobs(inputS3Uri, outputS3Uri, runId)
+        pending = list(jobs)
+        running = []
+        start_time = time.time()
+        while pending or running:
+            now = time.time()
+            while pending and len(running) < self.maxConcurrentJobs and pending[0].nextActionTime <= now:
+                job = pending.pop(0)
+                if self.startJob(datastoreId, roleArn, job):
+                    running.append(job)
+                else:
+                    # Throttled: hold back all starts until this job's backoff expires.
+                    pending.insert(0, job)
+                    break
+            for job in [j for j in running if j.nextActionTime <= now]:
+                self.pollJob(datastoreId, job)
+                if job.status in ("COMPLETED", "FAILED"):
+                    running.remove(job)
+                    if job.status == "COMPLETED":
+                        self.collectResults(datastoreId, job, index)
+                    logging.info(
+                        f"Import job {job.jobId} {job.status}: {job.imageSets} image sets, {job.failures} failures; "
+                        f"{len([j for j in jobs if j.status in ('COMPLETED', 'FAILED')])}/{len(jobs)} jobs done"
+                    )
+            upcoming = [j.nextActionTime for j in running]
+            if pending and len(running) < self.maxConcurrentJobs:
+                upcoming.append(pending[0].nextActionTime)
+            if upcoming:
+                time.sleep(max(0.0, min(upcoming) - time.time()))
+        logging.info(
+            f"Imported {len(index.imageSetIds)} image sets with {len(jobs)} jobs in {time.time() - start_time:.0f}s"
+        )
+        return index, [job.summary() for job in jobs]
@@ -0,0 +1,190 @@
+import math
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .FetchPlan import FetchPlan, intTag
+from .FrameDecode import decodeFrame
+from .Normalize import rescaleFromMetadata
+
+
+def pixelDtype(dicom):
+    bits = intTag(dicom, "BitsAllocated") or 16
+    signed = intTag(dicom, "PixelRepresentation") == 1
+    if bits <= 8:
+        return np.dtype(np.int8 if signed else np.uint8)
+    if bits <= 16:
+        return np.dtype(np.int16 if signed else np.uint16)
+    return np.dtype(np.int32 if signed else np.uint32)
+
+
+class LazyVolume:
+    """
+    An image set as a read-only (depth, rows, columns) array that fetches and decodes only the
+    slices an index touches.
+
+    Shape and dtype come from the metadata, and the slices are the frames a FetchPlan selects,
+    in slice order. Decoded slices are kept in an LRU of `cacheSlices` slices; with
+    `cacheBlobBytes` the encoded frames are also kept, so a slice evicted from the decoded LRU
+    is decoded again without a service call.
+
+        volume = LazyVolume(medicalimaging, datastoreId, imageSetId)
+        patch = volume[40:72, 100:196, 100:196]
+    """
+
+    def __init__(
+        self,
+        medicalimaging,
+        datastoreId,
+        imageSetId,
+        metadata=None,
+        fetchPlan=None,
+        resolutionLevel=0,
+        cacheSlices=64,
+        cacheBlobBytes=256 * 1024**2,
+        maxWorkers=8,
+    ):
+        self.medicalimaging = medicalimaging
+        self.datastoreId = datastoreId
+        self.imageSetId = imageSetId
+        self.resolutionLevel = resolutionLevel
+        self.cacheSlices = cacheSlices
+        self.cacheBlobBytes = cacheBlobBytes
+        self.maxWorkers = maxWorkers
+        if metadata is None:
+            metadata = medicalimaging.getMetadata(datastoreId, imageSetId)
+        self.frameIds = (fetchPlan or FetchPlan()).frameIds(metadata)
+        instances = {
+            frame["ID"]: {**series.get("DICOM", {}), **instance.get("DICOM", {})}
+            for series in metadata["Study"]["Series"].values()
+            for instance in series.get("Instances", {}).values()
+            for frame in instance.get("ImageFrames", [])
+        }
+        first = instances[self.frameIds[0]] if self.frameIds else {}
+        rows, columns = intTag(first, "Rows"), intTag(first, "Columns")
+        if rows and columns:
+            scale = 2**resolutionLevel
+            self._frameShape = (math.ceil(rows / scale), math.ceil(columns / scale))
+        else:
+            self._frameShape = None
+        self._dtype = pixelDtype(first)
+        # Pixels stay native; apply these on the training device, see Normalize.toFloatOnDevice.
+        self.rescaleSlope, self.rescaleIntercept = rescaleFromMetadata(first)
+        self.slices = OrderedDict()
+        self.blobs = OrderedDict()
+        self.blobBytes = 0
+        self.fetches = 0
+        self.decodes = 0
+        self.lock = threading.Lock()
+
+    @property
+    def frameShape(self):
+        if self._frameShape is None:
+            # No Rows/Columns in the metadata: the first slice tells.
+            self._frameShape = self.slice(0).shape
+        return self._frameShape
+
+    @property
+    def shape(self):
+        return (len(self.frameIds), *self.frameShape)
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def ndim(self):
+        return 3
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return len(self.frameIds)
+
+    def __repr__(self):
+        return f"LazyVolume({self.imageSetId}, shape={self.shape}, dtype={self.dtype}, cached={len(self.slices)})"
+
+    def blob(self, index):
+        frameId = self.frameIds[index]
+        with self.lock:
+            data = self.blobs.get(frameId)
+            if data is not None:
+                self.blobs.move_to_end(frameId)
+                return data
+        data = self.medicalimaging.getFrameBytes(self.datastoreId, self.imageSetId, frameId)
+        with self.lock:
+            self.fetches += 1
+            if self.cacheBlobBytes and len(data) <= self.cacheBlobBytes and frameId not in self.blobs:
+                self.blobs[frameId] = data
+                self.blobBytes += len(data)
+                while self.blobBytes > self.cacheBlobBytes:
+                    self.blobBytes -= len(self.blobs.popitem(last=False)[1])
+        return data
+
+    def slice(self, index):
+        """Decoded slice `index`, from the LRU or fetched and decoded."""
+        with self.lock:
+            pixels = self.slices.get(index)
+            if pixels is not None:
+                self.slices.move_to_end(index)
+                return pixels
+        pixels = decodeFrame(self.blob(index), self.resolutionLevel)
+        if pixels.dtype != self._dtype:
+            self._dtype = pixels.dtype
+        pixels.flags.writeable = False
+        with self.lock:
+            self.decodes += 1
+            if self.cacheSlices:
+                self.slices[index] = pixels
+                while len(self.slices) > self.cacheSlices:
+                    self.slices.popitem(last=False)
+        return pixels
+
+    def depthIndices(self, key):
+        depth = len(self.frameIds)
+        if isinstance(key, (int, np.integer)):
+            index = int(key) + depth if key < 0 else int(key)
+            if not 0 <= index < depth:
+                raise IndexError(f"index {key} is out of bounds for depth {depth}")
+            return [index], True
+        if isinstance(key, slice):
+            return list(range(*key.indices(depth))), False
+        indices = np.arange(depth)[np.asarray(key)]
+        return [int(i) for i in np.atleast_1d(indices)], False
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        if any(k is Ellipsis or k is None for k in key):
+            raise IndexError("LazyVolume supports integer, slice and array indices only")
+        indices, scalar = self.depthIndices(key[0])
+        rest = key[1:]
+        missing = [i for i in dict.fromkeys(indices) if i not in self.slices]
+        if len(missing) > 1:
+            # Fetch the missing slices concurrently; `fetched` holds them even if the LRU is smaller.
+            with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+                fetched = dict(zip(missing, executor.map(self.slice, missing)))
+        else:
+            fetched = {}
+        slices = [fetched[i] if i in fetched else self.slice(i) for i in indices]
+        if scalar:
+            return slices[0][rest] if rest else slices[0]
+        if not slices:
+            return np.empty((0, *self.frameShape), dtype=self.dtype)[(slice(None), *rest)]
+        return np.stack([s[rest] if rest else s for s in slices])
+
+    def __array__(self, dtype=None):
+        volume = self[:]
+        return volume.astype(dtype) if dtype is not None else volume
+
+    def stats(self):
+        return {
+            "slices": len(self.frameIds),
+            "fetches": self.fetches,
+            "decodes": self.decodes,
+            "cachedSlices": len(self.slices),
+            "cachedBlobBytes": self.blobBytes,
+        }
@@ -0,0 +1,270 @@
+import hashlib
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+
+from .FetchPlan import INDEXED_SERIES_TAGS, intTag, sliceLocation
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS imagesets (
+    imageSetId TEXT PRIMARY KEY,
+    datastoreId TEXT NOT NULL,
+    version TEXT,
+    updatedAt TEXT,
+    patientId TEXT,
+    patientName TEXT,
+    patientSex TEXT,
+    patientBirthDate TEXT,
+    studyInstanceUID TEXT,
+    studyDate TEXT,
+    studyDescription TEXT,
+    accessionNumber TEXT,
+    numberOfSeries INTEGER,
+    numberOfFrames INTEGER,
+    indexedAt REAL
+);
+CREATE TABLE IF NOT EXISTS series (
+    imageSetId TEXT NOT NULL,
+    seriesInstanceUID TEXT NOT NULL,
+    modality TEXT,
+    bodyPartExamined TEXT,
+    seriesDescription TEXT,
+    seriesNumber INTEGER,
+    numberOfInstances INTEGER,
+    numberOfFrames INTEGER,
+    PRIMARY KEY (imageSetId, seriesInstanceUID)
+);
+CREATE TABLE IF NOT EXISTS frames (
+    imageSetId TEXT NOT NULL,
+    seriesInstanceUID TEXT NOT NULL,
+    sopInstanceUID TEXT NOT NULL,
+    instanceNumber INTEGER,
+    sliceLocation REAL,
+    position INTEGER NOT NULL,
+    frameId TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS imagesets_study ON imagesets (studyInstanceUID);
+CREATE INDEX IF NOT EXISTS imagesets_patient ON imagesets (patientId);
+CREATE INDEX IF NOT EXISTS series_modality ON series (modality, bodyPartExamined);
+CREATE INDEX IF NOT EXISTS series_uid ON series (seriesInstanceUID);
+CREATE INDEX IF NOT EXISTS frames_imageset ON frames (imageSetId, position);
+"""
+
+
+def tag(dicom, name):
+    value = dicom.get(name)
+    if isinstance(value, dict):
+        # Person names may be stored as component groups.
+        value = value.get("Alphabetic") or next(iter(value.values()), None)
+    return value
+
+
+class MetadataIndex:
+    """
+    Local SQLite index of the patient, study, series and frame level metadata of the image sets
+    in a datastore.
+
+    `refresh` harvests `getMetadata` concurrently, and only for image sets that are new or
+    whose version changed since the last refresh. Cohort selection then runs as local queries
+    instead of one API call per image set.
+    """
+
+    def __init__(self, medicalimaging, path="metadata_index.db", maxWorkers=16):
+        self.medicalimaging = medicalimaging
+        self.path = path
+        self.maxWorkers = maxWorkers
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def indexedVersions(self, datastoreId):
+        rows = self.db.execute("SELECT imageSetId, version FROM imagesets WHERE datastoreId = ?", (datastoreId,))
+        return dict(rows.fetchall())
+
+    def rows(self, datastoreId, imageSetId, summary, metadata):
+        patient = metadata.get("Patient", {}).get("DICOM", {})
+        study = metadata.get("Study", {})
+        studyDicom = study.get("DICOM", {})
+        seriesRows, frameRows = [], []
+        position = 0
+        for seriesUID, series in study.get("Series", {}).items():
+            seriesDicom = series.get("DICOM", {})
+            instances = series.get("Instances", {})
+            seriesFrames = 0
+            for sopUID, instance in instances.items():
+                instanceDicom = instance.get("DICOM", {})
+                for frame in instance.get("ImageFrames", []):
+                    frameRows.append(
+                        (imageSetId, seriesUID, sopUID, intTag(instanceDicom, "InstanceNumber"),
+                         sliceLocation(instanceDicom), position, frame["ID"])
+                    )
+                    position += 1
+                    seriesFrames += 1
+            seriesRows.append(
+                (imageSetId, seriesUID, tag(seriesDicom, "Modality"), tag(seriesDicom, "BodyPartExamined"),
+                 tag(seriesDicom, "SeriesDescription"), intTag(seriesDicom, "SeriesNumber"), len(instances), seriesFrames)
+            )
+        imageSetRow = (
+            imageSetId, datastoreId, str(summary.get("version")), str(summary.get("updatedAt", "")),
+            tag(patient, "PatientID"), tag(patient, "PatientName"), tag(patient, "PatientSex"),
+            tag(patient, "PatientBirthDate"), tag(studyDicom, "StudyInstanceUID"), tag(studyDicom, "StudyDate"),
+            tag(studyDicom, "StudyDescription"), tag(studyDicom, "AccessionNumber"),
+            len(seriesRows), position, time.time(),
+        )
+        return imageSetRow, seriesRows, frameRows
+
+    def store(self, imageSetRow, seriesRows, frameRows):
+        imageSetId = imageSetRow[0]
+        with self.db:
+            self.remove([imageSetId])
+            self.db.execute(f"INSERT INTO imagesets VALUES ({','.join('?' * len(imageSetRow))})", imageSetRow)
+            self.db.executemany("INSERT INTO series VALUES (?,?,?,?,?,?,?,?)", seriesRows)
+            self.db.executemany("INSERT INTO frames VALUES (?,?,?,?,?,?,?)", frameRows)
+
+    def remove(self, imageSetIds):
+        for table in ("frames", "series", "imagesets"):
+            self.db.executemany(f"DELETE FROM {table} WHERE imageSetId = ?", [(i,) for i in imageSetIds])
+
+    def refresh(self, datastoreId, imageSetIds=None, prune=False):
+        """
+        Index the image sets of `datastoreId`, or only `imageSetIds`, that are new or changed.
+
+        Args:
+            datastoreId (str): Datastore to index.
+            imageSetIds (iterable): Limit the refresh to these image sets; None for the whole datastore.
+            prune (bool): Drop indexed image sets that are no longer in the datastore.
+
+        Returns:
+            dict: Number of image sets indexed, unchanged, removed and failed.
+        """
+        start_time = time.time()
+        summaries = {s["imageSetId"]: s for s in self.medicalimaging.searchImageSets(datastoreId)}
+        indexed = self.indexedVersions(datastoreId)
+        wanted = summaries.keys() if imageSetIds is None else [i for i in imageSetIds if i in summaries]
+        stale = [i for i in wanted if i not in indexed or indexed[i] != str(summaries[i].get("version"))]
+        removed = [i for i in indexed if i not in summaries] if prune else []
+        failed = 0
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+            futures = {executor.submit(self.medicalimaging.getMetadata, datastoreId, i): i for i in stale}
+            for future in as_completed(futures):
+                imageSetId = futures[future]
+                try:
+                    metadata = future.result()
+                except Exception as e:
+                    logging.warning(f"Metadata of {imageSetId} not indexed: {e}")
+                    failed += 1
+                    continue
+                # sqlite connections stay on this thread; the workers only fetch.
+                self.store(*self.rows(datastoreId, imageSetId, summaries[imageSetId], metadata))
+        if removed:
+            with self.db:
+                self.remove(removed)
+        result = {
+            "indexed": len(stale) - failed,
+            "unchanged": len(wanted) - len(stale),
+            "removed": len(removed),
+            "failed": failed,
+        }
+        end_time = time.time()
+        logging.info(f"Metadata index refresh {result} in {self.medicalimaging.stopwatch(start_time, end_time):.0f} ms")
+        return result
+
+    def query(
+        self,
+        datastoreId=None,
+        modality=None,
+        bodyPart=None,
+        studyInstanceUIDs=None,
+        seriesInstanceUIDs=None,
+        patientIds=None,
+        imageSetIds=None,
+        minFrames=None,
+        maxFrames=None,
+    ):
+        """
+        One row per matching series with its image set, patient and study columns. UID lists
+        of any length are matched through temporary tables, so a cohort of thousands of UIDs is
+        a single indexed join.
+        """
+        where, params, joins = [], [], []
+        for column, values in (
+            ("i.studyInstanceUID", studyInstanceUIDs),
+            ("s.seriesInstanceUID", seriesInstanceUIDs),
+            ("i.patientId", patientIds),
+            ("i.imageSetId", imageSetIds),
+        ):
+            if values is not None:
+                table = f"temp_{column.split('.')[1]}"
+                self.db.execute(f"CREATE TEMP TABLE IF NOT EXISTS {table} (value TEXT PRIMARY KEY)")
+                self.db.execute(f"DELETE FROM {table}")
+                self.db.executemany(f"INSERT OR IGNORE INTO {table} VALUES (?)", [(str(v),) for v in values])
+                joins.append(f"JOIN {table} ON {table}.value = {column}")
+        for clause, value in (
+            ("i.datastoreId = ?", datastoreId),
+            ("s.modality = ?", modality),
+            ("s.bodyPartExamined = ?", bodyPart),
+            ("s.numberOfFrames >= ?", minFrames),
+            ("s.numberOfFrames <= ?", maxFrames),
+        ):
+            if value is not None:
+                where.append(clause)
+                params.append(value)
+        sql = (
+            "SELECT i.imageSetId, i.datastoreId, i.patientId, i.patientSex, i.patientBirthDate, i.studyInstanceUID, "
+            "i.studyDate, i.studyDescription, s.seriesInstanceUID, s.modality, s.bodyPartExamined, "
+            "s.seriesDescription, s.numberOfInstances, s.numberOfFrames "
+            "FROM imagesets i JOIN series s ON s.imageSetId = i.imageSetId "
+            + " ".join(joins)
+            + (" WHERE " + " AND ".join(where) if where else "")
+            + " ORDER BY i.imageSetId, s.seriesNumber"
+        )
+        return pd.read_sql_query(sql, self.db, params=params)
+
+    def frameIds(self, imageSetId, seriesInstanceUID=None, fetchPlan=None):
+        """
+        Frame IDs of an image set, optionally of one series. Without a FetchPlan they are in
+        metadata order; with one, the plan selects them from the indexed series tags and
+        slice positions.
+        """
+        if fetchPlan is None:
+            sql = "SELECT frameId FROM frames WHERE imageSetId = ?"
+            params = [imageSetId]
+            if seriesInstanceUID is not None:
+                sql += " AND seriesInstanceUID = ?"
+                params.append(seriesInstanceUID)
+            return [row[0] for row in self.db.execute(sql + " ORDER BY position", params)]
+        columns = list(INDEXED_SERIES_TAGS.values())
+        series = []
+        for row in self.db.execute(
+            f"SELECT {', '.join(columns)} FROM series WHERE imageSetId = ? ORDER BY rowid", (imageSetId,)
+        ):
+            seriesDicom = {keyword: value for keyword, value in zip(INDEXED_SERIES_TAGS, row) if value is not None}
+            if seriesInstanceUID is not None and seriesDicom["SeriesInstanceUID"] != seriesInstanceUID:
+                continue
+            frames = self.db.execute(
+                "SELECT instanceNumber, sliceLocation, frameId FROM frames "
+                "WHERE imageSetId = ? AND seriesInstanceUID = ? ORDER BY position",
+                (imageSetId, seriesDicom["SeriesInstanceUID"]),
+            ).fetchall()
+            series.append((seriesDicom, frames))
+        return fetchPlan.select(series)
+
+
+def trainValSplit(cohort, valFraction=1 / 3, by="patientId", seed=0):
+    """
+    Deterministic train/validation split of a query result. Rows are assigned by a hash of
+    their `by` column, so all image sets of a patient land on the same side and the split is
+    stable as the index grows.
+    """
+    def bucket(key):
+        digest = hashlib.sha256(f"{seed}|{key}".encode()).digest()
+        return int.from_bytes(digest[:8], "big") / 2**64
+
+    keys = cohort[by].fillna(cohort["imageSetId"]).astype(str)
+    isVal = keys.map(bucket) < valFraction
+    return cohort[~isVal], cohort[isVal]
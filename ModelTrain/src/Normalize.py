@@ -0,0 +1,65 @@
+import numpy as np
+
+from .FetchPlan import intTag
+
+
+def floatTag(dicom, name, default):
+    value = dicom.get(name)
+    if isinstance(value, (list, tuple)):
+        value = value[0] if value else None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def rescaleFromMetadata(dicom):
+    """(RescaleSlope, RescaleIntercept) of an instance or series DICOM dict, (1.0, 0.0) if absent."""
+    return floatTag(dicom, "RescaleSlope", 1.0), floatTag(dicom, "RescaleIntercept", 0.0)
+
+
+def compactDtype(volume, dicom=None):
+    """
+    Smallest torch-friendly integer dtype for a native volume: uint16 pixels that fit in 15
+    bits (BitsStored <= 15, or by value) are stored as int16, since torch has no uint16 ops.
+    """
+    if volume.dtype != np.uint16:
+        return volume.dtype
+    bitsStored = intTag(dicom or {}, "BitsStored")
+    if (bitsStored is not None and bitsStored <= 15) or (volume.size and int(volume.max()) < 2**15):
+        return np.dtype(np.int16)
+    return np.dtype(np.int32)
+
+
+def toFloatOnDevice(x, device, mode="frame", slope=1.0, intercept=0.0, window=None, dtype=None):
+    """
+    Move a batch of native integer volumes, shaped (..., depth, rows, columns), to `device` and
+    turn it into normalized floats there, with in-place operations on one float copy.
+
+    Args:
+        mode (str): "frame" rescales every slice to [0, 1] (the Lab-2 preprocessing), "volume"
+                    every volume, "window" clips `window` = (low, high) in rescaled units (e.g.
+                    Hounsfield) to [0, 1], "none" only applies slope and intercept.
+        slope, intercept: RescaleSlope/RescaleIntercept, scalars or tensors that broadcast.
+    """
+    import torch
+
+    x = x.to(device, non_blocking=True).to(dtype or torch.float32)
+    if mode == "frame" or mode == "volume":
+        # min-max scaling does not depend on a positive slope and the intercept
+        dims = (-2, -1) if mode == "frame" else (-3, -2, -1)
+        low = x.amin(dim=dims, keepdim=True)
+        span = x.amax(dim=dims, keepdim=True).sub_(low)
+        # constant slices or volumes keep their values, as in the Lab-2 preprocessing
+        low = torch.where(span > 0, low, torch.zeros_like(low))
+        return x.sub_(low).div_(torch.where(span > 0, span, torch.ones_like(span)))
+    if not (isinstance(slope, (int, float)) and slope == 1.0):
+        x.mul_(torch.as_tensor(slope, device=x.device, dtype=x.dtype))
+    if not (isinstance(intercept, (int, float)) and intercept == 0.0):
+        x.add_(torch.as_tensor(intercept, device=x.device, dtype=x.dtype))
+    if mode == "window":
+        low, high = window
+        return x.clamp_(low, high).sub_(low).div_(high - low)
+    if mode == "none":
+        return x
+    raise ValueError(f"Unsupported normalization {mode}, expected frame, volume, window or none")
@@ -0,0 +1,335 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .Normalize import compactDtype
+
+INDEX_FILE = "index.json"
+
+
+def rescaleFrame(pixel):
+    ## rescale to min 0 and max 1, as in the training notebook
+    pixel = pixel.astype(np.float32)
+    if pixel.min() < pixel.max():
+        pixel -= pixel.min()
+        pixel /= pixel.max()
+    return pixel
+
+
+def rescaleVolume(volume):
+    volume = volume.astype(np.float32)
+    low, high = volume.min(), volume.max()
+    return (volume - low) / (high - low) if low < high else volume
+
+
+# "none" keeps the native integer pixels, for normalization on the training device (Normalize.toFloatOnDevice).
+NORMALIZATIONS = {"frame": None, "volume": rescaleVolume, "none": lambda volume: volume}
+
+
+def resample(volume, targetShape):
+    import torch
+
+    tensor = torch.from_numpy(np.ascontiguousarray(volume, dtype=np.float32))[None, None]
+    return torch.nn.functional.interpolate(tensor, size=tuple(targetShape), mode="trilinear", align_corners=False)[0, 0].numpy()
+
+
+class VolumeStore:
+    """
+    Decoded, normalized and optionally resampled training volumes on local disk.
+
+    Each volume is stored as slabs of `chunkDepth` slices, one `.npy` file per slab, read
+    memory-mapped; with `compress=True` slabs are zlib-compressed `.npz` files instead, which
+    are smaller but are decompressed on read. `index.json` lists the volumes with their shape
+    and the settings they were materialized with, so several runs can share one store and
+    `materialize` only adds the volumes that are missing.
+
+    `dtype="native", normalization="none"` keeps the decoded 16-bit pixels, half the size of
+    float32, and leaves the float conversion to the training device.
+    """
+
+    def __init__(
+        self, path, chunkDepth=16, dtype="float16", normalization="frame", targetShape=None, compress=False, fetchPlan=None
+    ):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.lock = threading.Lock()
+        self.index = self.readIndex()
+        settings = {
+            "chunkDepth": chunkDepth,
+            "dtype": dtype,
+            "normalization": normalization,
+            "targetShape": list(targetShape) if targetShape else None,
+            "compress": compress,
+        }
+        if fetchPlan is not None:
+            # Volumes fetched with different plans do not mix in one store.
+            settings["fetchPlan"] = repr(fetchPlan)
+        if normalization not in NORMALIZATIONS:
+            raise ValueError(f"Unsupported normalization {normalization}, expected one of {list(NORMALIZATIONS)}")
+        if self.index["volumes"] and self.index["settings"] != settings:
+            raise ValueError(f"{path} was materialized with {self.index['settings']}, not {settings}")
+        self.index["settings"] = settings
+        self.settings = settings
+
+    def __getstate__(self):
+        # DataLoader workers may receive the store pickled.
+        state = dict(self.__dict__)
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def readIndex(self):
+        try:
+            with open(os.path.join(self.path, INDEX_FILE)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"settings": None, "volumes": {}}
+
+    def writeIndex(self):
+        tmp = os.path.join(self.path, f"{INDEX_FILE}.{os.getpid()}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp, os.path.join(self.path, INDEX_FILE))
+
+    def __contains__(self, imageSetId):
+        return imageSetId in self.index["volumes"]
+
+    def __len__(self):
+        return len(self.index["volumes"])
+
+    def imageSetIds(self):
+        return list(self.index["volumes"])
+
+    def shape(self, imageSetId):
+        return tuple(self.index["volumes"][imageSetId]["shape"])
+
+    def dtype(self, imageSetId):
+        entry = self.index["volumes"][imageSetId]
+        if "dtype" in entry:
+            return np.dtype(entry["dtype"])
+        if self.settings["dtype"] != "native":
+            return np.dtype(self.settings["dtype"])
+        # indexed before the dtype was recorded
+        return self.readChunk(imageSetId, 0).dtype
+
+    def volumeDir(self, imageSetId):
+        return os.path.join(self.path, imageSetId)
+
+    def chunkPath(self, imageSetId, chunk):
+        return os.path.join(self.volumeDir(imageSetId), f"{chunk:05d}.{'npz' if self.settings['compress'] else 'npy'}")
+
+    def write(self, imageSetId, volume, attributes=None):
+        """Store a (depth, height, width) volume that is already normalized and resampled."""
+        if self.settings["dtype"] == "native":
+            volume = volume.astype(compactDtype(volume), copy=False)
+        else:
+            volume = volume.astype(self.settings["dtype"])
+        depth = self.settings["chunkDepth"]
+        tmpDir = f"{self.volumeDir(imageSetId)}.{os.getpid()}.tmp"
+        shutil.rmtree(tmpDir, ignore_errors=True)
+        os.makedirs(tmpDir)
+        for chunk, start in enumerate(range(0, volume.shape[0], depth)):
+            name = os.path.basename(self.chunkPath(imageSetId, chunk))
+            if self.settings["compress"]:
+                np.savez_compressed(os.path.join(tmpDir, name), slab=volume[start:start + depth])
+            else:
+                np.save(os.path.join(tmpDir, name), volume[start:start + depth])
+        shutil.rmtree(self.volumeDir(imageSetId), ignore_errors=True)
+        os.replace(tmpDir, self.volumeDir(imageSetId))
+        with self.lock:
+            self.index["volumes"][imageSetId] = {
+                "shape": list(volume.shape), "dtype": volume.dtype.str, **(attributes or {})
+            }
+            self.writeIndex()
+
+    def readChunk(self, imageSetId, chunk):
+        if self.settings["compress"]:
+            with np.load(self.chunkPath(imageSetId, chunk)) as f:
+                return f["slab"]
+        return np.load(self.chunkPath(imageSetId, chunk), mmap_mode="r")
+
+    def slab(self, imageSetId, start=0, stop=None):
+        """Slices [start, stop) of a volume, reading only the chunks that hold them."""
+        depth = self.settings["chunkDepth"]
+        stop = self.shape(imageSetId)[0] if stop is None else min(stop, self.shape(imageSetId)[0])
+        if start >= stop:
+            return np.empty((0, *self.shape(imageSetId)[1:]), dtype=self.dtype(imageSetId))
+        parts = []
+        for chunk in range(start // depth, (stop - 1) // depth + 1):
+            data = self.readChunk(imageSetId, chunk)
+            offset = chunk * depth
+            parts.append(data[max(start - offset, 0):stop - offset])
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def volume(self, imageSetId):
+        return self.slab(imageSetId)
+
+    def fetchVolume(self, medicalimaging, datastoreId, imageSetId, frameIds, frameWorkers=8):
+        rescale = rescaleFrame if self.settings["normalization"] == "frame" else None
+        with ThreadPoolExecutor(max_workers=frameWorkers) as executor:
+            frames = list(executor.map(lambda f: medicalimaging.getFramePixels(datastoreId, imageSetId, f), frameIds))
+        volume = np.stack([rescale(frame) if rescale else frame for frame in frames])
+        if rescale is None:
+            volume = NORMALIZATIONS[self.settings["normalization"]](volume)
+        if self.settings["targetShape"]:
+            native = volume.dtype
+            volume = resample(volume, self.settings["targetShape"])
+            if np.issubdtype(native, np.integer):
+                volume = np.rint(volume).astype(native)
+        return volume
+
+    def rescale(self, imageSetId):
+        """(RescaleSlope, RescaleIntercept) the volume was materialized with."""
+        attributes = self.index["volumes"][imageSetId]
+        return attributes.get("rescaleSlope", 1.0), attributes.get("rescaleIntercept", 0.0)
+
+    def materialize(self, medicalimaging, datastoreId, frameIds, workers=4, frameWorkers=8, rescale=None):
+        """
+        Fetch, decode, normalize and store the volumes that are not in the store yet.
+
+        Args:
+            medicalimaging (MedicalImaging): Client the frames are fetched with.
+            datastoreId (str): Datastore of the image sets.
+            frameIds (dict): imageSetId -> frame IDs in slice order, e.g. from `MetadataIndex.frameIds`.
+            workers (int): Volumes fetched concurrently.
+            frameWorkers (int): Frames fetched concurrently per volume.
+            rescale (dict): imageSetId -> (RescaleSlope, RescaleIntercept) to record with native
+                            volumes, e.g. from `Normalize.rescaleFromMetadata`.
+
+        Returns:
+            dict: Number of volumes materialized, already present and failed.
+        """
+        start_time = time.time()
+        missing = [i for i in frameIds if i not in self]
+
+        def materializeOne(imageSetId):
+            try:
+                volume = self.fetchVolume(medicalimaging, datastoreId, imageSetId, frameIds[imageSetId], frameWorkers)
+                attributes = {"datastoreId": datastoreId, "frames": len(frameIds[imageSetId])}
+                if rescale and imageSetId in rescale:
+                    attributes["rescaleSlope"], attributes["rescaleIntercept"] = rescale[imageSetId]
+                self.write(imageSetId, volume, attributes)
+                return True
+            except Exception as e:
+                logging.warning(f"Volume {imageSetId} not materialized: {e}")
+                return False
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            done = list(executor.map(materializeOne, missing))
+        result = {"materialized": sum(done), "present": len(frameIds) - len(missing), "failed": done.count(False)}
+        end_time = time.time()
+        logging.info(f"Materialized {result} into {self.path} in {medicalimaging.stopwatch(start_time, end_time):.0f} ms")
+        return result
+
+
+try:
+    import torch
+    from torch.utils.data import Dataset
+except ImportError:  # materializing does not need torch
+    Dataset = object
+
+
+class VolumeDataset(Dataset):
+    """
+    Training samples read from a VolumeStore: `(image, label)` with the image as a
+    (1, depth, height, width) tensor, or a `slabDepth` slab of it starting at a random slice.
+    Images keep the store's dtype, so integer volumes cross the DataLoader workers at their
+    native size, unless `dtype` converts them on the host.
+    """
+
+    def __init__(self, store, labels, slabDepth=None, transform=None, dtype=None):
+        self.store = store
+        self.imageSetIds = [i for i in labels if i in store]
+        self.labels = labels
+        self.slabDepth = slabDepth
+        self.transform = transform
+        self.dtype = dtype
+
+    def __len__(self):
+        return len(self.imageSetIds)
+
+    def depths(self):
+        """Depth of every sample, from the store index without reading pixels, e.g. for DepthBuckets."""
+        depths = [self.store.shape(imageSetId)[0] for imageSetId in self.imageSetIds]
+        return [min(depth, self.slabDepth) for depth in depths] if self.slabDepth else depths
+
+    def __getitem__(self, idx):
+        imageSetId = self.imageSetIds[idx]
+        if self.slabDepth:
+            depth = self.store.shape(imageSetId)[0]
+            start = int(torch.randint(0, max(depth - self.slabDepth, 0) + 1, ()).item())
+            data = self.store.slab(imageSetId, start, start + self.slabDepth)
+        else:
+            data = self.store.volume(imageSetId)
+        image = torch.from_numpy(np.array(data, dtype=self.dtype))[None]
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, self.labels[imageSetId]
+
+
+def main():
+    from .Api import MedicalImaging
+    from .MetadataIndex import MetadataIndex
+
+    from .FetchPlan import FetchPlan
+
+    parser = argparse.ArgumentParser(
+        description="Materialize HealthImaging image sets into a local VolumeStore; run as `python -m src.VolumeStore` from ModelTrain/"
+    )
+    parser.add_argument("datastoreId")
+    parser.add_argument("store", help="output directory")
+    parser.add_argument("--index", default="metadata_index.db", help="MetadataIndex database with the frame IDs")
+    parser.add_argument("--imagesets", default=None, help="file with one imageSetId per line (default: all indexed)")
+    parser.add_argument("--chunk-depth", type=int, default=16)
+    parser.add_argument("--dtype", default="float16")
+    parser.add_argument("--normalization", default="frame", choices=list(NORMALIZATIONS))
+    parser.add_argument("--target-shape", default=None, help="resample to depth,height,width")
+    parser.add_argument("--compress", action="store_true")
+    parser.add_argument("--modality", default=None, help="fetch only the series of this modality")
+    parser.add_argument("--slice-range", default=None, help="start,stop slice indices or fractions, e.g. 0.25,0.75")
+    parser.add_argument("--stride", type=int, default=1, help="fetch every n-th slice")
+    parser.add_argument("--target-depth", type=int, default=None, help="fetch this many evenly spaced slices")
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    medicalimaging = MedicalImaging()
+    metadataIndex = MetadataIndex(medicalimaging, args.index)
+    if args.imagesets:
+        with open(args.imagesets) as f:
+            imageSetIds = [line.strip() for line in f if line.strip()]
+    else:
+        imageSetIds = metadataIndex.query(datastoreId=args.datastoreId)["imageSetId"].unique()
+    fetchPlan = None
+    if args.modality or args.slice_range or args.stride > 1 or args.target_depth:
+        fetchPlan = FetchPlan(
+            seriesFilter={"Modality": args.modality} if args.modality else None,
+            sliceRange=[float(v) if "." in v else int(v) for v in args.slice_range.split(",")] if args.slice_range else None,
+            stride=args.stride,
+            targetDepth=args.target_depth,
+        )
+    store = VolumeStore(
+        args.store,
+        chunkDepth=args.chunk_depth,
+        dtype=args.dtype,
+        normalization=args.normalization,
+        targetShape=[int(v) for v in args.target_shape.split(",")] if args.target_shape else None,
+        compress=args.compress,
+        fetchPlan=fetchPlan,
+    )
+    frameIds = {i: metadataIndex.frameIds(i, fetchPlan=fetchPlan) for i in imageSetIds}
+    print(json.dumps(store.materialize(medicalimaging, args.datastoreId, frameIds, workers=args.workers)))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="INFO")
+    main()
@@ -0,0 +1,91 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pytest
+
+from src.FrameCache import CacheServer, FrameCache, HttpFrameCache, SharedDirectoryCache, frameKey
+
+
+@pytest.fixture
+def server():
+    server = CacheServer(host="127.0.0.1", port=0).start()
+    yield server
+    server.stop()
+
+
+class CountingFetch:
+    def __init__(self, data=b"frame", delay=0.0):
+        self.data = data
+        self.delay = delay
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.delay)
+        return self.data
+
+
+def test_frame_cache_is_abstract():
+    with pytest.raises(TypeError):
+        FrameCache()
+
+
+def test_http_cache_shares_hits_between_clients(server):
+    key = frameKey("datastore", "imageset", "frame")
+    first, second = HttpFrameCache(server.url), HttpFrameCache(server.url)
+    fetch = CountingFetch()
+    assert first.getOrFetch(key, fetch) == b"frame"
+    assert second.getOrFetch(key, fetch) == b"frame"
+    assert fetch.calls == 1
+    assert first.stats()["misses"] == 1
+    assert second.stats()["hits"] == 1
+
+
+def test_http_cache_coalesces_concurrent_fetches(server):
+    key = frameKey("datastore", "imageset", "frame")
+    clients = [HttpFrameCache(server.url) for _ in range(4)]
+    fetch = CountingFetch(delay=0.2)
+    results = []
+    threads = [
+        threading.Thread(target=lambda c=client: results.append(c.getOrFetch(key, fetch)))
+        for client in clients
+        for _ in range(2)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [b"frame"] * len(threads)
+    assert fetch.calls == 1
+
+
+def test_http_cache_falls_back_when_server_is_down():
+    cache = HttpFrameCache("http://127.0.0.1:9", timeout=1)
+    fetch = CountingFetch()
+    assert cache.getOrFetch(frameKey("d", "i", "f"), fetch) == b"frame"
+    assert fetch.calls == 1
+    assert cache.stats()["errors"] >= 1
+
+
+def test_shared_directory_cache_evicts_least_recently_used(tmp_path):
+    cache = SharedDirectoryCache(str(tmp_path), maxBytes=10000, scanInterval=3600)
+    keys = [frameKey("d", "i", f"frame{n}") for n in range(5)]
+    for n, key in enumerate(keys):
+        assert cache.getOrFetch(key, CountingFetch(bytes(300))) == bytes(300)
+    # Let the background scan of the first put finish, then age the frames in key order.
+    with cache.evictLock:
+        for n, key in enumerate(keys):
+            os.utime(cache.framePath(key), (n, n))
+        cache.maxBytes = 1000
+        cache.evict()
+    assert [os.path.exists(cache.framePath(key)) for key in keys] == [False, False, True, True, True]
+    assert cache.stats()["evictions"] == 2
+    fetch = CountingFetch(b"refetched")
+    assert cache.getOrFetch(keys[-1], fetch) == bytes(300)
+    assert cache.getOrFetch(keys[0], fetch) == b"refetched"
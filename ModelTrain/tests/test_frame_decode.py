@@ -0,0 +1,55 @@
+import io
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+openjpeg = pytest.importorskip("openjpeg")
+pytest.importorskip("PIL")
+
+from src.FrameDecode import decodeFrame, parseCodestreamHeader, readFrame
+
+
+def encodedFrame(rows=64, columns=48):
+    """Smooth signed CT-like frame, so a lower resolution level is close to the subsampled frame."""
+    y, x = np.mgrid[:rows, :columns]
+    pixels = (400 * np.sin(x / 9) + 300 * np.cos(y / 7) - 200).astype(np.int16)
+    return pixels, openjpeg.encode(pixels)
+
+
+def test_parseCodestreamHeader():
+    pixels, data = encodedFrame()
+    header = parseCodestreamHeader(data)
+    assert (header["width"], header["height"]) == (48, 64)
+    assert header["signed"]
+    assert header["precision"] <= 16
+    assert header["levels"] >= 2
+
+
+def test_readFrame_full_resolution():
+    pixels, data = encodedFrame()
+    decoded, level, nbytes = readFrame(io.BytesIO(data), 0)
+    assert level == 0
+    assert nbytes == len(data)
+    np.testing.assert_array_equal(decoded, pixels)
+
+
+@pytest.mark.parametrize("level", [1, 2])
+def test_readFrame_reduced_resolution(level):
+    pixels, data = encodedFrame()
+    decoded, used, nbytes = readFrame(io.BytesIO(data), level)
+    scale = 2**level
+    assert used == level
+    assert decoded.shape == (64 // scale, 48 // scale)
+    assert decoded.dtype == np.int16
+    # The stored sample values come back, not Pillow's shifted unsigned ones.
+    assert np.abs(decoded - pixels[::scale, ::scale]).mean() < 10
+
+
+def test_decodeFrame_odd_size_rounds_up():
+    pixels, data = encodedFrame(rows=63, columns=45)
+    assert decodeFrame(data, 1).shape == (32, 23)
+    assert decodeFrame(data, 2).shape == (16, 12)
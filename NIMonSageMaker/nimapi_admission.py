@@ -0,0 +1,317 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import deque
+from typing import NamedTuple, Optional
+
+from .metrics import ADMISSION_COST_BYTES, ADMISSION_REJECTIONS, ADMISSION_WAIT_SECONDS, current_timer
+
+
+GB = 1024**3
+# Host memory per input voxel across the request: the native volume in the proxy, the float32
+# copy and preprocessing buffers in Triton, and the output mask.
+BYTES_PER_VOXEL = float(os.getenv("NIMS_ADMISSION_BYTES_PER_VOXEL", "32"))
+# Voxels per byte of an S3/HTTP source whose shape is unknown until it is downloaded; a
+# gzip-compressed int16 NIfTI CT holds about one voxel per byte.
+VOXELS_PER_SOURCE_BYTE = float(os.getenv("NIMS_ADMISSION_VOXELS_PER_BYTE", "1.0"))
+# Voxels assumed when the source size is unknown, a 512x512x300 CT.
+DEFAULT_VOXELS = int(os.getenv("NIMS_ADMISSION_DEFAULT_VOXELS", str(512 * 512 * 300)))
+
+
+class RequestCost(NamedTuple):
+    """Estimated compute (input voxels) and host memory cost of one inference request."""
+
+    voxels: int
+    memory_bytes: int
+    source: str
+
+    @classmethod
+    def from_voxels(cls, voxels: int, source: str) -> "RequestCost":
+        return cls(int(voxels), int(voxels * BYTES_PER_VOXEL), source)
+
+    @classmethod
+    def from_source_bytes(cls, size: Optional[int]) -> "RequestCost":
+        if not size:
+            return cls.from_voxels(DEFAULT_VOXELS, "default")
+        return cls.from_voxels(size * VOXELS_PER_SOURCE_BYTE, "content-length")
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request is not admitted; answered with `status_code` and a Retry-After header."""
+
+    def __init__(self, status_code: int, message: str, retry_after: int):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+        self.retry_after = retry_after
+
+
+def _read_int(path: str) -> Optional[int]:
+    try:
+        with open(path) as fp:
+            value = fp.read().strip()
+    except OSError:
+        return None
+    return int(value) if value.isdigit() else None
+
+
+def _meminfo(field: str) -> Optional[int]:
+    try:
+        with open("/proc/meminfo") as fp:
+            for line in fp:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def memory_limit() -> Optional[int]:
+    """Memory limit of the container (cgroup v2 or v1), else the host memory."""
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        limit = _read_int(path)
+        # cgroup v1 reports "no limit" as a number close to 2**63
+        if limit and limit < 2**60:
+            return limit
+    return _meminfo("MemTotal")
+
+
+def _cgroup_stat(path: str, field: str) -> int:
+    try:
+        with open(path) as fp:
+            for line in fp:
+                name, _, value = line.partition(" ")
+                if name == field:
+                    return int(value)
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def available_memory() -> Optional[int]:
+    """
+    Memory the container can still allocate: its cgroup limit minus its usage without the
+    inactive page cache (downloaded files the kernel can reclaim), else MemAvailable.
+    """
+    limit = memory_limit()
+    for usage_path, stat_path, field in (
+        ("/sys/fs/cgroup/memory.current", "/sys/fs/cgroup/memory.stat", "inactive_file"),
+        ("/sys/fs/cgroup/memory/memory.usage_in_bytes", "/sys/fs/cgroup/memory/memory.stat", "total_inactive_file"),
+    ):
+        usage = _read_int(usage_path)
+        if usage is not None and limit:
+            return max(0, limit - usage + _cgroup_stat(stat_path, field))
+    return _meminfo("MemAvailable")
+
+
+class _Waiter:
+    def __init__(self, cost: RequestCost, future: asyncio.Future):
+        self.cost = cost
+        self.future = future
+
+
+class Ticket:
+    """An admitted request's share of the budget; `release` is idempotent."""
+
+    def __init__(self, controller: "AdmissionController", cost: RequestCost, memory_bytes: int):
+        self.controller = controller
+        self.cost = cost
+        self.memory_bytes = memory_bytes
+        self.admitted_ts = time.perf_counter()
+        self.released = False
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self.controller._release(self)
+
+
+class AdmissionController:
+    """
+    Admits inference requests against a host memory budget and an optional voxel budget
+    before any download or decode starts.
+
+    Requests that do not fit wait in a FIFO queue of at most `max_queued` requests for up to
+    `max_wait` seconds. A full queue is answered with 429 and a wait that runs out with 503,
+    both with a Retry-After estimated from recent hold times. While the container's free
+    memory is below `min_free_bytes` nothing new is admitted, whatever the budget says. A
+    request larger than the whole budget runs alone.
+
+    All methods run on the event loop, so the bookkeeping needs no lock.
+    """
+
+    def __init__(
+        self,
+        memory_budget: int,
+        max_voxels: int = 0,
+        max_active: int = 0,
+        max_queued: int = 16,
+        max_wait: float = 30.0,
+        min_free_bytes: int = 0,
+        poll_interval: float = 0.5,
+        max_retry_after: int = 60,
+    ):
+        """
+        Args:
+            memory_budget (int): Estimated host memory of all admitted requests, in bytes.
+            max_voxels (int): Input voxels of all admitted requests, 0 for no limit.
+            max_active (int): Admitted requests, 0 for no limit.
+            max_queued (int): Requests waiting for admission before new ones get 429.
+            max_wait (float): Seconds a request waits for admission before it gets 503.
+            min_free_bytes (int): Free container memory below which nothing new is admitted.
+            poll_interval (float): Seconds between free-memory checks while requests wait.
+            max_retry_after (int): Upper bound of the Retry-After hint in seconds.
+        """
+        self.memory_budget = memory_budget
+        self.max_voxels = max_voxels
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.min_free_bytes = min_free_bytes
+        self.poll_interval = poll_interval
+        self.max_retry_after = max_retry_after
+        self.active = 0
+        self.memory_in_use = 0
+        self.voxels_in_use = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.average_hold = 10.0
+        self._waiters: deque[_Waiter] = deque()
+
+    @classmethod
+    def from_env(cls) -> "AdmissionController":
+        limit = memory_limit() or 16 * GB
+        return cls(
+            memory_budget=int(
+                os.getenv("NIMS_ADMISSION_MEMORY_BYTES")
+                or limit * float(os.getenv("NIMS_ADMISSION_MEMORY_FRACTION", "0.6"))
+            ),
+            max_voxels=int(os.getenv("NIMS_ADMISSION_MAX_VOXELS", "0")),
+            max_active=int(os.getenv("NIMS_ADMISSION_MAX_ACTIVE", "0")),
+            max_queued=int(os.getenv("NIMS_ADMISSION_MAX_QUEUED", "16")),
+            max_wait=float(os.getenv("NIMS_ADMISSION_MAX_WAIT", "30")),
+            min_free_bytes=int(os.getenv("NIMS_ADMISSION_MIN_FREE_BYTES") or limit * 0.1),
+        )
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def under_pressure(self) -> bool:
+        if not self.min_free_bytes:
+            return False
+        available = available_memory()
+        return available is not None and available < self.min_free_bytes
+
+    def _fits(self, cost: RequestCost) -> bool:
+        if self.active == 0:
+            return True
+        if self.max_active and self.active >= self.max_active:
+            return False
+        if self.max_voxels and self.voxels_in_use + cost.voxels > self.max_voxels:
+            return False
+        return self.memory_in_use + min(cost.memory_bytes, self.memory_budget) <= self.memory_budget
+
+    def _grant(self, cost: RequestCost) -> Ticket:
+        ticket = Ticket(self, cost, min(cost.memory_bytes, self.memory_budget))
+        self.active += 1
+        self.admitted += 1
+        self.memory_in_use += ticket.memory_bytes
+        self.voxels_in_use += cost.voxels
+        return ticket
+
+    def _dispatch(self) -> None:
+        """Admit waiters from the head of the queue while they fit; strict FIFO, so large requests do not starve."""
+        while self._waiters and self._fits(self._waiters[0].cost):
+            if self.active and self.under_pressure():
+                return
+            waiter = self._waiters.popleft()
+            waiter.future.set_result(self._grant(waiter.cost))
+
+    def _release(self, ticket: Ticket) -> None:
+        self.active -= 1
+        self.memory_in_use -= ticket.memory_bytes
+        self.voxels_in_use -= ticket.cost.voxels
+        hold = time.perf_counter() - ticket.admitted_ts
+        self.average_hold = 0.8 * self.average_hold + 0.2 * hold
+        self._dispatch()
+
+    def retry_after(self) -> int:
+        """Seconds until the queue ahead of a new request has likely drained."""
+        seconds = self.average_hold * (self.queued + 1) / max(1, self.active)
+        return max(1, min(self.max_retry_after, math.ceil(seconds)))
+
+    def _reject(self, status_code: int, reason: str, message: str, wait: float) -> AdmissionRejected:
+        self.rejected += 1
+        ADMISSION_REJECTIONS.labels(reason).inc()
+        ADMISSION_WAIT_SECONDS.labels("rejected").observe(wait)
+        logging.warning(f"Request rejected ({reason}): {message}")
+        return AdmissionRejected(status_code, message, self.retry_after())
+
+    async def admit(self, cost: RequestCost) -> Ticket:
+        """
+        Wait until `cost` fits the budget.
+
+        Returns:
+            Ticket: Release it once the request no longer holds memory.
+
+        Raises:
+            AdmissionRejected: 429 if the queue is full, 503 if no budget freed up within `max_wait`.
+        """
+        ADMISSION_COST_BYTES.labels(cost.source).observe(cost.memory_bytes)
+        timer = current_timer.get()
+        start_ts = time.perf_counter()
+        ticket = None
+        if not self._waiters and self._fits(cost) and not (self.active and self.under_pressure()):
+            ticket = self._grant(cost)
+        else:
+            if self.queued >= self.max_queued:
+                raise self._reject(429, "queue_full", f"{self.queued} requests are waiting for admission", 0.0)
+            waiter = _Waiter(cost, asyncio.get_running_loop().create_future())
+            self._waiters.append(waiter)
+            deadline = start_ts + self.max_wait
+            try:
+                while not waiter.future.done():
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    # Freed budget wakes the waiter at once; the timeout re-checks the free memory.
+                    await asyncio.wait({waiter.future}, timeout=min(remaining, self.poll_interval))
+                    self._dispatch()
+            except BaseException:
+                if waiter.future.done():
+                    waiter.future.result().release()
+                else:
+                    self._waiters.remove(waiter)
+                raise
+            if waiter.future.done():
+                ticket = waiter.future.result()
+            else:
+                self._waiters.remove(waiter)
+                self._dispatch()
+                raise self._reject(
+                    503,
+                    "timeout",
+                    f"No capacity for a request of {cost.memory_bytes / GB:.1f} GB within {self.max_wait:.0f}s",
+                    time.perf_counter() - start_ts,
+                )
+        wait = time.perf_counter() - start_ts
+        ADMISSION_WAIT_SECONDS.labels("admitted").observe(wait)
+        if timer:
+            timer.record("admission_queue", wait)
+        return ticket
+
+    def stats(self) -> dict:
+        return {
+            "memory_budget": self.memory_budget,
+            "memory_in_use": self.memory_in_use,
+            "voxels_in_use": self.voxels_in_use,
+            "active": self.active,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "average_hold": round(self.average_hold, 3),
+            "under_pressure": self.under_pressure(),
+        }
@@ -0,0 +1,151 @@
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _link_or_copy(src: str, dst: str) -> None:
+    """Hard link `src` to `dst`, falling back to a copy across filesystems."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class VolumeCache:
+    """
+    Bounded LRU cache of prepared input volumes, keyed by image source and version.
+
+    Every entry is a single file (the NIfTI/DICOM volume handed to Triton) stored under a
+    per-process directory `cache_dir/<pid>`, so the uvicorn workers sharing `cache_dir` never
+    remove each other's entries. Entries are handed out as hard links into the request working directory,
+    so evicting an entry never pulls a file from under a request that is still using it.
+    Point `cache_dir` at a tmpfs such as `/dev/shm` to keep the cache in memory.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int, max_entries: int = 64, ttl: float = 300.0):
+        """
+        Args:
+            cache_dir (str): Directory holding the cached volumes.
+            max_bytes (int): Total size budget of the cached volumes. 0 disables the cache.
+            max_entries (int): Maximum number of cached volumes.
+            ttl (float): Lifetime in seconds of entries whose source exposes no version/ETag.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[str, int, Optional[float]]] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        if self.enabled:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Directories of processes that have exited are not tracked by anyone, so drop them.
+            for name in os.listdir(cache_dir):
+                if name.isdigit() and not _process_alive(int(name)):
+                    shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0 and self.max_entries > 0
+
+    @staticmethod
+    def make_key(url: str, version: Optional[str]) -> str:
+        return f"{url}#{version or ''}"
+
+    def _evict(self, key: str) -> None:
+        path, size, _ = self._entries.pop(key)
+        self._size -= size
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+    def get(self, key: str, destination_path: str) -> Optional[str]:
+        """
+        Link a cached volume into `destination_path`.
+
+        Args:
+            key (str): Cache key built by `make_key`.
+            destination_path (str): Request working directory.
+
+        Returns:
+            str: The path of the volume inside `destination_path`, or None on a miss.
+        """
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[2] is not None and entry[2] < time.time():
+                self._evict(key)
+                entry = None
+            if not entry:
+                self.misses += 1
+                return None
+            image_file = os.path.join(destination_path, os.path.basename(entry[0]))
+            try:
+                _link_or_copy(entry[0], image_file)
+            except OSError as e:
+                logging.warning(f"Cached volume of {key} is unavailable, treating it as a miss: {e}")
+                self._evict(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return image_file
+
+    def put(self, key: str, image_file: str, versioned: bool = True) -> None:
+        """
+        Add a prepared volume to the cache, evicting least recently used entries to fit.
+
+        Args:
+            key (str): Cache key built by `make_key`.
+            image_file (str): The prepared volume. It is linked, not moved.
+            versioned (bool): False if the key carries no version, so the entry expires after `ttl`.
+        """
+        if not self.enabled or not image_file or not os.path.isfile(image_file):
+            return
+
+        size = os.path.getsize(image_file)
+        if size > self.max_bytes:
+            logging.info(f"Volume of {size} bytes exceeds cache budget; not caching {key}")
+            return
+
+        # Resolved per call, so a worker forked after the cache was created gets its own directory.
+        entry_dir = os.path.join(self.cache_dir, str(os.getpid()), hashlib.sha256(key.encode()).hexdigest())
+        with self._lock:
+            if key in self._entries:
+                self._evict(key)
+            while self._entries and (self._size + size > self.max_bytes or len(self._entries) >= self.max_entries):
+                self._evict(next(iter(self._entries)))
+
+            os.makedirs(entry_dir, exist_ok=True)
+            path = os.path.join(entry_dir, os.path.basename(image_file))
+            _link_or_copy(image_file, path)
+            expires = None if versioned else time.time() + self.ttl
+            self._entries[key] = (path, size, expires)
+            self._size += size
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
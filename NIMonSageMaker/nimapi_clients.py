@@ -0,0 +1,28 @@
+import functools
+import os
+
+
+# AWS clients and the GPU decoder are created on first use rather than at import time, so
+# the proxy starts serving health checks without waiting on credentials, the network or CUDA.
+
+
+@functools.lru_cache(maxsize=None)
+def s3_client():
+    import boto3
+
+    return boto3.client("s3")
+
+
+@functools.lru_cache(maxsize=None)
+def ahi_client():
+    import boto3
+    from botocore.config import Config
+
+    return boto3.client("medical-imaging", config=Config(region_name=os.getenv("AWS_REGION", "us-east-1")))
+
+
+@functools.lru_cache(maxsize=None)
+def image_decoder():
+    from nvidia import nvimgcodec
+
+    return nvimgcodec.Decoder()
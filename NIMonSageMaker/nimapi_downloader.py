@@ -0,0 +1,379 @@
+import gzip
+import json
+import logging
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Optional
+from urllib.parse import urlparse
+
+import numpy as np
+import requests
+import SimpleITK as sitk
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from aws_requests_auth.aws_auth import AWSRequestsAuth
+
+from .clients import ahi_client, image_decoder, s3_client
+from .metrics import DOWNLOAD_BYTES, timed
+from .utils import get_filename_from_cd
+
+
+MB = 1024 * 1024
+CHUNK_SIZE = int(os.getenv("NIMS_DOWNLOAD_CHUNK_SIZE", str(8 * MB)))
+MAX_CONCURRENCY = int(os.getenv("NIMS_DOWNLOAD_CONCURRENCY", "8"))
+AHI_RETRIEVE_BIN = os.getenv(
+    "NIMS_AHI_RETRIEVE_BIN", "/root/aws-healthimaging-samples/ahi-batch-image-frame-retrieve/build/apps/ahi-retrieve"
+)
+
+s3_transfer_config = TransferConfig(
+    multipart_threshold=CHUNK_SIZE,
+    multipart_chunksize=CHUNK_SIZE,
+    max_concurrency=MAX_CONCURRENCY,
+    io_chunksize=MB,
+)
+
+
+class Volume(NamedTuple):
+    """A decoded input volume in (z, y, x) order, ready to be written for Triton."""
+
+    array: np.ndarray
+    spacing: Optional[tuple] = None
+    origin: Optional[tuple] = None
+
+
+def write_volume(volume: Volume, image_file: str) -> str:
+    """
+    Write a decoded volume as (gzip-compressed) NIfTI.
+
+    Kept a module level function so it can run in a worker process.
+    """
+    image = sitk.GetImageFromArray(volume.array)
+    if volume.spacing:
+        image.SetSpacing(volume.spacing)
+    if volume.origin:
+        image.SetOrigin(volume.origin)
+    sitk.WriteImage(image, image_file)
+    return image_file
+
+
+class HttpBackend:
+    """Streams HTTP/HTTPS objects with large chunks, and with parallel range requests when the server allows."""
+
+    def estimate_voxels(self, url: str, destination_path: str) -> Optional[int]:
+        return None
+
+    def decode(self, fetched_path: str, destination_path: str) -> Optional[Volume]:
+        return None
+
+    def fetch(self, url: str, destination_path: str) -> tuple[str, int]:
+        head = requests.head(url, allow_redirects=True, timeout=30)
+        size = int(head.headers.get("content-length", 0)) if head.ok else 0
+        ranged = head.ok and head.headers.get("accept-ranges", "").lower() == "bytes" and size > 2 * CHUNK_SIZE
+        file_path = os.path.join(destination_path, get_filename_from_cd(url, head.headers.get("content-disposition")))
+
+        if not ranged:
+            with requests.get(url, stream=True, allow_redirects=True, timeout=30) as response:
+                response.raise_for_status()
+                with open(file_path, "wb") as fp:
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        fp.write(chunk)
+            return file_path, os.path.getsize(file_path)
+
+        def fetch_range(start: int) -> None:
+            end = min(start + CHUNK_SIZE, size) - 1
+            response = requests.get(url, headers={"Range": f"bytes={start}-{end}"}, allow_redirects=True, timeout=60)
+            response.raise_for_status()
+            if response.status_code != 206 or len(response.content) != end - start + 1:
+                raise requests.exceptions.RequestException(f"Unexpected response to range {start}-{end}")
+            os.pwrite(fd, response.content, start)
+
+        fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            with ThreadPoolExecutor(max_workers=MAX_CONCURRENCY) as executor:
+                list(executor.map(fetch_range, range(0, size, CHUNK_SIZE)))
+        finally:
+            os.close(fd)
+        return file_path, size
+
+
+class DicomWebBackend:
+    """Fetches a single instance through the HealthImaging DICOMweb API and converts it to NIfTI."""
+
+    def estimate_voxels(self, url: str, destination_path: str) -> Optional[int]:
+        return None
+
+    def decode(self, fetched_path: str, destination_path: str) -> Optional[Volume]:
+        from pydicom import dcmread
+
+        dataset = dcmread(fetched_path)
+        return Volume(np.expand_dims(dataset.pixel_array, 0))
+
+    def fetch(self, url: str, destination_path: str) -> tuple[str, int]:
+        host = urlparse(url).hostname
+        response = requests.get(
+            url,
+            headers={"Accept": "application/dicom; transfer-syntax=1.2.840.10008.1.2.1"},
+            auth=AWSRequestsAuth(
+                aws_access_key=os.getenv("AWS_ACCESS_KEY_ID", ""),
+                aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY", ""),
+                aws_host=host,
+                aws_region=host.split(".")[1] if host.count(".") > 2 else os.getenv("AWS_REGION", "us-east-1"),
+                aws_service="medical-imaging",
+            ),
+            timeout=60,
+        )
+        response.raise_for_status()
+        file_path = os.path.join(destination_path, "instance.dcm")
+        with open(file_path, "wb") as fp:
+            fp.write(response.content)
+        return file_path, len(response.content)
+
+
+class S3Backend:
+    """Downloads S3 objects with parallel multipart ranged GETs."""
+
+    def __init__(self, client=None):
+        self._client = client
+
+    @property
+    def s3_client(self):
+        return self._client or s3_client()
+
+    def estimate_voxels(self, url: str, destination_path: str) -> Optional[int]:
+        return None
+
+    def decode(self, fetched_path: str, destination_path: str) -> Optional[Volume]:
+        return None
+
+    def fetch(self, url: str, destination_path: str) -> tuple[str, int]:
+        bucket_name, key = url.replace("s3://", "").split("/", 1)
+        file_path = os.path.join(destination_path, os.path.basename(key))
+        self.s3_client.download_file(Bucket=bucket_name, Key=key, Filename=file_path, Config=s3_transfer_config)
+        return file_path, os.path.getsize(file_path)
+
+
+class HealthImagingBackend:
+    """
+    Fetches every HTJ2K frame of an image set with the `ahi-retrieve` batch tool, decodes
+    them on the GPU with nvImageCodec and assembles a NIfTI volume in slice order.
+    """
+
+    def __init__(self, client=None, decoder=None):
+        self._client = client
+        self._decoder = decoder
+
+    @property
+    def ahi_client(self):
+        return self._client or ahi_client()
+
+    @property
+    def decoder(self):
+        return self._decoder or image_decoder()
+
+    @staticmethod
+    def frame_order(metadata: dict) -> tuple[list[str], dict]:
+        """
+        Order the frames of the largest series by position along the slice axis.
+
+        Args:
+            metadata (dict): The image set metadata.
+
+        Returns:
+            tuple[list[str], dict]: The ordered frame IDs and the DICOM attributes of the first instance.
+        """
+        series = max(metadata["Study"]["Series"].values(), key=lambda s: len(s["Instances"]))
+        frames = []
+        for instance in series["Instances"].values():
+            dicom = instance.get("DICOM", {})
+            position = dicom.get("ImagePositionPatient")
+            order = float(position[2]) if position else float(dicom.get("InstanceNumber", 0))
+            for frame in instance["ImageFrames"]:
+                frames.append((order, frame["ID"], dicom))
+        frames.sort(key=lambda f: f[0])
+        return [f[1] for f in frames], frames[0][2] if frames else {}
+
+    def fetch_metadata(self, url: str, destination_path: str) -> bytes:
+        """Image set metadata, written to `imagesetmetadata.json` in `destination_path` and read from there afterwards."""
+        metadata_file = os.path.join(destination_path, "imagesetmetadata.json")
+        if os.path.isfile(metadata_file):
+            with open(metadata_file, "rb") as fp:
+                return fp.read()
+        datastoreId, imageSetId = url.replace("healthimaging://", "").split("/")[:2]
+        response = self.ahi_client.get_image_set_metadata(datastoreId=datastoreId, imageSetId=imageSetId)
+        raw_metadata = gzip.decompress(response["imageSetMetadataBlob"].read())
+        with open(metadata_file, "wb") as fp:
+            fp.write(raw_metadata)
+        return raw_metadata
+
+    def estimate_voxels(self, url: str, destination_path: str) -> Optional[int]:
+        """Voxels of the volume `decode` will assemble, from the frame count and Rows/Columns."""
+        frame_ids, dicom = self.frame_order(json.loads(self.fetch_metadata(url, destination_path)))
+        if not dicom.get("Rows") or not dicom.get("Columns"):
+            return None
+        return len(frame_ids) * int(dicom["Rows"]) * int(dicom["Columns"])
+
+    def fetch(self, url: str, destination_path: str) -> tuple[str, int]:
+        datastoreId, imageSetId = url.replace("healthimaging://", "").split("/")[:2]
+        # Already written if admission control estimated the request from it.
+        raw_metadata = self.fetch_metadata(url, destination_path)
+        metadata_file = os.path.join(destination_path, "imagesetmetadata.json")
+
+        # ahi-retrieve writes <datastoreId>/<imageSetId>/<frameId>.jph relative to its working directory.
+        subprocess.run(
+            [
+                AHI_RETRIEVE_BIN,
+                "-i", metadata_file,
+                "-r", os.getenv("AWS_REGION", "us-east-1"),
+                "-a", os.getenv("AWS_ACCESS_KEY_ID", ""),
+                "-s", os.getenv("AWS_SECRET_ACCESS_KEY", ""),
+                "-f", "jph",
+            ],
+            cwd=destination_path,
+            check=True,
+        )
+
+        image_path = os.path.join(destination_path, datastoreId, imageSetId)
+        return image_path, len(raw_metadata) + sum(
+            os.path.getsize(os.path.join(image_path, p)) for p in os.listdir(image_path)
+        )
+
+    def decode(self, fetched_path: str, destination_path: str) -> Optional[Volume]:
+        with open(os.path.join(destination_path, "imagesetmetadata.json")) as fp:
+            frame_ids, dicom = self.frame_order(json.load(fp))
+        file_list = [os.path.join(fetched_path, f"{frame_id}.jph") for frame_id in frame_ids]
+        if not all(os.path.isfile(f) for f in file_list):
+            file_list = sorted(os.path.join(fetched_path, p) for p in os.listdir(fetched_path))
+
+        import cupy as cp
+
+        slices = [cp.asnumpy(cp.asarray(i))[:, :, -1] for i in self.decoder.read(file_list)]
+        with timed("volume_assembly"):
+            array = np.stack(slices)
+        spacing = origin = None
+        if dicom.get("PixelSpacing"):
+            row_spacing, col_spacing = (float(v) for v in dicom["PixelSpacing"])
+            spacing = (col_spacing, row_spacing, float(dicom.get("SliceThickness") or 1.0))
+        if dicom.get("ImagePositionPatient"):
+            origin = tuple(float(v) for v in dicom["ImagePositionPatient"])
+        return Volume(array, spacing, origin)
+
+
+def image_shape(image_file: str) -> list[int]:
+    """Size of an image file in (x, y, z) order, read from its header only."""
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(image_file)
+    reader.ReadImageInformation()
+    return list(reader.GetSize())
+
+
+class FileDownloader:
+    """
+    Single fetch layer for inference inputs. Dispatches to a per-scheme backend and
+    records the transferred bytes and throughput of the last download.
+    """
+
+    def __init__(self, url: str, protocol: str, s3_client=None, ahi_client=None, decoder=None):
+        self.url = url
+        self.protocol = protocol
+        self.backends = {
+            "http": HttpBackend(),
+            "https": HttpBackend(),
+            "dicomweb": DicomWebBackend(),
+            "s3": S3Backend(s3_client),
+            "healthimaging": HealthImagingBackend(ahi_client, decoder),
+        }
+        self.bytes = 0
+        self.elapsed = 0.0
+
+    @property
+    def backend_name(self) -> str:
+        if self.protocol == "https" and (urlparse(self.url).hostname or "").startswith("dicom-medical-imaging."):
+            return "dicomweb"
+        return self.protocol
+
+    @property
+    def throughput(self) -> float:
+        """Bytes per second of the last download."""
+        return self.bytes / self.elapsed if self.elapsed > 0 else 0.0
+
+    def fetch(self, destination_path: str) -> Optional[str]:
+        """
+        Transfer the source into `destination_path` without decoding it.
+
+        Args:
+            destination_path (str): The path where the downloaded file should be saved.
+
+        Returns:
+            str: The path to the downloaded file or frame directory, or None if the download failed.
+        """
+        backend = self.backends.get(self.backend_name)
+        if backend is None:
+            logging.error(f"Unsupported protocol: {self.protocol}")
+            return None
+
+        start_ts = time.time()
+        try:
+            file_path, self.bytes = backend.fetch(self.url, destination_path)
+        except (requests.exceptions.RequestException, ClientError, subprocess.CalledProcessError, OSError) as e:
+            logging.error(f"Error downloading {self.url} with {self.backend_name} backend: {e}")
+            return None
+        self.elapsed = time.time() - start_ts
+        DOWNLOAD_BYTES.labels(self.backend_name).inc(self.bytes)
+        logging.info(
+            f"Downloaded {self.url} via {self.backend_name}: {self.bytes} bytes in {self.elapsed:.2f}s "
+            f"({self.throughput / MB:.1f} MB/s)"
+        )
+        return file_path
+
+    def estimate_voxels(self, destination_path: str) -> Optional[int]:
+        """
+        Voxels of the input volume before it is downloaded, where the source tells cheaply.
+
+        Args:
+            destination_path (str): The request working directory.
+
+        Returns:
+            int: The voxel count, or None if the backend cannot tell or the lookup failed.
+        """
+        backend = self.backends.get(self.backend_name)
+        if backend is None:
+            return None
+        try:
+            return backend.estimate_voxels(self.url, destination_path)
+        except (ClientError, OSError, ValueError, KeyError) as e:
+            logging.warning(f"Unable to estimate the size of {self.url}: {e}")
+            return None
+
+    def decode(self, fetched_path: str, destination_path: str) -> Optional[Volume]:
+        """
+        Decode fetched DICOM/HTJ2K data into a volume.
+
+        Args:
+            fetched_path (str): The path returned by `fetch`.
+            destination_path (str): The request working directory.
+
+        Returns:
+            Volume: The decoded volume, or None if `fetched_path` can be handed to Triton as is.
+        """
+        return self.backends[self.backend_name].decode(fetched_path, destination_path)
+
+    def download_file(self, destination_path: str) -> Optional[str]:
+        """
+        Download a file based on the provided protocol and URL, converting it to NIfTI if needed.
+
+        Args:
+            destination_path (str): The path where the downloaded file should be saved.
+
+        Returns:
+            str: The path to the downloaded file, or None if the download failed.
+        """
+        file_path = self.fetch(destination_path)
+        if file_path is None:
+            return None
+        volume = self.decode(file_path, destination_path)
+        if volume is None:
+            return file_path
+        return write_volume(volume, os.path.join(destination_path, "example-1.nii.gz"))
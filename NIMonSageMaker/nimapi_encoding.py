@@ -0,0 +1,234 @@
+import logging
+import os
+import struct
+import zlib
+from typing import Iterator, Optional
+
+import anyio
+import numpy as np
+import SimpleITK as sitk
+from fastapi import BackgroundTasks
+from fastapi.responses import Response
+from starlette.types import Receive, Scope, Send
+
+
+# Media types understood by the `/vista3d/inference` endpoint. The first entry of
+# an `Accept` header that matches one of these selects the output encoding; an
+# absent or wildcard `Accept` keeps the file Triton wrote untouched.
+MEDIA_TYPE_NATIVE = "application/octet-stream"
+MEDIA_TYPE_RAW = "application/x-vista3d-raw"
+MEDIA_TYPE_NIFTI_GZ = "application/x-nifti-gz"
+MEDIA_TYPE_RLE = "application/x-vista3d-rle"
+
+ENCODINGS = {
+    MEDIA_TYPE_RAW: "raw",
+    MEDIA_TYPE_NIFTI_GZ: "nifti-gz",
+    "application/gzip": "nifti-gz",
+    MEDIA_TYPE_RLE: "rle",
+}
+
+DEFAULT_COMPRESSION_LEVEL = int(os.getenv("NIMS_OUTPUT_COMPRESSION_LEVEL", "6"))
+STREAM_CHUNK_SIZE = int(os.getenv("NIMS_OUTPUT_CHUNK_SIZE", str(1024 * 1024)))
+
+# Header layout shared by the raw and RLE encodings (all little-endian):
+#   4s  magic (b"V3DR" or b"V3DL")
+#   B   format version
+#   c   numpy dtype character of the voxel (raw) or run value (RLE) array
+#   B   number of dimensions N
+#   x   padding
+#   N*I shape, slowest axis first (z, y, x)
+#   N*d spacing, fastest axis first (x, y, z) as reported by SimpleITK
+#   N*d origin
+#   N*N*d direction cosines
+# The RLE body is a uint64 run count followed by the run values and the uint32 run lengths.
+RAW_MAGIC = b"V3DR"
+RLE_MAGIC = b"V3DL"
+FORMAT_VERSION = 1
+
+
+def negotiate_encoding(accept: Optional[str]) -> tuple[str, Optional[int]]:
+    """
+    Select the output encoding for a response from the request `Accept` header.
+
+    Args:
+        accept (str): The raw `Accept` header value, e.g. `application/x-nifti-gz; level=1`.
+
+    Returns:
+        tuple[str, int]: The encoding name ("native", "raw", "nifti-gz" or "rle") and the
+                         compression level requested through the `level` media type parameter,
+                         or None if the client did not ask for one.
+    """
+    level = None
+    if not accept:
+        return "native", level
+
+    for media_range in accept.split(","):
+        media_type, *params = [p.strip() for p in media_range.split(";")]
+        encoding = ENCODINGS.get(media_type.lower())
+        if not encoding:
+            continue
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "level":
+                try:
+                    level = min(max(int(value.strip()), 0), 9)
+                except ValueError:
+                    logging.warning(f"Ignoring invalid compression level: {value}")
+        return encoding, level
+
+    return "native", level
+
+
+def _header(magic: bytes, image: sitk.Image, shape: tuple, dtype: np.dtype) -> bytes:
+    ndim = len(shape)
+    header = struct.pack("<4sBcBx", magic, FORMAT_VERSION, dtype.char.encode(), ndim)
+    header += struct.pack(f"<{ndim}I", *shape)
+    header += struct.pack(f"<{ndim}d", *image.GetSpacing())
+    header += struct.pack(f"<{ndim}d", *image.GetOrigin())
+    header += struct.pack(f"<{ndim * ndim}d", *image.GetDirection())
+    return header
+
+
+def _label_dtype(array: np.ndarray) -> np.dtype:
+    """Smallest unsigned little-endian dtype that holds every label in the mask."""
+    if array.size == 0 or (array.min() >= 0 and array.max() <= np.iinfo(np.uint8).max):
+        return np.dtype("<u1")
+    if array.min() >= 0 and array.max() <= np.iinfo(np.uint16).max:
+        return np.dtype("<u2")
+    return array.dtype.newbyteorder("<")
+
+
+def _chunks(buffer: memoryview, chunk_size: int) -> Iterator[bytes]:
+    for offset in range(0, len(buffer), chunk_size):
+        yield bytes(buffer[offset : offset + chunk_size])
+
+
+def rle_encode(array: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Run-length encode a label map in C (z, y, x) order.
+
+    Args:
+        array (np.ndarray): The label map.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The value of each run and its length.
+    """
+    flat = array.ravel()
+    if flat.size == 0:
+        return flat[:0], np.zeros(0, dtype="<u4")
+    starts = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1))
+    lengths = np.diff(np.append(starts, flat.size))
+    # A uint32 run covers ~4G voxels; split longer runs so the length array never overflows.
+    max_run = np.iinfo(np.uint32).max
+    if lengths.max() > max_run:
+        repeats = -(-lengths // max_run)
+        values = np.repeat(flat[starts], repeats)
+        split = np.full(repeats.sum(), max_run, dtype=np.int64)
+        split[np.cumsum(repeats) - 1] = lengths - (repeats - 1) * max_run
+        return values, split.astype("<u4")
+    return flat[starts], lengths.astype("<u4")
+
+
+def rle_decode(values: np.ndarray, lengths: np.ndarray, shape: tuple) -> np.ndarray:
+    """Inverse of `rle_encode`."""
+    return np.repeat(values, lengths.astype(np.int64)).reshape(shape)
+
+
+def stream_raw(pred_file: str, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Stream a prediction as a small header followed by little-endian voxels in (z, y, x) order.
+
+    Args:
+        pred_file (str): The prediction file written by Triton.
+        chunk_size (int): Size of each yielded chunk in bytes.
+    """
+    image = sitk.ReadImage(pred_file)
+    array = sitk.GetArrayViewFromImage(image)
+    dtype = _label_dtype(array)
+    array = np.ascontiguousarray(array, dtype=dtype)
+    yield _header(RAW_MAGIC, image, array.shape, dtype)
+    yield from _chunks(memoryview(array).cast("B"), chunk_size)
+
+
+def stream_rle(pred_file: str, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Stream a prediction as a run-length encoded label map.
+
+    Args:
+        pred_file (str): The prediction file written by Triton.
+        chunk_size (int): Size of each yielded chunk in bytes.
+    """
+    image = sitk.ReadImage(pred_file)
+    array = sitk.GetArrayViewFromImage(image)
+    dtype = _label_dtype(array)
+    values, lengths = rle_encode(array)
+    values = values.astype(dtype, copy=False)
+    yield _header(RLE_MAGIC, image, array.shape, dtype) + struct.pack("<Q", values.size)
+    yield from _chunks(memoryview(np.ascontiguousarray(values)).cast("B"), chunk_size)
+    yield from _chunks(memoryview(np.ascontiguousarray(lengths)).cast("B"), chunk_size)
+
+
+def stream_nifti_gz(
+    pred_file: str, working_dir: str, level: Optional[int] = None, chunk_size: int = STREAM_CHUNK_SIZE
+) -> Iterator[bytes]:
+    """
+    Stream a prediction as gzip-compressed NIfTI at the requested compression level.
+
+    The volume is written once as uncompressed NIfTI and gzip-compressed chunk by chunk
+    while it is sent, so the first bytes leave before the whole mask is compressed.
+
+    Args:
+        pred_file (str): The prediction file written by Triton.
+        working_dir (str): Request scoped directory for the intermediate NIfTI file.
+        level (int): zlib compression level, 0 (store) to 9 (smallest). Defaults to NIMS_OUTPUT_COMPRESSION_LEVEL.
+        chunk_size (int): Size of each chunk read from the intermediate file.
+    """
+    nifti_file = os.path.join(working_dir, "pred.nii")
+    sitk.WriteImage(sitk.ReadImage(pred_file), nifti_file, useCompression=False)
+
+    level = DEFAULT_COMPRESSION_LEVEL if level is None else level
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    with open(nifti_file, "rb") as fp:
+        while chunk := fp.read(chunk_size):
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+    yield compressor.flush()
+
+
+def output_filename(pred_file: str, encoding: str) -> str:
+    """Name of the attachment returned for an encoded prediction."""
+    name = os.path.basename(pred_file)
+    for ext in (".nii.gz", ".nii", ".nrrd", ".mha", ".nhdr"):
+        if name.endswith(ext):
+            name = name[: -len(ext)]
+            break
+    return {
+        "raw": f"{name}.v3draw",
+        "nifti-gz": f"{name}.nii.gz",
+        "rle": f"{name}.v3drle",
+    }.get(encoding, os.path.basename(pred_file))
+
+
+class CleanupResponse(Response):
+    """
+    Sends `response`, then runs `background` however the send ended.
+
+    Starlette runs a response's background tasks only after the whole body went out, so a
+    body that fails to stream or a client that disconnects would leak what they release,
+    such as the request's admission ticket and working directory.
+    """
+
+    def __init__(self, response: Response, background: BackgroundTasks):
+        self.response = response
+        self.status_code = response.status_code
+        self.raw_headers = response.raw_headers
+        self.background = background
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await self.response(scope, receive, send)
+        finally:
+            # Shielded, so the tasks also run when the request is cancelled.
+            with anyio.CancelScope(shield=True):
+                await self.background()
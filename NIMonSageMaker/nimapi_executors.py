@@ -0,0 +1,112 @@
+import asyncio
+import contextvars
+import multiprocessing
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable
+
+from .metrics import current_timer
+
+
+class StageExecutor:
+    """
+    Bounded executor for one stage of request processing.
+
+    Work submitted through `run` waits on an asyncio semaphore, so at most `max_workers`
+    calls of the stage are in flight and the rest queue on the event loop without occupying
+    a worker. The event loop itself never runs the blocking call. Queue wait and run time
+    are recorded as `<name>_queue` and `<name>` in the timer of the calling request.
+    """
+
+    def __init__(self, name: str, max_workers: int, kind: str = "thread"):
+        """
+        Args:
+            name (str): Stage name used in metrics.
+            max_workers (int): Worker threads/processes, which is also the stage concurrency limit.
+            kind (str): "thread" for I/O or GIL-releasing work, "process" for pure-Python CPU work.
+        """
+        self.name = name
+        self.kind = kind
+        self.max_workers = max_workers
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_time = 0.0
+        self._semaphore = asyncio.Semaphore(max_workers)
+        self._executor: Executor = None
+
+    @property
+    def executor(self) -> Executor:
+        # Created on first use: process pools must not be forked before the event loop and CUDA are up.
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.name)
+        return self._executor
+
+    async def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run `fn(*args, **kwargs)` on the stage executor once a slot is free."""
+        timer = current_timer.get()
+        queued_ts = time.perf_counter()
+        self.queued += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.queued -= 1
+        wait = time.perf_counter() - queued_ts
+        self.wait_time += wait
+        if timer:
+            timer.record(f"{self.name}_queue", wait)
+
+        call = partial(fn, *args, **kwargs)
+        if self.kind == "thread":
+            # Threads see the request context, so work inside `fn` can record finer stages.
+            call = partial(contextvars.copy_context().run, call)
+        self.active += 1
+        start_ts = time.perf_counter()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, call)
+            self.completed += 1
+            return result
+        except BaseException:
+            self.failed += 1
+            raise
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+            if timer:
+                timer.record(self.name, time.perf_counter() - start_ts)
+
+    def stats(self) -> dict:
+        return {
+            "kind": self.kind,
+            "max_workers": self.max_workers,
+            "queued": self.queued,
+            "active": self.active,
+            "completed": self.completed,
+            "failed": self.failed,
+            "wait_time": round(self.wait_time, 3),
+        }
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+# fetch:  source version lookups, downloads and the ahi-retrieve subprocess (network bound)
+# decode: DICOM/HTJ2K decode and volume assembly (GPU decoder and numpy, release the GIL)
+# write:  gzip NIfTI encoding of assembled volumes (CPU bound, isolated in processes)
+# infer:  blocking Triton gRPC calls
+stages = {
+    "fetch": StageExecutor("fetch", int(os.getenv("NIMS_FETCH_WORKERS", "8"))),
+    "decode": StageExecutor("decode", int(os.getenv("NIMS_DECODE_WORKERS", "2"))),
+    "write": StageExecutor("write", int(os.getenv("NIMS_WRITE_PROCESSES", "2")), kind="process"),
+    "infer": StageExecutor("infer", int(os.getenv("NIMS_INFER_WORKERS", "4"))),
+}
@@ -1,51 +1,74 @@
-import gzip
 import json
 import logging
 import mimetypes
 import os
-import subprocess
 import tempfile
 import time
 import uuid
 from typing import Optional
-from io import BytesIO
 
 import numpy as np
 import requests
 import tritonclient.grpc as grpcclient
 from fastapi import BackgroundTasks, FastAPI, HTTPException, Request, status
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import FileResponse, JSONResponse
-from monai.transforms import LoadImage
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from nvcf_helper_functions import helpers
 from tritonclient.utils import np_to_triton_dtype
-import SimpleITK as sitk
-from nvidia import nvimgcodec
-from pydicom import dcmread
-import cupy as cp
-import boto3
-from botocore.config import Config
-from botocore.exceptions import ClientError
-from aws_requests_auth.aws_auth import AWSRequestsAuth
 
+from .admission import AdmissionController, AdmissionRejected, RequestCost, Ticket
+from .cache import VolumeCache
+from .clients import ahi_client, s3_client
+from .downloader import FileDownloader, image_shape, write_volume
+from .encoding import (
+    CleanupResponse,
+    MEDIA_TYPE_NIFTI_GZ,
+    MEDIA_TYPE_RAW,
+    MEDIA_TYPE_RLE,
+    negotiate_encoding,
+    output_filename,
+    stream_nifti_gz,
+    stream_raw,
+    stream_rle,
+)
+from .executors import stages
+from .metrics import (
+    IMAGE_CACHE,
+    IMAGE_VOXELS,
+    REQUEST_SECONDS,
+    REQUESTS,
+    RequestTimer,
+    current_timer,
+    register_admission_collector,
+    register_stage_collector,
+    register_triton_collector,
+)
 from .schemas import BadInputError, InferenceRequest, ModelInfo
-from .utils import get_filename_from_cd, is_url, remove_file
+from .utils import is_url, remove_file
 
 
 parent_dir = os.path.dirname(os.path.abspath(__file__))
 triton_dir = os.path.join(os.path.dirname(parent_dir), "triton")
 bundle_root = os.path.join(triton_dir, "vista3d", "1")
-s3 = boto3.client('s3')
-my_config = Config(region_name = os.getenv('AWS_REGION', 'us-east-1'))
-ahi = boto3.client('medical-imaging', config=my_config)
-decoder = nvimgcodec.Decoder()
+volume_cache = VolumeCache(
+    cache_dir=os.getenv("NIMS_CACHE_DIR", os.path.join(tempfile.gettempdir(), "vista3d-volume-cache")),
+    max_bytes=int(os.getenv("NIMS_CACHE_MAX_BYTES", str(4 * 1024**3))),
+    max_entries=int(os.getenv("NIMS_CACHE_MAX_ENTRIES", "64")),
+    ttl=float(os.getenv("NIMS_CACHE_TTL", "300")),
+)
+admission = AdmissionController.from_env()
 
 class HealthCheckFilter(logging.Filter):
     def filter(self, record: logging.LogRecord) -> bool:
-        return record.getMessage().find("/health") == -1
+        message = record.getMessage()
+        return message.find("/health") == -1 and message.find("/metrics") == -1
 
 
 logging.getLogger("uvicorn.access").addFilter(HealthCheckFilter())
+register_stage_collector(stages)
+register_admission_collector(admission)
+register_triton_collector("localhost:8001", "vista3d")
 
 
 async def input_exception_handler(request: Request, exc: BadInputError) -> JSONResponse:
@@ -62,6 +85,14 @@ async def servicedown_exception_handler(request: Request, exc: ConnectionRefused
     )
 
 
+async def admission_exception_handler(request: Request, exc: AdmissionRejected) -> JSONResponse:
+    return JSONResponse(
+        status_code=exc.status_code,
+        content=jsonable_encoder({"error_msg": [{"msg": exc.message}]}),
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
 app = FastAPI(
     title="VISTA-3D NVIDIA MicroService APIs",
     description="VISTA-3D is a specialized interactive foundation model for segmenting and annotating human anatomies.",
@@ -77,6 +108,7 @@ app = FastAPI(
 )
 app.add_exception_handler(BadInputError, input_exception_handler)
 app.add_exception_handler(ConnectionRefusedError, servicedown_exception_handler)
+app.add_exception_handler(AdmissionRejected, admission_exception_handler)
 
 
 @app.get(
@@ -86,7 +118,7 @@ app.add_exception_handler(ConnectionRefusedError, servicedown_exception_handler)
     summary="Check if service is ready",
     description="Check if service is ready and model is ready for inference",
 )
-async def health_ready() -> bool:
+def health_ready() -> bool:
     client = grpcclient.InferenceServerClient(url="localhost:8001", verbose=True)
     return client.is_server_ready() and client.is_model_ready("vista3d")
 
@@ -98,7 +130,7 @@ async def health_ready() -> bool:
     summary="Check if service is live",
     description="Check if service is up and running",
 )
-async def health_live() -> bool:
+def health_live() -> bool:
     client = grpcclient.InferenceServerClient(url="localhost:8001", verbose=True)
     return client.is_server_live()
 
@@ -122,111 +154,6 @@ async def info() -> ModelInfo:
     )
 
 
-@app.post(
-    path="/vista3d/inference",
-    operation_id="inference",
-    tags=["Models"],
-    summary="Run Inference",
-    description="Run Inference function of a model for segmenting and annotating human anatomies",
-    responses={
-        200: {
-            "description": "OK",
-            "content": {
-                "application/octet-stream": {"schema": {"type": "string", "format": "binary"}},
-            },
-        },
-    },
-)
-
-
-class FileDownloader:
-    def __init__(self, url: str, protocol: str):
-        self.url = url
-        self.protocol = protocol
-
-    def download_from_http(self, destination_path: str) -> Optional[str]:
-        """
-        Download a file from an HTTP/HTTPS URL.
-
-        Args:
-            destination_path (str): The path where the downloaded file should be saved.
-
-        Returns:
-            str: The path to the downloaded file, or None if the download failed.
-        """
-        try:
-            response = requests.get(self.url, stream=True)
-            response.raise_for_status()
-
-            file_path = os.path.join(destination_path, os.path.basename(self.url))
-            with open(file_path, 'wb') as file:
-                for chunk in response.iter_content(chunk_size=8192):
-                    file.write(chunk)
-
-            return file_path
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Error downloading from HTTP/HTTPS: {e}")
-            return None
-
-    def download_from_s3(self, destination_path: str) -> Optional[str]:
-        """
-        Download a file from an S3 bucket.
-
-        Args:
-            destination_path (str): The path where the downloaded file should be saved.
-
-        Returns:
-            str: The path to the downloaded file, or None if the download failed.
-        """
-        try:
-            bucket_name, key = self.url.replace('s3://', '').split('/', 1)
-            file_path = os.path.join(destination_path, os.path.basename(key))
-
-            s3.download_file(Bucket=bucket_name, Key=key, Filename=file_path)
-            return file_path
-        except ClientError as e:
-            logging.error(f"Error downloading from S3: {e}")
-            return
-
-    def download_from_ahi(self, destination_path: str) -> Optional[str]:
-        """
-        Download a file from Amazon Health Imaging.
-
-        Args:
-            destination_path (str): The path where the downloaded file should be saved.
-
-        Returns:
-            str: The path to the downloaded file, or None if the download failed.
-        """
-        try:
-            # Implement the logic to download from Amazon Health Imaging
-            # using the self.ahi_client and self.url
-            pass
-        except Exception as e:
-            logging.error(f"Error downloading from Amazon Health Imaging: {e}")
-            return None
-
-    def download_file(self, destination_path: str) -> Optional[str]:
-        """
-        Download a file based on the provided protocol and URL.
-
-        Args:
-            destination_path (str): The path where the downloaded file should be saved.
-
-        Returns:
-            str: The path to the downloaded file, or None if the download failed.
-        """
-        if self.protocol == 'http' or self.protocol == 'https':
-            return self.download_from_http(destination_path)
-        elif self.protocol == 's3':
-            return self.download_from_s3(destination_path)
-        elif self.protocol == 'healthimaging':
-            return self.download_from_ahi(destination_path)
-        else:
-            logging.error(f"Unsupported protocol: {self.protocol}")
-            return None
-
-
 async def parse_url(url: str) -> tuple[str, str]:
     """
     Parse a URL string and return a tuple containing the URL and the matched protocol.
@@ -261,13 +188,137 @@ async def parse_url(url: str) -> tuple[str, str]:
     return url, matched_protocol
 
 
+def probe_source(url: str, protocol: str) -> tuple[Optional[str], Optional[int]]:
+    """
+    Look up a cheap version identifier of the image source for the input-volume cache, and
+    its size for admission control, with a single metadata request.
+
+    Args:
+        url (str): The image URL.
+        protocol (str): The protocol returned by `parse_url`.
+
+    Returns:
+        tuple[Optional[str], Optional[int]]: The S3 VersionId/ETag, HTTP ETag/Last-Modified or
+            HealthImaging image set version, and the S3 ContentLength or HTTP Content-Length;
+            None where the source exposes neither.
+    """
+    try:
+        if protocol == 's3':
+            bucket_name, key = url.replace('s3://', '').split('/', 1)
+            head = s3_client().head_object(Bucket=bucket_name, Key=key)
+            return head.get('VersionId') or head.get('ETag'), head.get('ContentLength')
+        elif protocol == 'healthimaging':
+            datastoreId, imageSetId = url.replace('healthimaging://', '').split('/')[:2]
+            return ahi_client().get_image_set(datastoreId=datastoreId, imageSetId=imageSetId).get('versionId'), None
+        elif protocol in ('http', 'https') and not url.startswith("https://dicom-medical-imaging"):
+            response = requests.head(url, allow_redirects=True, timeout=10)
+            size = response.headers.get('Content-Length')
+            return (
+                response.headers.get('ETag') or response.headers.get('Last-Modified'),
+                int(size) if size and size.isdigit() else None,
+            )
+    except Exception as e:
+        logging.warning(f"Unable to determine version of {url}: {e}")
+    return None, None
+
+
+async def estimate_cost(
+    image_file: Optional[str], downloader: Optional[FileDownloader], source_size: Optional[int], working_dir: str
+) -> RequestCost:
+    """
+    Estimate a request's cost before anything is downloaded: from the header of a cached
+    volume, from the HealthImaging metadata, else from the source size.
+    """
+    try:
+        if image_file:
+            return RequestCost.from_voxels(int(np.prod(await stages["fetch"].run(image_shape, image_file))), "header")
+        if downloader:
+            voxels = await stages["fetch"].run(downloader.estimate_voxels, working_dir)
+            if voxels:
+                return RequestCost.from_voxels(voxels, "metadata")
+    except Exception as e:
+        logging.warning(f"Unable to estimate the size of {image_file or downloader.url}: {e}")
+    return RequestCost.from_source_bytes(source_size)
+
+
+@app.get(
+    path="/health/stages",
+    operation_id="healthstages",
+    tags=["Health"],
+    summary="Request stage executors",
+    description="Queue depth, in-flight and completed work of each request processing stage",
+)
+async def health_stages() -> dict:
+    return {name: stage.stats() for name, stage in stages.items()}
+
+
+@app.get(
+    path="/health/admission",
+    operation_id="healthadmission",
+    tags=["Health"],
+    summary="Admission control",
+    description="Memory budget in use, admitted and waiting requests of admission control",
+)
+async def health_admission() -> dict:
+    return admission.stats()
+
+
+@app.get(
+    path="/metrics",
+    operation_id="metrics",
+    tags=["Health"],
+    summary="Prometheus metrics",
+    description="Per-stage latency histograms, request counters and stage queue depths in Prometheus text format",
+)
+def metrics() -> Response:
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.on_event("shutdown")
+def shutdown_stages() -> None:
+    for stage in stages.values():
+        stage.shutdown()
+
+
+async def release_ticket(ticket: Ticket) -> None:
+    # async, so Starlette runs it on the event loop with the rest of admission control
+    # instead of in its threadpool.
+    ticket.release()
+
+
+@app.post(
+    path="/vista3d/inference",
+    operation_id="inference",
+    tags=["Models"],
+    summary="Run Inference",
+    description="Run Inference function of a model for segmenting and annotating human anatomies",
+    responses={
+        200: {
+            "description": "OK",
+            "content": {
+                "application/octet-stream": {"schema": {"type": "string", "format": "binary"}},
+                MEDIA_TYPE_RAW: {"schema": {"type": "string", "format": "binary"}},
+                MEDIA_TYPE_NIFTI_GZ: {"schema": {"type": "string", "format": "binary"}},
+                MEDIA_TYPE_RLE: {"schema": {"type": "string", "format": "binary"}},
+            },
+        },
+    },
+)
 async def inference(request: InferenceRequest, background_tasks: BackgroundTasks, http_request: Request):
     success = False
     headers = http_request.headers
     start_ts = time.time()
     image_fetch_ts = 0.0
     image_file = None
+    image_size = None
+    image_cache_hit = False
+    download_throughput = 0.0
     output = None
+    ticket = None
+    cost = None
+    rejected = False
+    timer = RequestTimer()
+    current_timer.set(timer)
 
     try:
         image_url = request.image
@@ -275,101 +326,59 @@ async def inference(request: InferenceRequest, background_tasks: BackgroundTasks
         working_dir = os.path.join(root_dir, tempfile.NamedTemporaryFile().name)
         os.makedirs(working_dir, exist_ok=True)
         
-        logging.info(f"Downloading Remote URI => {image_file}")
+        logging.info(f"Downloading Remote URI => {image_url}")
 
         url, protocol = await parse_url(image_url)
-        downloader = FileDownloader(url, protocol)
-        donwnloader.download_file(working_dir)
-
+        version, source_size = await stages["fetch"].run(probe_source, url, protocol)
+        cache_key = VolumeCache.make_key(url, version)
+        image_file = volume_cache.get(cache_key, working_dir)
+        image_cache_hit = image_file is not None
+        IMAGE_CACHE.labels("hit" if image_cache_hit else "miss").inc()
+
+        downloader = None
+        if not image_cache_hit:
+            if not protocol:
+                output = {"error": "Invalid Image URL"}
+                raise HTTPException(status_code=422, detail=output["error"])
+            downloader = FileDownloader(url, protocol)
 
-        
+        # Wait for memory before downloading or decoding anything.
+        cost = await estimate_cost(image_file, downloader, source_size, working_dir)
+        try:
+            ticket = await admission.admit(cost)
+        except AdmissionRejected:
+            rejected = True
+            remove_file(working_dir)
+            raise
+
+        if not image_cache_hit:
+            image_file = await stages["fetch"].run(downloader.fetch, working_dir)
+            download_throughput = downloader.throughput
+        background_tasks.add_task(remove_file, working_dir)
+
+        if not image_file:
+            output = {"error": f"Unable to fetch image from {image_url}"}
+            raise HTTPException(status_code=422, detail=output["error"])
 
-        if is_url(image_url) and image_url.startswith("http"):
-            if image_url.startswith("https://dicom-medical-imaging.us-east-1.amazonaws.com"):
-                headers = {
-                    'Accept': 'application/dicom; transfer-syntax=1.2.840.10008.1.2.1',
-                }
-                r = requests.get(
-                    image_url,
-                    headers=headers,
-                    auth=AWSRequestsAuth(
-                        aws_access_key=os.getenv('AWS_ACCESS_KEY_ID', ''), 
-                        aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY', ''), 
-                        aws_host='dicom-medical-imaging.us-east-1.amazonaws.com', 
-                        aws_region=os.getenv('AWS_REGION', 'us-east-1'), 
-                        aws_service='medical-imaging'
-                    ),
+        volume = None
+        if not image_cache_hit:
+            volume = await stages["decode"].run(downloader.decode, image_file, working_dir)
+            if volume is not None:
+                image_file = await stages["write"].run(
+                    write_volume, volume, os.path.join(working_dir, "example-1.nii.gz")
                 )
-                dataset = dcmread(BytesIO(r.content))
-                img = sitk.GetImageFromArray([dataset.pixel_array])
-                image_file = os.path.join(working_dir, 'example-1.nii.gz')
-                background_tasks.add_task(remove_file, working_dir)
-                if not image_file:
-                    output = {"error": "Can't determine filename to download from URI/Content Disposition"}
-                    raise HTTPException(status_code=422, detail=output["error"])
-                sitk.WriteImage(img, image_file)
-            else:
-                r = requests.get(image_url, allow_redirects=True)
-                image_file = os.path.join(working_dir, get_filename_from_cd(image_url, r.headers.get("content-disposition")))
-                background_tasks.add_task(remove_file, working_dir)
-                if not image_file:
-                    output = {"error": "Can't determine filename to download from URI/Content Disposition"}
-                    raise HTTPException(status_code=422, detail=output["error"])
-                with open(image_file, "wb") as fp:
-                    fp.write(r.content)
-        elif image_url.startswith("s3"):
-            path_parts=image_url.replace("s3://","").split("/")
-            bucket=path_parts.pop(0)
-            key="/".join(path_parts)
-            print(f"download s3 object from bucket: {bucket} and key: {key}")
-            image_file = os.path.join(working_dir, path_parts[-1])
-            background_tasks.add_task(remove_file, working_dir)
-            if not image_file:
-                output = {"error": "Can't determine filename to download from URI/Content Disposition"}
-                raise HTTPException(status_code=422, detail=output["error"])
-            with open(image_file, 'wb') as fp:
-                s3.download_fileobj(bucket, key, fp)
-        elif image_url.startswith("healthimaging://"):
-            path_parts=image_url.replace("healthimaging://","").split("/")
-            datastoreId=path_parts[0]
-            imageSetId=path_parts[1]
-            response = ahi.get_image_set_metadata(
-                datastoreId=datastoreId,
-                imageSetId=imageSetId
-            )
-            with open('/opt/nvidia/vista3d/imagesetmetadata.json', 'wb') as fp:
-                fp.write( gzip.decompress(response["imageSetMetadataBlob"].read()) )
-            subprocess.run([
-                "/root/aws-healthimaging-samples/ahi-batch-image-frame-retrieve/build/apps/ahi-retrieve", 
-                "-i", "/opt/nvidia/vista3d/imagesetmetadata.json", 
-                "-r", os.getenv('AWS_REGION', 'us-east-1'), 
-                "-a", os.getenv('AWS_ACCESS_KEY_ID', ''), 
-                "-s", os.getenv('AWS_SECRET_ACCESS_KEY', ''), 
-                "-f", "jph"
-            ])
-            image_path=f"/opt/nvidia/vista3d/{datastoreId}/{imageSetId}/"
-            file_list = []
-            for p in os.listdir(image_path):
-                file_list.append(os.path.join(image_path, p))
-            inputImages = decoder.read(file_list)
-            cp_imgs = []
-            for i in inputImages:
-                frame = cp.asnumpy(cp.asarray(i))
-                cp_imgs.append( frame[:,:,-1] )
-            result_image=sitk.GetImageFromArray(cp_imgs)
-            image_file = os.path.join(working_dir, 'example-1.nii.gz')
-            background_tasks.add_task(remove_file, working_dir)
-            if not image_file:
-                output = {"error": "Can't determine filename to download from URI/Content Disposition"}
-                raise HTTPException(status_code=422, detail=output["error"])
-            sitk.WriteImage(result_image, image_file)
-        else:
-            output = {"error": "Invalid Image URL"}
-            raise HTTPException(status_code=422, detail=output["error"])
-        
+            volume_cache.put(cache_key, image_file, versioned=version is not None)
+
+        # Shape in (x, y, z) order, from the decoded array or the image header; never a full reload.
+        try:
+            image_size = list(reversed(volume.array.shape)) if volume is not None else image_shape(image_file)
+            IMAGE_VOXELS.observe(int(np.prod(image_size)))
+        except Exception as e:
+            logging.warning(f"Unable to read image header of {image_file}: {e}")
+
         request.image = image_file
         image_fetch_ts = round(time.time() - start_ts, 2)
-        print(f"Fetched Image from: {image_url}; Time Lapsed: {image_fetch_ts}")
+        print(f"Fetched Image from: {image_url}; Cache Hit: {image_cache_hit}; Time Lapsed: {image_fetch_ts}")
 
         client = grpcclient.InferenceServerClient(url="localhost:8001", verbose=True)
         inputs = [grpcclient.InferInput("INPUT_REQUEST", [1], np_to_triton_dtype(np.object_))]
@@ -378,18 +387,43 @@ async def inference(request: InferenceRequest, background_tasks: BackgroundTasks
         input_request = request.model_dump_json()
         inputs[0].set_data_from_numpy(np.array([input_request], dtype=np.object_))
 
-        response = client.infer("vista3d", inputs, request_id=str(uuid.uuid4().hex), outputs=outputs)
+        response = await stages["infer"].run(
+            client.infer, "vista3d", inputs, request_id=str(uuid.uuid4().hex), outputs=outputs
+        )
         output = json.loads(response.as_numpy("OUTPUT_RESPONSE")[0].decode())
 
         pred_file = output.get("pred", None) if output else None
         if pred_file and os.path.isfile(pred_file):
-            print(f"Sending Output Mask: {pred_file}")
+            encoding, level = negotiate_encoding(headers.get("accept"))
+            print(f"Sending Output Mask: {pred_file}; Encoding: {encoding}")
+            background_tasks.add_task(timer.record_since, "send", time.perf_counter())
+
+            if encoding == "native" or (encoding == "nifti-gz" and level is None and pred_file.endswith(".nii.gz")):
+                media_types = mimetypes.guess_type(pred_file, strict=False)
+                media_type = "application/octet-stream" if media_types is None or media_types[0] is None else media_types[0]
+
+                success = True
+                return CleanupResponse(
+                    FileResponse(pred_file, media_type=media_type, filename=os.path.basename(pred_file)),
+                    background_tasks,
+                )
 
-            media_types = mimetypes.guess_type(pred_file, strict=False)
-            media_type = "application/octet-stream" if media_types is None or media_types[0] is None else media_types[0]
+            if encoding == "raw":
+                media_type, content = MEDIA_TYPE_RAW, stream_raw(pred_file)
+            elif encoding == "rle":
+                media_type, content = MEDIA_TYPE_RLE, stream_rle(pred_file)
+            else:
+                media_type, content = MEDIA_TYPE_NIFTI_GZ, stream_nifti_gz(pred_file, working_dir, level)
 
             success = True
-            return FileResponse(pred_file, media_type=media_type, filename=os.path.basename(pred_file))
+            return CleanupResponse(
+                StreamingResponse(
+                    content,
+                    media_type=media_type,
+                    headers={"Content-Disposition": f'attachment; filename="{output_filename(pred_file, encoding)}"'},
+                ),
+                background_tasks,
+            )
 
         raise HTTPException(
             status_code=500,
@@ -403,24 +437,43 @@ async def inference(request: InferenceRequest, background_tasks: BackgroundTasks
             "start_time": start_ts,
             "end_time": time.time(),
             "image_fetch_time": image_fetch_ts,
+            "image_cache_hit": image_cache_hit,
+            "download_throughput": round(download_throughput),
             "total_latency": round(time.time() - start_ts, 2),
         }
+        if image_size:
+            properties["image_size"] = image_size
+        if cost:
+            properties["estimated_memory"] = cost.memory_bytes
+        if ticket:
+            # A streamed response still holds its memory until it has been sent or abandoned.
+            if success:
+                background_tasks.add_task(release_ticket, ticket)
+            else:
+                ticket.release()
+
+        outcome = "success" if success else "rejected" if rejected else "failure"
+        REQUESTS.labels(outcome).inc()
+        REQUEST_SECONDS.labels(outcome).observe(time.time() - start_ts)
 
         if not success:
-            if image_file:
-                try:
-                    properties["image_size"] = list(LoadImage()(image_file).shape)
-                except:
-                    pass
             if output:
                 properties["error"] = output.get("error")
 
-        helpers.LOGGER.info(
-            helpers.build_log_message(
-                request_parameters={k: v for k, v in headers.items() if k and k.lower().startswith("nvcf")},
-                inference_type="medical",
-                properties=properties,
-                event_type="AIPlayground_Inference",
-                success=success,
-            ),
-        )
+        def log_request() -> None:
+            properties["stage_latency"] = timer.rounded()
+            helpers.LOGGER.info(
+                helpers.build_log_message(
+                    request_parameters={k: v for k, v in headers.items() if k and k.lower().startswith("nvcf")},
+                    inference_type="medical",
+                    properties=properties,
+                    event_type="AIPlayground_Inference",
+                    success=success,
+                ),
+            )
+
+        # A sent response is logged after its "send" stage, which is recorded once the body is out.
+        if success:
+            background_tasks.add_task(log_request)
+        else:
+            log_request()
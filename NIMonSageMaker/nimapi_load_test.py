@@ -0,0 +1,472 @@
+"""
+End-to-end load test of the VISTA-3D proxy against local stand-ins of its dependencies.
+
+The proxy (`nimapi.index:app`) runs under uvicorn in its own process, as in the container.
+A second process serves a fake S3 and HealthImaging API over HTTP, and a fake Triton gRPC
+server on localhost:8001. The fake Triton answers `ModelInfer` with a mask of the input's
+shape after a configurable compute delay, `--triton-instances` requests at a time.
+HealthImaging frames are fetched by a stand-in for `ahi-retrieve` that calls the fake
+GetImageFrame. S3 inputs are synthetic CT volumes and HealthImaging inputs are image sets
+of synthetic JPEG 2000 frames, with the shapes given in `--mix`.
+
+Clients keep `--concurrency` requests in flight. Each request picks a mix entry by weight.
+With probability `--reuse` it repeats an earlier image of that entry, which exercises the
+volume cache. The report lists throughput, latency percentiles, status codes and error
+rates. It also lists the peak RSS of the proxy and its worker processes, and the proxy's
+admission and stage statistics.
+
+The fake HealthImaging API, the synthetic image sets and the report helpers come from the
+model handler's harness, ModelInference/src/load_test.py, so the harness runs from a checkout
+of this repository. Mount it into the NIM image and stop Triton, so that port 8001 is free:
+
+    docker run --rm --runtime=nvidia -v $PWD:/workshop --entrypoint python nim-shim:latest \\
+        /workshop/NIMonSageMaker/nimapi_load_test.py
+
+The proxy is imported from `--package-root`, the image's /opt/nvidia/vista3d by default.
+HealthImaging entries need the `pylibjpeg-openjpeg` package to encode the frames.
+
+usage: python nimapi_load_test.py [--mix SOURCE:SLICESxSIZE[:WEIGHT],...] [--concurrency N]
+                                  [--requests N] [--reuse F] [--infer-seconds S]
+                                  [--infer-seconds-per-mvoxel S] [--triton-instances N]
+                                  [--accept TYPE] [--package-root DIR]
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from http.server import ThreadingHTTPServer
+from typing import Dict, List, NamedTuple
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, "ModelInference", "src"))
+
+import numpy as np
+import requests
+
+import load_test as handler_load_test
+from load_test import (
+    DATASTORE_ID,
+    FRAME_VARIANTS,
+    MemorySampler,
+    _status_fields,
+    image_set_id,
+    latency_summary,
+    phantom_slice,
+)
+
+SOURCES = ("s3", "healthimaging")
+BUCKET = "vista3d-load-test"
+TRITON_ADDRESS = "localhost:8001"
+
+
+class MixEntry(NamedTuple):
+    source: str
+    slices: int
+    size: int
+    weight: float
+
+    @property
+    def name(self) -> str:
+        return f"{self.source}:{self.slices}x{self.size}"
+
+
+def parse_mix(text: str) -> List[MixEntry]:
+    """`s3:300x512:3,healthimaging:120x512:1`: source, slices x rows/columns and a relative weight."""
+    entries = []
+    for item in text.split(","):
+        match = re.fullmatch(r"(\w+):(\d+)x(\d+)(?::([\d.]+))?", item.strip())
+        if not match or match.group(1) not in SOURCES:
+            raise argparse.ArgumentTypeError(f"Invalid mix entry {item!r}, expected SOURCE:SLICESxSIZE[:WEIGHT]")
+        entries.append(MixEntry(match.group(1), int(match.group(2)), int(match.group(3)), float(match.group(4) or 1)))
+    return entries
+
+
+def nifti_volume(slices: int, size: int, path: str) -> bytes:
+    import SimpleITK as sitk
+
+    image = sitk.GetImageFromArray(np.stack([phantom_slice(i % FRAME_VARIANTS, size) for i in range(slices)]))
+    image.SetSpacing((0.8, 0.8, 1.5))
+    sitk.WriteImage(image, path)
+    with open(path, "rb") as fp:
+        return fp.read()
+
+
+class FakeAWS(handler_load_test.FakeAWS):
+    """The model handler harness's fake HealthImaging image sets, plus synthetic S3 volumes."""
+
+    def __init__(self, entries: List[MixEntry], work_dir: str):
+        super().__init__(entry.size for entry in entries if entry.source == "healthimaging")
+        self.volumes: Dict[tuple, bytes] = {}
+        for entry in entries:
+            if entry.source == "s3" and (entry.slices, entry.size) not in self.volumes:
+                path = os.path.join(work_dir, f"{entry.slices}x{entry.size}.nii.gz")
+                self.volumes[(entry.slices, entry.size)] = nifti_volume(entry.slices, entry.size, path)
+
+
+class FakeAWSHandler(handler_load_test.FakeAWSHandler):
+    """
+    The model handler harness's fake HealthImaging API, plus S3 HeadObject/GetObject (with
+    ranges) on `s3://BUCKET/volumes/<slices>x<size>/<any>.nii.gz`.
+    """
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        match = re.fullmatch(rf"/{BUCKET}/volumes/(\d+)x(\d+)/[^?]+", self.path.split("?")[0])
+        data = self.aws.volumes.get((int(match.group(1)), int(match.group(2)))) if match else None
+        if data is None:
+            error = b"<Error><Code>NoSuchKey</Code><Message>The specified key does not exist.</Message></Error>"
+            return self._reply(404, error, "application/xml")
+        headers = {
+            "ETag": f'"{hashlib.md5(match.group(0).encode()).hexdigest()}"',
+            "Last-Modified": formatdate(0, usegmt=True),
+            "Accept-Ranges": "bytes",
+        }
+        status, start, end = 200, 0, len(data) - 1
+        byte_range = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if byte_range:
+            status, start = 206, int(byte_range.group(1))
+            end = min(end, int(byte_range.group(2) or end))
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+        self._reply(status, data[start:end + 1], "application/octet-stream", headers)
+        self.aws.count("HeadObject" if self.command == "HEAD" else "GetObject", sent=0 if self.command == "HEAD" else end + 1 - start)
+
+
+def fake_triton_server(output_dir: str, infer_seconds: float, seconds_per_mvoxel: float, instances: int):
+    """
+    gRPC server on localhost:8001 that answers VISTA-3D `ModelInfer` calls like Triton, with a
+    synthetic mask, and `ModelStatistics` with the queue and compute time it spent on them.
+    """
+    from concurrent import futures
+
+    import grpc
+    import SimpleITK as sitk
+    from tritonclient.grpc import service_pb2, service_pb2_grpc
+    from tritonclient.utils import deserialize_bytes_tensor, serialize_byte_tensor
+
+    class FakeTriton(service_pb2_grpc.GRPCInferenceServiceServicer):
+        slots = threading.Semaphore(instances)
+        lock = threading.Lock()
+        # Running totals like Triton's inference statistics: successes, queue and compute nanoseconds.
+        totals = {"count": 0, "queue": 0, "compute_infer": 0}
+
+        def ServerLive(self, request, context):
+            return service_pb2.ServerLiveResponse(live=True)
+
+        def ServerReady(self, request, context):
+            return service_pb2.ServerReadyResponse(ready=True)
+
+        def ModelReady(self, request, context):
+            return service_pb2.ModelReadyResponse(ready=True)
+
+        def ModelStatistics(self, request, context):
+            with self.lock:
+                totals = dict(self.totals)
+            duration = service_pb2.StatisticDuration
+            return service_pb2.ModelStatisticsResponse(
+                model_stats=[
+                    service_pb2.ModelStatistics(
+                        name=request.name or "vista3d",
+                        version="1",
+                        inference_count=totals["count"],
+                        execution_count=totals["count"],
+                        inference_stats=service_pb2.InferStatistics(
+                            success=duration(count=totals["count"], ns=totals["queue"] + totals["compute_infer"]),
+                            queue=duration(count=totals["count"], ns=totals["queue"]),
+                            compute_infer=duration(count=totals["count"], ns=totals["compute_infer"]),
+                        ),
+                    )
+                ]
+            )
+
+        def ModelInfer(self, request, context):
+            payload = json.loads(deserialize_bytes_tensor(request.raw_input_contents[0])[0])
+            queued_ts = time.perf_counter()
+            # Triton queues requests beyond its model instances.
+            with self.slots:
+                start_ts = time.perf_counter()
+                reader = sitk.ImageFileReader()
+                reader.SetFileName(payload["image"])
+                reader.ReadImageInformation()
+                size = reader.GetSize()
+                mask = np.zeros(tuple(reversed(size)), dtype=np.uint8)
+                mask[size[2] // 3 : size[2] // 2, size[1] // 3 : size[1] // 2, size[0] // 2 : size[0] * 2 // 3] = 1
+                pred = os.path.join(output_dir, f"{uuid.uuid4().hex}.nii.gz")
+                sitk.WriteImage(sitk.GetImageFromArray(mask), pred)
+                delay = infer_seconds + int(np.prod(size)) / 1e6 * seconds_per_mvoxel
+                time.sleep(max(0.0, delay - (time.perf_counter() - start_ts)))
+                with self.lock:
+                    self.totals["count"] += 1
+                    self.totals["queue"] += int((start_ts - queued_ts) * 1e9)
+                    self.totals["compute_infer"] += int((time.perf_counter() - start_ts) * 1e9)
+            output = serialize_byte_tensor(np.array([json.dumps({"pred": pred}).encode()], dtype=np.object_))
+            return service_pb2.ModelInferResponse(
+                model_name=request.model_name,
+                id=request.id,
+                outputs=[service_pb2.ModelInferResponse.InferOutputTensor(name="OUTPUT_RESPONSE", datatype="BYTES", shape=[1])],
+                raw_output_contents=[output.item()],
+            )
+
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=64))
+    service_pb2_grpc.add_GRPCInferenceServiceServicer_to_server(FakeTriton(), server)
+    if not server.add_insecure_port(TRITON_ADDRESS):
+        raise SystemExit(f"{TRITON_ADDRESS} is in use; stop Triton before running the load test")
+    server.start()
+    return server
+
+
+def run_fakes(conn, entries: List[MixEntry], work_dir: str, infer_seconds: float, seconds_per_mvoxel: float, instances: int):
+    """Fake-dependency process: sends the AWS endpoint URL once it serves, then answers `stats` until `stop`."""
+    try:
+        aws = FakeAWS(entries, work_dir)
+        server = ThreadingHTTPServer(("127.0.0.1", 0), FakeAWSHandler)
+        server.daemon_threads = True
+        server.aws = aws
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        triton = fake_triton_server(work_dir, infer_seconds, seconds_per_mvoxel, instances)
+    except BaseException as e:
+        conn.send({"error": repr(e)})
+        raise
+    conn.send({"aws_url": f"http://127.0.0.1:{server.server_address[1]}"})
+    while conn.recv() != "stop":
+        with aws.lock:
+            conn.send(dict(aws.stats))
+    triton.stop(0)
+    server.shutdown()
+
+
+def ahi_retrieve(argv: List[str]) -> None:
+    """Stand-in for the `ahi-retrieve` batch tool: writes <datastoreId>/<imageSetId>/<frameId>.jph."""
+    import boto3
+    from botocore.config import Config
+
+    parser = argparse.ArgumentParser(prog="ahi-retrieve")
+    parser.add_argument("-i", dest="metadata", required=True)
+    for flag in ("-r", "-a", "-s", "-f"):
+        parser.add_argument(flag)
+    args = parser.parse_args(argv)
+    with open(args.metadata) as fp:
+        metadata = json.load(fp)
+    frame_ids = [
+        frame["ID"]
+        for series in metadata["Study"]["Series"].values()
+        for instance in series["Instances"].values()
+        for frame in instance["ImageFrames"]
+    ]
+    image_path = os.path.join(metadata["DatastoreID"], metadata["ImageSetID"])
+    os.makedirs(image_path, exist_ok=True)
+    client = boto3.client("medical-imaging", config=Config(max_pool_connections=32))
+
+    def fetch(frame: str) -> None:
+        response = client.get_image_frame(
+            datastoreId=metadata["DatastoreID"],
+            imageSetId=metadata["ImageSetID"],
+            imageFrameInformation={"imageFrameId": frame},
+        )
+        with open(os.path.join(image_path, f"{frame}.{args.f or 'jph'}"), "wb") as fp:
+            fp.write(response["imageFrameBlob"].read())
+
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        list(executor.map(fetch, frame_ids))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def plan_requests(entries: List[MixEntry], count: int, reuse: float, seed: int) -> List[tuple]:
+    """(entry, image URL) per request; a reused URL hits the proxy's volume cache."""
+    rng = random.Random(seed)
+    last_url: Dict[MixEntry, str] = {}
+    plan = []
+    for n in range(count):
+        entry = rng.choices(entries, weights=[e.weight for e in entries])[0]
+        if entry in last_url and rng.random() < reuse:
+            url = last_url[entry]
+        elif entry.source == "s3":
+            url = f"s3://{BUCKET}/volumes/{entry.slices}x{entry.size}/{n:06d}.nii.gz"
+        else:
+            url = f"healthimaging://{DATASTORE_ID}/{image_set_id(entry.slices, entry.size, n)}"
+        last_url[entry] = url
+        plan.append((entry, url))
+    return plan
+
+
+def wait_until_ready(base_url: str, proxy: subprocess.Popen, timeout: float) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proxy.poll() is not None:
+            raise RuntimeError(f"The proxy exited with {proxy.returncode}")
+        try:
+            if requests.get(f"{base_url}/health/ready", timeout=5).json() is True:
+                return
+        except (requests.exceptions.RequestException, ValueError):
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"The proxy was not ready within {timeout:.0f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("s3:300x512:3,s3:120x512:1"), help="request mix")
+    parser.add_argument("--concurrency", type=int, default=4, help="requests in flight")
+    parser.add_argument("--requests", type=int, default=40, help="requests to send")
+    parser.add_argument("--reuse", type=float, default=0.0, help="probability that a request repeats an earlier image")
+    parser.add_argument("--infer-seconds", type=float, default=2.0, help="fixed compute delay of the fake Triton")
+    parser.add_argument("--infer-seconds-per-mvoxel", type=float, default=0.0, help="added delay per million voxels")
+    parser.add_argument("--triton-instances", type=int, default=1, help="requests the fake Triton computes at once")
+    parser.add_argument("--accept", default=None, help="Accept header of the requests, e.g. application/x-vista3d-rle")
+    parser.add_argument("--timeout", type=float, default=600, help="client timeout per request in seconds")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the request mix")
+    parser.add_argument("--package-root", default="/opt/nvidia/vista3d", help="directory holding the nimapi package")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="vista3d-load-test-") as work_dir:
+        context = multiprocessing.get_context("spawn")
+        conn, child_conn = context.Pipe()
+        fakes = context.Process(
+            target=run_fakes,
+            args=(child_conn, args.mix, work_dir, args.infer_seconds, args.infer_seconds_per_mvoxel, args.triton_instances),
+            daemon=True,
+        )
+        fakes.start()
+        started = conn.recv()
+        if "error" in started:
+            raise SystemExit(f"Fake dependencies failed to start: {started['error']}")
+
+        retrieve_bin = os.path.join(work_dir, "ahi-retrieve")
+        with open(retrieve_bin, "w") as fp:
+            fp.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.abspath(__file__)}" ahi-retrieve "$@"\n')
+        os.chmod(retrieve_bin, 0o755)
+        env = dict(os.environ)
+        env.update(
+            {
+                "AWS_ENDPOINT_URL": started["aws_url"],
+                "AWS_ACCESS_KEY_ID": "load-test",
+                "AWS_SECRET_ACCESS_KEY": "load-test",
+                "AWS_REGION": "us-east-1",
+                "AWS_DEFAULT_REGION": "us-east-1",
+                "AWS_EC2_METADATA_DISABLED": "true",
+                # HealthImaging data plane calls go to runtime-<endpoint host> otherwise.
+                "AWS_DISABLE_HOST_PREFIX_INJECTION": "true",
+                "NIMS_AHI_RETRIEVE_BIN": retrieve_bin,
+                "PYTHONPATH": os.pathsep.join([args.package_root, env.get("PYTHONPATH", "")]),
+            }
+        )
+        env.setdefault("NIMS_CACHE_DIR", os.path.join(work_dir, "volume-cache"))
+        port = free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        log_path = os.path.join(work_dir, "proxy.log")
+        with open(log_path, "wb") as log:
+            proxy = subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "nimapi.index:app", "--host", "127.0.0.1", "--port", str(port)],
+                cwd=args.package_root,
+                env=env,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+            )
+        try:
+            try:
+                wait_until_ready(base_url, proxy, timeout=120)
+            except RuntimeError as e:
+                with open(log_path, errors="replace") as fp:
+                    raise SystemExit(f"{e}\n{fp.read()[-4000:]}")
+
+            sampler = MemorySampler([proxy.pid])
+            sampler.start()
+            headers = {"Accept": args.accept} if args.accept else {}
+            sessions = threading.local()
+
+            def send(entry: MixEntry, url: str) -> dict:
+                if not hasattr(sessions, "session"):
+                    sessions.session = requests.Session()
+                result = {"entry": entry.name, "status": 0, "bytes": 0}
+                start_ts = time.perf_counter()
+                try:
+                    response = sessions.session.post(
+                        f"{base_url}/vista3d/inference",
+                        json={"image": url, "prompts": {"classes": ["liver", "spleen"]}},
+                        headers=headers,
+                        timeout=args.timeout,
+                    )
+                    result.update(status=response.status_code, bytes=len(response.content))
+                    if not response.ok:
+                        result["error"] = response.text[:200]
+                except requests.exceptions.RequestException as e:
+                    result["error"] = repr(e)
+                result["seconds"] = time.perf_counter() - start_ts
+                return result
+
+            plan = plan_requests(args.mix, args.requests, args.reuse, args.seed)
+            start_ts = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                results = list(executor.map(lambda item: send(*item), plan))
+            wall_seconds = time.perf_counter() - start_ts
+
+            # Tickets are released by background tasks after the responses were sent.
+            deadline = time.time() + 10
+            admission = requests.get(f"{base_url}/health/admission", timeout=10).json()
+            while admission["active"] and time.time() < deadline:
+                time.sleep(0.2)
+                admission = requests.get(f"{base_url}/health/admission", timeout=10).json()
+            stages = requests.get(f"{base_url}/health/stages", timeout=10).json()
+            tree_peak = sampler.stop()
+            proxy_peak = _status_fields(proxy.pid).get("VmHWM")
+            conn.send("stats")
+            fake_stats = conn.recv()
+        finally:
+            proxy.terminate()
+            proxy.wait(timeout=30)
+            conn.send("stop")
+            fakes.join(timeout=10)
+
+    ok = [r for r in results if r["status"] == 200]
+    status_codes: Dict[str, int] = {}
+    for r in results:
+        status_codes[str(r["status"])] = status_codes.get(str(r["status"]), 0) + 1
+    report = {
+        "concurrency": args.concurrency,
+        "requests": len(results),
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput_rps": round(len(ok) / wall_seconds, 3),
+        "response_mb_per_second": round(sum(r["bytes"] for r in ok) / wall_seconds / 1024**2, 3),
+        "status_codes": status_codes,
+        "error_rate": round(1 - len(ok) / len(results), 4) if results else None,
+        "latency_seconds": latency_summary([r["seconds"] for r in ok]),
+        "by_entry": {},
+        "errors": sorted({r["error"] for r in results if "error" in r})[:10],
+        "memory": {"proxy_peak_rss_bytes": proxy_peak, "proxy_tree_peak_rss_bytes": tree_peak},
+        "admission": admission,
+        "stages": stages,
+        "fake_requests": fake_stats,
+    }
+    for entry in args.mix:
+        entry_results = [r for r in results if r["entry"] == entry.name]
+        report["by_entry"][entry.name] = {
+            "requests": len(entry_results),
+            "errors": sum(1 for r in entry_results if r["status"] != 200),
+            "latency_seconds": latency_summary([r["seconds"] for r in entry_results if r["status"] == 200]),
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["ahi-retrieve"]:
+        ahi_retrieve(sys.argv[2:])
+    else:
+        main()
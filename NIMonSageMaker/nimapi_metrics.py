@@ -0,0 +1,169 @@
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from prometheus_client import REGISTRY, Counter, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+
+# Latency buckets from 5 ms to 10 min; a large CT can spend minutes in fetch or inference.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+STAGE_SECONDS = Histogram(
+    "vista3d_stage_seconds", "Time spent per request processing stage.", ["stage"], buckets=LATENCY_BUCKETS
+)
+REQUEST_SECONDS = Histogram(
+    "vista3d_request_seconds", "End-to-end inference request latency.", ["outcome"], buckets=LATENCY_BUCKETS
+)
+REQUESTS = Counter("vista3d_requests", "Inference requests.", ["outcome"])
+DOWNLOAD_BYTES = Counter("vista3d_download_bytes", "Bytes fetched from image sources.", ["backend"])
+IMAGE_CACHE = Counter("vista3d_image_cache_lookups", "Input-volume cache lookups.", ["result"])
+IMAGE_VOXELS = Histogram(
+    "vista3d_image_voxels", "Voxels per input volume.", buckets=tuple(4**n * 1024 for n in range(4, 12))
+)
+ADMISSION_WAIT_SECONDS = Histogram(
+    "vista3d_admission_wait_seconds", "Time requests waited for admission.", ["outcome"], buckets=LATENCY_BUCKETS
+)
+ADMISSION_REJECTIONS = Counter("vista3d_admission_rejections", "Requests rejected by admission control.", ["reason"])
+ADMISSION_COST_BYTES = Histogram(
+    "vista3d_admission_cost_bytes",
+    "Estimated host memory per request, by where the estimate came from.",
+    ["source"],
+    buckets=tuple(2**n * 1024**2 for n in range(6, 17)),
+)
+
+# Timer of the request being processed; stage executors record their queue and run times into it.
+current_timer: ContextVar[Optional["RequestTimer"]] = ContextVar("current_timer", default=None)
+
+
+class RequestTimer:
+    """Per-request latency breakdown, mirrored into the stage histogram as it is recorded."""
+
+    def __init__(self):
+        self.timings: dict[str, float] = {}
+
+    def record(self, stage: str, seconds: float) -> None:
+        self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+        STAGE_SECONDS.labels(stage).observe(seconds)
+
+    def record_since(self, stage: str, start: float) -> None:
+        """Record the time elapsed since `start`, a `time.perf_counter()` value."""
+        self.record(stage, time.perf_counter() - start)
+
+    @contextmanager
+    def stage(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def rounded(self) -> dict[str, float]:
+        return {stage: round(seconds, 3) for stage, seconds in self.timings.items()}
+
+
+@contextmanager
+def timed(stage: str):
+    """Record a stage into the current request timer, if any."""
+    timer = current_timer.get()
+    if timer is None:
+        yield
+        return
+    with timer.stage(stage):
+        yield
+
+
+def triton_statistics(client, model_name: str) -> Optional[dict[str, int]]:
+    """Cumulative successful inferences and queue/compute nanoseconds of a Triton model, or None if unavailable."""
+    try:
+        statistics = client.get_inference_statistics(model_name=model_name, as_json=True)
+    except Exception as e:
+        logging.debug(f"Unable to read Triton statistics of {model_name}: {e}")
+        return None
+    totals = {"count": 0, "queue": 0, "compute_infer": 0}
+    for model in statistics.get("model_stats", []):
+        inference = model.get("inference_stats", {})
+        # Protobuf JSON renders uint64 as strings and leaves out zero fields.
+        totals["count"] += int(inference.get("success", {}).get("count", 0))
+        totals["queue"] += int(inference.get("queue", {}).get("ns", 0))
+        totals["compute_infer"] += int(inference.get("compute_infer", {}).get("ns", 0))
+    return totals
+
+
+class StageCollector:
+    """Exports the queue depth and in-flight work of the stage executors as gauges."""
+
+    def __init__(self, stages: dict):
+        self.stages = stages
+
+    def collect(self):
+        queued = GaugeMetricFamily("vista3d_stage_queued", "Calls waiting for a stage slot.", labels=["stage"])
+        active = GaugeMetricFamily("vista3d_stage_active", "Calls running on a stage executor.", labels=["stage"])
+        for name, stage in self.stages.items():
+            queued.add_metric([name], stage.queued)
+            active.add_metric([name], stage.active)
+        yield queued
+        yield active
+
+
+def register_stage_collector(stages: dict) -> None:
+    REGISTRY.register(StageCollector(stages))
+
+
+class AdmissionCollector:
+    """Exports the admission queue and the budget in use as gauges."""
+
+    def __init__(self, controller):
+        self.controller = controller
+
+    def collect(self):
+        controller = self.controller
+        for name, documentation, value in (
+            ("vista3d_admission_queued", "Requests waiting for admission.", controller.queued),
+            ("vista3d_admission_active", "Admitted requests in flight.", controller.active),
+            ("vista3d_admission_memory_bytes", "Estimated memory of the admitted requests.", controller.memory_in_use),
+            ("vista3d_admission_memory_budget_bytes", "Memory budget of admission control.", controller.memory_budget),
+        ):
+            gauge = GaugeMetricFamily(name, documentation)
+            gauge.add_metric([], value)
+            yield gauge
+
+
+def register_admission_collector(controller) -> None:
+    REGISTRY.register(AdmissionCollector(controller))
+
+
+class TritonCollector:
+    """
+    Exports Triton's cumulative inference statistics of a model, read at scrape time. Triton
+    only keeps them as totals per model, so they are server-level counters; the time of one
+    request's Triton call is its "infer" stage.
+    """
+
+    def __init__(self, url: str, model_name: str):
+        self.url = url
+        self.model_name = model_name
+        self._client = None
+
+    def collect(self):
+        if self._client is None:
+            import tritonclient.grpc as grpcclient
+
+            self._client = grpcclient.InferenceServerClient(url=self.url)
+        totals = triton_statistics(self._client, self.model_name)
+        if totals is None:
+            return
+        for name, documentation, value in (
+            ("vista3d_triton_inferences", "Successful inferences reported by Triton.", totals["count"]),
+            ("vista3d_triton_queue_seconds", "Time inferences waited in Triton's scheduler queue.", totals["queue"] / 1e9),
+            ("vista3d_triton_compute_seconds", "Time Triton spent executing the model.", totals["compute_infer"] / 1e9),
+        ):
+            counter = CounterMetricFamily(name, documentation, labels=["model"])
+            counter.add_metric([self.model_name], value)
+            yield counter
+
+
+def register_triton_collector(url: str, model_name: str) -> None:
+    REGISTRY.register(TritonCollector(url, model_name))
@@ -0,0 +1,103 @@
+import asyncio
+import importlib.util
+import os
+import sys
+import types
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+pytest.importorskip("fastapi")
+pytest.importorskip("prometheus_client")
+pytest.importorskip("SimpleITK")
+
+
+def load(name):
+    """Import nimapi_<name>.py as nimapi.<name>, the module the Dockerfile installs it as."""
+    if "nimapi" not in sys.modules:
+        package = types.ModuleType("nimapi")
+        package.__path__ = []
+        sys.modules["nimapi"] = package
+    if f"nimapi.{name}" not in sys.modules:
+        spec = importlib.util.spec_from_file_location(f"nimapi.{name}", os.path.join(ROOT, f"nimapi_{name}.py"))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[spec.name] = module
+        spec.loader.exec_module(module)
+    return sys.modules[f"nimapi.{name}"]
+
+
+load("metrics")
+admission = load("admission")
+encoding = load("encoding")
+
+from fastapi import BackgroundTasks
+from fastapi.responses import StreamingResponse
+from starlette.requests import ClientDisconnect
+
+
+def body(fail_after=None):
+    for n in range(8):
+        if n == fail_after:
+            raise RuntimeError("prediction file vanished")
+        yield b"x" * 1024
+
+
+async def send_response(response, disconnect_after=None):
+    """Send `response` over ASGI 2.4, where a client that went away makes `send` raise OSError."""
+    messages = []
+
+    async def receive():
+        await asyncio.Event().wait()
+
+    async def send(message):
+        if disconnect_after is not None and len(messages) > disconnect_after:
+            raise OSError("connection reset by peer")
+        messages.append(message)
+
+    scope = {"type": "http", "asgi": {"spec_version": "2.4"}}
+    await response(scope, receive, send)
+    return messages
+
+
+async def admitted_stream(fail_after=None, disconnect_after=None):
+    """Admission stats after a single-slot controller's ticket is tied to a streamed response."""
+    controller = admission.AdmissionController(memory_budget=1024**3, max_active=1, max_wait=0.1)
+    ticket = await controller.admit(admission.RequestCost.from_voxels(1000, "test"))
+    assert controller.stats()["active"] == 1
+
+    async def release_ticket():
+        ticket.release()
+
+    background = BackgroundTasks()
+    background.add_task(release_ticket)
+    response = encoding.CleanupResponse(StreamingResponse(body(fail_after)), background)
+    try:
+        await send_response(response, disconnect_after)
+    except (ClientDisconnect, RuntimeError):
+        pass
+    stats = controller.stats()
+    # The slot is free again: a new request is admitted without waiting.
+    (await controller.admit(admission.RequestCost.from_voxels(1000, "test"))).release()
+    return stats
+
+
+def test_cleanup_response_runs_background_after_a_complete_send():
+    assert asyncio.run(admitted_stream())["active"] == 0
+
+
+def test_cleanup_response_releases_ticket_when_client_disconnects():
+    assert asyncio.run(admitted_stream(disconnect_after=2))["active"] == 0
+
+
+def test_cleanup_response_releases_ticket_when_body_fails():
+    assert asyncio.run(admitted_stream(fail_after=3))["active"] == 0
+
+
+def test_cleanup_response_keeps_status_and_headers():
+    response = StreamingResponse(body(), media_type="application/x-vista3d-raw", headers={"X-Test": "1"})
+    wrapped = encoding.CleanupResponse(response, BackgroundTasks())
+    messages = asyncio.run(send_response(wrapped))
+    assert messages[0]["status"] == 200
+    assert (b"x-test", b"1") in messages[0]["headers"]
+    assert sum(len(m.get("body", b"")) for m in messages) == 8 * 1024